@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+filter_illumina_index Client
+========================
+
+Runs filter_illumina_index in a server started with `--serve SOCKET`, which
+has the interpreter and modules already loaded, rather than starting the
+program afresh, e.g. for many small files. Takes the same options as the
+program, with paths relative to the current directory; messages of the
+program are shown on stdout and stderr as usual, and the exit status is
+that of the program.
+
+To run a request, or shut down the server once running requests finish, use:
+|   python -m filter_illumina_index.client SOCKET [options of filter_illumina_index]
+|   python -m filter_illumina_index.client --shutdown SOCKET
+
+With `--json` before SOCKET, the reply of the server is written to stdout as
+JSON instead, with the result of the program as returned by `main()` with
+`return_result`, the exit status and the messages written to stdout and
+stderr. Standard input and output (`-`) cannot be used by requests.
+
+Only modules of the standard library needed to send the request are
+imported, so that the client starts quickly.
+"""
+
+import json
+import os
+import socket
+import sys
+
+_PROGRAM_NAME = 'filter_illumina_index.client'
+_USAGE = 'usage: {} [--json] SOCKET [options] | --shutdown SOCKET\n'.format(_PROGRAM_NAME)
+
+
+def send_request(socket_path, request):
+    """
+    Sends a request (a dict) to a server listening on `socket_path`, and
+    returns its reply as a dict.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client_socket:
+        client_socket.connect(socket_path)
+        with client_socket.makefile('rwb') as stream:
+            stream.write(json.dumps(request).encode()+b'\n')
+            stream.flush()
+            reply = stream.readline()
+    if not reply:
+        raise ConnectionError("no reply from server on {}".format(socket_path))
+    return json.loads(reply)
+
+
+def run(socket_path, argv, cwd=None):
+    """
+    Runs the program with command line options `argv` in the server on
+    `socket_path`, in working directory `cwd` (default: current directory),
+    and returns the reply: a dict with the `result` of the program (as
+    returned by `main()` with `return_result`, through JSON), its
+    `exit_status`, and the messages it wrote to `stdout` and `stderr`.
+    """
+    return send_request(socket_path, {"argv": list(argv),
+                                      "cwd": os.getcwd() if cwd is None else cwd})
+
+
+def shutdown(socket_path):
+    """
+    Asks the server on `socket_path` to stop accepting requests, once running
+    requests finish.
+    """
+    send_request(socket_path, {"shutdown": True})
+
+
+def main(argv = None):
+    if argv is None: argv = sys.argv[1:]
+    as_json = argv[:1]==['--json']
+    if as_json: argv = argv[1:]
+    if argv[:1]==['--shutdown'] and len(argv)==2:
+        shutdown(argv[1])
+        return
+    if not argv or argv[0].startswith('-'):
+        sys.stderr.write(_USAGE)
+        sys.exit(2)
+    try:
+        reply = run(argv[0], argv[1:])
+    except OSError as exception:
+        sys.stderr.write("{}: cannot connect to server on {}: {}\n".format(
+            _PROGRAM_NAME, argv[0], exception))
+        sys.exit(1)
+    if as_json:
+        json.dump(reply, sys.stdout, indent=1)
+        print()
+    else:
+        sys.stdout.write(reply["stdout"])
+        sys.stderr.write(reply["stderr"])
+    sys.exit(reply["exit_status"])
+
+
+if __name__ == '__main__':
+    main()
@@ -2,15 +2,82 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import array
+import bisect
+import collections
+import concurrent # concurrent.futures imported lazily, below
+import contextlib
 import functools
-import mimetypes
+import importlib.util
+import itertools
 import gzip
+import io
+import json
+import math
+import operator
+import os
+import queue
+import shutil
+import stat
 import sys
+import threading
+import time
 from functools import partial
 
 import dnaio
 import xopen
 
+def _lazy_import(name):
+    # module imported on first use of one of its attributes, so that runs not
+    # needing it start faster, or None if not installed (or the module itself
+    # if already imported)
+    if name in sys.modules: return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None: return None
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    parent, _, child = name.rpartition('.')
+    if parent: setattr(sys.modules[parent], child, module)
+    return module
+
+np = _lazy_import('numpy') # optional, used for classifying many indexes at once
+statistics = _lazy_import('statistics')
+# only used by some modes (workers, parallel decompression or compression,
+# batch and server modes, memory mapped input, sample sheets and manifests)
+_lazy_import('concurrent.futures')
+csv = _lazy_import('csv')
+mmap = _lazy_import('mmap')
+multiprocessing = _lazy_import('multiprocessing')
+signal = _lazy_import('signal')
+socket = _lazy_import('socket')
+traceback = _lazy_import('traceback')
+
+try:
+    from isal import igzip, isal_zlib as zlib
+except ImportError: # optional, faster decompression of gzip input in parallel
+    import zlib
+    igzip = gzip
+
+try:
+    from zlib_ng import gzip_ng
+except ImportError: # optional, in-process gzip compression backend
+    gzip_ng = None
+
+try:
+    from compression import zstd # Python 3.14 onwards
+except ImportError:
+    try:
+        from backports import zstd
+    except ImportError: # optional, in-process zstd compression
+        zstd = None
+
+if hasattr(int, 'bit_count'): # Python 3.10 onwards
+    _bit_count = int.bit_count
+else:
+    def _bit_count(n): return bin(n).count('1')
+
 """
 Filter a Illumina FASTQ file based on index sequence.
 
@@ -22,7 +89,8 @@ file* (if any). Displays the count of total, filtered and unfiltered reads,
 as well as the number of mismatches found across all reads. Matching tolerating
 a certain number of mismatches (`-m` parameter), and gzip compression for input
 (detected on the basis of file extension) and output (specified using `-c`
-parameter) are supported.
+parameter) are supported. A sample sheet (`-S` parameter) can instead be given
+to demultiplex reads into one output per sample in a single pass.
 """
 _PROGRAM_NAME = 'filter_illumina_index'
 # -------------------------------------------------------------------------------
@@ -34,12 +102,68 @@ _PROGRAM_NAME = 'filter_illumina_index'
 #
 # Dependencies: dnaio, tested with v0.4.1
 #               xopen, tested with v0.9.0
+#               numpy (optional), tested with v2.4
 # -------------------------------------------------------------------------------
 
-_PROGRAM_VERSION = '1.0.5'
+_PROGRAM_VERSION = '1.1.0.dev0'
 # -------------------------------------------------------------------------------
 # ### Change log
 #
+# version 1.1.0.dev0 (in development)
+#   - Demultiplex mode: split reads into one output per sample from a sample
+#     sheet in a single pass (`-S`, `-o`, `--ambiguous`)
+#   - Cache matching results by read index (`--cache-size`), so matching cost
+#     scales with distinct indexes rather than reads
+#   - Process raw records a chunk at a time, copying records to output
+#     unchanged rather than creating and re-writing a `dnaio` record for each
+#   - Passthrough mode copies (or clones) the input, or recompresses it in
+#     large blocks, without parsing records
+#   - Filter chunks in parallel worker processes (`--workers`)
+#   - Filter paired-end and index read files in lockstep, by the index in the
+#     first file, with one filtered/unfiltered output per input file
+#   - Match many distinct barcodes at once using `numpy`, if installed
+#   - Benchmark harness with synthetic FASTQ generator
+#     (`python -m filter_illumina_index.tests.benchmark`)
+#   - `IndexFilter` class for filtering reads or files from Python, which the
+#     command line program now uses
+#   - Statistics report with time spent in each stage and bytes read and
+#     written (`--stats-json`), and progress on stderr (`--progress`)
+#   - Decision log with a tab separated line for each read (`--decision-log`)
+#   - Discover mode counting the most frequent indexes in fixed memory
+#     (`--discover`)
+#   - Decompress BGZF and multi-member gzip input in parallel with `--threads`
+#     more than 1
+#   - Separate input and output threads, compression level for each output,
+#     and in-process compression backends compressing blocks of all outputs
+#     on a shared thread pool (`--compression-backend`), including zstd
+#   - Estimate filtered fraction and mismatches with confidence intervals
+#     from the first reads or a sample of the input (`--head`, `--sample`)
+#   - Memory map a single uncompressed input file, writing records straight
+#     from the mapping
+#   - Sidecar index of the length and index of each record, to filter the same
+#     input again with other parameters without parsing it (`--sidecar`)
+#   - Several numbers of mismatches in one pass (e.g. `--mismatches 0,1,2`),
+#     with filtered reads split into tiers by the smallest they are within
+#   - Read standard input and write standard output (`-`), through background
+#     threads overlapping I/O with filtering, with messages then on stderr
+#   - Write each output file in a thread of its own behind a bounded queue,
+#     with queue depth and waits of each output shown with `-v`
+#   - Batch mode running the jobs of a manifest on a process pool, largest
+#     first, splitting one CPU budget between jobs and their decompression,
+#     classification and compression (`--batch`, `--cpus`)
+#   - Compare indexes packed into integers, counting mismatches with XOR and
+#     `int.bit_count()`; `N` and other IUPAC codes in the index to filter for
+#     (or in sample sheet indexes) are wildcards matching any base
+#   - Server mode running requests from a thin client in processes with
+#     modules already imported (`--serve`, `--max-concurrent`,
+#     `filter_illumina_index_client`), and `numpy` imported only once used
+#   - Checkpoints saved every `--checkpoint-interval` seconds to
+#     `--checkpoint`, from which an interrupted run carries on with the same
+#     output
+#   - Indel-tolerant matching by edit distance (`--distance levenshtein`),
+#     with indexes within `--mismatches` edits looked up in a precomputed
+#     neighborhood of the index to filter for
+#
 # version 1.0.4 2020-04-11
 # Speed up and algorithm changes
 #   - Switch to `dnaio` over Biopython to improve speed (>3x faster + multi-
@@ -78,6 +202,3588 @@ _PROGRAM_VERSION = '1.0.5'
 
 # INITIALISATION
 
+_DEMUX_ALPHABET = 'ACGTN'
+    # bases substituted when building the demultiplexing lookup table
+_AMBIGUOUS = -1
+    # sample number for reads matching more than one sample equally well
+_CHUNK_SIZE = 4*1024**2
+    # size of chunks of raw records read at a time
+_FICLONE = 0x40049409
+    # Linux ioctl request to clone (reflink) a file
+_RUNS_PER_RECORD_JOIN = 4
+    # records in a chunk are written by joining lines rather than as runs of
+    # consecutive records once there is more than 1 run per this many records
+_NEWLINE, _AT, _PLUS, _CR = b'\n@+\r'
+    # byte values looked for in memory mapped FASTQ files
+_DECISION_LOG_HEADER = b'name\tindex1\tindex2\tmismatches1\tmismatches2\tdecision\n'
+    # columns of decision log, one line per read
+_BATCH_MIN_INDEXES = 1024
+    # indexes in a chunk are classified together using numpy (if available)
+    # rather than one at a time with the cache if there are at least this
+    # many distinct indexes
+_GZIP_MAGIC = b'\x1f\x8b\x08'
+    # start of header of each gzip member, with deflate compression
+_GZIP_SEGMENT_SIZE = 4*1024**2
+    # compressed bytes of splittable gzip input decompressed by each thread
+_GZIP_MAX_SEGMENTS = 4
+    # gzip input is decompressed sequentially if no member boundary is found
+    # within this many segments
+_COMPRESS_BLOCK_SIZE = 1024**2
+    # uncompressed bytes of output compressed together by in-process backends
+_COMPRESSION_BACKENDS = ('xopen', 'isal', 'zlib-ng', 'zlib')
+    # backends for writing compressed output, `xopen` choosing for itself
+_GZIP_PROBE_SIZE = 16*1024**2
+_GZIP_PROBE_BLOCK_SIZE = 64*1024
+    # bytes of gzip input examined for the end of the first member, and
+    # decompressed at a time while doing so
+_SIDECAR_FORMAT = 'filter_illumina_index sidecar index 2'
+    # format (and version) of sidecar index files, see `SidecarIndex`
+_SIDECAR_SUFFIX = '.fii'
+    # added to the input file name for the default sidecar index file
+_CHECKPOINT_FORMAT = 'filter_illumina_index checkpoint 1'
+    # format (and version) of checkpoint files, see `Checkpoint`
+_STDIO_PATH = '-'
+    # path standing for standard input or output, as for `xopen`
+_STREAM_QUEUE_DEPTH = 2
+    # chunks read ahead from, or queued for writing to, standard input or
+    # output and other streams, i.e. double buffered
+_WRITE_QUEUE_DEPTH = 4
+    # chunks of records queued for each output file's writer thread
+_BATCH_CPUS_PER_JOB = 3
+    # CPUs given to each batch job run at once, as decompressing its input,
+    # classifying reads and compressing its output can each keep one busy
+_IUPAC_WILDCARDS = 'NRYSWKMBDHV'
+    # IUPAC codes for more than one base, matching any base of a read when
+    # in an index to filter for
+_READ_BASE_CODES = bytes(b'ACGT'.index(c) if c in b'ACGT' else 4 for c in range(256))
+_FILTER_BASE_CODES = bytes(b'ACGT'.index(c) if c in b'ACGT' else 8 for c in range(256))
+_COMPARED_BASES = bytes(0 if chr(c) in _IUPAC_WILDCARDS else 1 for c in range(256))
+    # byte of each base of a packed index (see `pack_index()`): 2 bits for A,
+    # C, G or T, with bit 2 set for other characters of a read and bit 3 for
+    # other characters of an index to filter for, so that they never match;
+    # and 1 for each base compared, 0 for wildcards
+_DEMUX_MAX_WILDCARDS = 4
+    # sample indexes with more wildcards are matched by counting mismatches
+    # rather than by precomputed variants
+_DEMUX_MAX_VARIANTS = 2**20
+    # variants of all sample indexes precomputed for demultiplexing at most,
+    # otherwise reads are matched by counting mismatches
+_SERVE_POLL_INTERVAL = 0.5
+    # seconds between checks by `--serve` for a request to shut down
+_DISTANCES = ('hamming', 'levenshtein')
+    # ways of counting mismatches between indexes: substitutions (plus any
+    # difference in length), or edits including insertions and deletions
+_EDIT_NEIGHBORHOOD_MAX_SIZE = 2**18
+    # indexes within each number of edits of an index to filter for are
+    # precomputed while there are no more than this many in all
+
+
+# HELPER FUNCTIONS
+
+PackedIndex = collections.namedtuple('PackedIndex', ['codes', 'compared', 'length'])
+    # index to filter for packed by `pack_index()`: ints with a byte for each
+    # base, of its code and of whether it is compared, and number of bases
+
+def pack_index(filter_seq_index):
+    """
+    Packs an index to filter for (str or bytes) into a `PackedIndex` for
+    `count_mismatches()`. Each base is a byte of an int, the first base being
+    the lowest: A, C, G and T are 0 to 3 (2 bits), with a higher bit flagging
+    other characters. IUPAC codes for more than one base (`N`, `R`, `Y` etc.)
+    are wildcards, left out of the bases compared.
+    """
+    if isinstance(filter_seq_index, str):
+        filter_seq_index = filter_seq_index.encode('latin-1', 'replace')
+    return PackedIndex(
+        int.from_bytes(filter_seq_index.translate(_FILTER_BASE_CODES), 'little'),
+        int.from_bytes(filter_seq_index.translate(_COMPARED_BASES), 'little'),
+        len(filter_seq_index))
+
+
+def check_index(filter_seq_index):
+    """
+    Raises ValueError if an index to filter for has characters other than A,
+    C, G, T and IUPAC codes for more than one base, which `pack_index()`
+    couldn't match to any character of a read.
+    """
+    invalid = sorted(set(filter_seq_index).difference('ACGT'+_IUPAC_WILDCARDS))
+    if invalid:
+        raise ValueError("index {} has characters other than A, C, G, T and IUPAC "
+            "codes ({}): {}".format(filter_seq_index, _IUPAC_WILDCARDS, ''.join(invalid)))
+
+
+def count_mismatches(entry_seq_index, filter_seq_index):
+    """
+    Number of mismatches between index from a read and index to filter for
+    (str, bytes or a `PackedIndex`); any characters missing from either index
+    count as mismatches, as do characters other than A, C, G and T (such as
+    N in the read) unless matched by a wildcard in the index to filter for.
+    The read index is packed as for `pack_index()`, so that mismatches are
+    the bytes left non-zero by XOR, counted with `int.bit_count()`.
+    """
+    if not isinstance(filter_seq_index, PackedIndex):
+        filter_seq_index = pack_index(filter_seq_index)
+    if isinstance(entry_seq_index, str):
+        entry_seq_index = entry_seq_index.encode('latin-1', 'replace')
+    entry_length = len(entry_seq_index)
+    differences = filter_seq_index.codes ^ int.from_bytes(
+        entry_seq_index.translate(_READ_BASE_CODES), 'little')
+    # lowest bit of each byte set if any of its bits are
+    differences |= differences>>2
+    differences |= differences>>1
+    differences &= filter_seq_index.compared & ((1<<8*entry_length)-1)
+    return _bit_count(differences) + abs(entry_length-filter_seq_index.length)
+
+
+EditIndex = collections.namedtuple('EditIndex', ['masks', 'length'])
+    # index to filter for packed by `pack_edit_index()`: for each code of a
+    # read base, an int with the bits of the positions it matches, and number
+    # of bases
+
+def pack_edit_index(filter_seq_index):
+    """
+    Packs an index to filter for (str or bytes) into an `EditIndex` for
+    `edit_distance()`. For each code of a read base from `_READ_BASE_CODES`
+    (A, C, G, T, then any other character) there is an int with a bit set
+    for each position of the index it matches, the first base being the
+    lowest bit, with wildcards matching any character.
+    """
+    if isinstance(filter_seq_index, str):
+        filter_seq_index = filter_seq_index.encode('latin-1', 'replace')
+    filter_codes = filter_seq_index.translate(_FILTER_BASE_CODES)
+    wildcards = sum(1<<position for position, compared in
+                    enumerate(filter_seq_index.translate(_COMPARED_BASES)) if not compared)
+    masks = tuple(wildcards | sum(1<<position for position, filter_code in
+                                  enumerate(filter_codes) if filter_code==code)
+                  for code in range(5))
+    return EditIndex(masks, len(filter_seq_index))
+
+
+def edit_distance(entry_seq_index, filter_seq_index):
+    """
+    Edit (Levenshtein) distance between index from a read and index to filter
+    for (str, bytes or an `EditIndex`): the fewest substitutions, insertions
+    and deletions of single characters turning one into the other, with
+    characters matching as for `count_mismatches()`. Computed a read base at
+    a time with the column of distances to each prefix of the index to filter
+    for held in the bits of two ints, of positions where the distance goes up
+    and down, as in Myers' bit-parallel algorithm (with Hyyrö's change for
+    the distance between whole strings).
+    """
+    if not isinstance(filter_seq_index, EditIndex):
+        filter_seq_index = pack_edit_index(filter_seq_index)
+    if isinstance(entry_seq_index, str):
+        entry_seq_index = entry_seq_index.encode('latin-1', 'replace')
+    masks, length = filter_seq_index
+    if not length: return len(entry_seq_index)
+    all_bits = (1<<length)-1
+    last_bit = 1<<(length-1)
+    up, down = all_bits, 0 # vertical differences
+    distance = length
+    for code in entry_seq_index.translate(_READ_BASE_CODES):
+        matches = masks[code]
+        vertical = matches | down
+        horizontal = (((matches & up) + up) ^ up) | matches
+        up_horizontal = down | (all_bits & ~(horizontal | up))
+        down_horizontal = up & horizontal
+        if up_horizontal & last_bit: distance += 1
+        elif down_horizontal & last_bit: distance -= 1
+        # first row of distances goes up by one each base
+        up_horizontal = all_bits & (up_horizontal<<1 | 1)
+        down_horizontal = all_bits & down_horizontal<<1
+        up = down_horizontal | (all_bits & ~(vertical | up_horizontal))
+        down = up_horizontal & vertical
+    return distance
+
+
+def edit_neighborhood(filter_seq_index, max_edits, max_size=_EDIT_NEIGHBORHOOD_MAX_SIZE):
+    """
+    Returns a dict of indexes (bytes, of A, C, G, T and N) within `max_edits`
+    edits of index to filter for `filter_seq_index` (str), with the edit distance
+    of each as from `edit_distance()`, generated by applying each edit to the
+    indexes one edit closer, with wildcards first replaced by every base. The
+    dict only has the indexes within as many edits as fit in `max_size`
+    indexes, and is empty if the index to filter for has characters other
+    than A, C, G, T and wildcards, so that an index missing from it may
+    still be within `max_edits` edits.
+    """
+    if set(filter_seq_index).difference('ACGT'+_IUPAC_WILDCARDS):
+        return {}
+    alphabet = [bytes([base]) for base in _DEMUX_ALPHABET.encode()]
+    edits = [b'']
+    for c in filter_seq_index:
+        edits = [variant+base for variant in edits for base in
+                 (alphabet if c in _IUPAC_WILDCARDS else [c.encode()])]
+        if len(edits)>max_size: return {}
+    neighborhood = dict.fromkeys(edits, 0)
+    for n_edits in range(1, max_edits+1):
+        next_edits = []
+        for variant in edits:
+            for position in range(len(variant)+1):
+                # insertion, or substitution or deletion of the next base
+                prefix, suffix = variant[:position], variant[position:]
+                candidates = [prefix+base+suffix for base in alphabet]
+                if suffix:
+                    candidates += [prefix+base+suffix[1:] for base in alphabet]
+                    candidates.append(prefix+suffix[1:])
+                for candidate in candidates:
+                    if candidate not in neighborhood:
+                        neighborhood[candidate] = n_edits
+                        next_edits.append(candidate)
+            if len(neighborhood)>max_size:
+                # indexes with this many edits left out
+                for candidate in next_edits: del neighborhood[candidate]
+                return neighborhood
+        edits = next_edits
+    return neighborhood
+
+
+def _edit_distance_counter(filter_seq_index, max_edits):
+    # returns a function giving the edit distance of a read index (bytes) to
+    # filter_seq_index, looked up in its neighborhood if within max_edits,
+    # otherwise computed
+    neighborhood = edit_neighborhood(filter_seq_index, max_edits)
+    filter_seq_index = pack_edit_index(filter_seq_index)
+    def count_edits(entry_seq_index):
+        n_edits = neighborhood.get(entry_seq_index)
+        if n_edits is None:
+            n_edits = edit_distance(entry_seq_index, filter_seq_index)
+        return n_edits
+    return count_edits
+
+
+def make_index_classifier(filter_seq_index, filter_seq_index2, separator,
+                          max_tolerated_mismatches, cache_size=65536, distance='hamming'):
+    """
+    Returns a function classifying the index from a read, giving
+    `(n_mismatches1, n_mismatches2, filtered)`, the index being str or bytes
+    as taken from the header of a raw record; `filter_seq_index2` is None
+    for a single index, and either index can be '' for passthrough of that
+    index. A run usually has only a few thousand distinct indexes across
+    many millions of reads, so results are kept in a LRU cache of up to
+    `cache_size` indexes. With `distance` of 'levenshtein', mismatches are
+    the edit distance of each index, read indexes within
+    `max_tolerated_mismatches` edits being looked up in an
+    `edit_neighborhood()` of the index to filter for. Raises ValueError if
+    the separator is missing.
+    """
+    passthrough1 = filter_seq_index == ''
+    passthrough2 = not filter_seq_index2
+    if distance=='levenshtein':
+        count_mismatches1 = None if passthrough1 else \
+            _edit_distance_counter(filter_seq_index, max_tolerated_mismatches)
+        count_mismatches2 = None if passthrough2 else \
+            _edit_distance_counter(filter_seq_index2, max_tolerated_mismatches)
+    else:
+        count_mismatches1 = partial(count_mismatches,
+                                    filter_seq_index=pack_index(filter_seq_index))
+        if filter_seq_index2 is not None:
+            count_mismatches2 = partial(count_mismatches,
+                                        filter_seq_index=pack_index(filter_seq_index2))
+    if filter_seq_index2 is not None:
+        separator = separator.encode('latin-1', 'replace')
+    def classify_index(entry_seq_index):
+        if isinstance(entry_seq_index, str):
+            entry_seq_index = entry_seq_index.encode('latin-1', 'replace')
+        entry_seq_index = entry_seq_index.rstrip(b'\r')
+        if filter_seq_index2 is None:
+            n_mismatches1 = count_mismatches1(entry_seq_index)
+            n_mismatches2 = 0
+        else:
+            separator_pos = entry_seq_index.find(separator)
+            if separator_pos==-1:
+                raise ValueError("no separator detected for index {}".format(
+                    entry_seq_index.decode('latin-1')))
+            n_mismatches1 = 0 if passthrough1 else count_mismatches1(
+                entry_seq_index[:separator_pos])
+            n_mismatches2 = 0 if passthrough2 else count_mismatches2(
+                entry_seq_index[separator_pos+len(separator):])
+        filtered = (n_mismatches1+n_mismatches2 <= max_tolerated_mismatches)
+        return n_mismatches1, n_mismatches2, filtered
+    return functools.lru_cache(maxsize=cache_size)(classify_index)
+
+
+def count_mismatches_batch(entry_seq_indexes, filter_seq_index):
+    """
+    Numbers of mismatches between each of a list of indexes (bytes) from reads
+    and the index to filter for (bytes), as for `count_mismatches()` but
+    computed together using numpy, as an array. Indexes are put in a matrix
+    with one row per index, truncated or padded to the length of the index to
+    filter for and coded as for `pack_index()`, with padding and wildcards
+    excluded from the comparison as missing characters are counted from the
+    difference in length.
+    """
+    filter_length = len(filter_seq_index)
+    lengths = np.fromiter(map(len, entry_seq_indexes), dtype=np.intp,
+                          count=len(entry_seq_indexes))
+    n_mismatches = np.abs(lengths-filter_length)
+    if not filter_length: return n_mismatches
+    padded_indexes = map(bytes.ljust,
+        map(operator.getitem, entry_seq_indexes, itertools.repeat(slice(filter_length))),
+        itertools.repeat(filter_length), itertools.repeat(b'\0'))
+    index_matrix = np.frombuffer(b''.join(padded_indexes).translate(_READ_BASE_CODES),
+                                 dtype=np.uint8).reshape(-1, filter_length)
+    differences = index_matrix!=np.frombuffer(
+        filter_seq_index.translate(_FILTER_BASE_CODES), dtype=np.uint8)
+    differences &= np.arange(filter_length)<lengths[:, np.newaxis]
+    differences &= np.frombuffer(filter_seq_index.translate(_COMPARED_BASES),
+                                 dtype=np.uint8).astype(bool)
+    n_mismatches += np.count_nonzero(differences, axis=1)
+    return n_mismatches
+
+
+def edit_distance_batch(entry_seq_indexes, filter_seq_index):
+    """
+    Edit distances between each of a list of indexes (bytes) from reads and
+    the index to filter for (bytes, of up to 64 bases), as for
+    `edit_distance()` but computed together using numpy, as an array. Indexes
+    are put in a matrix with one row per index, padded to the longest and
+    coded as for `pack_edit_index()`, with the bits of each row held in
+    uint64s and only updated for the bases of its index.
+    """
+    filter_index = pack_edit_index(filter_seq_index)
+    lengths = np.fromiter(map(len, entry_seq_indexes), dtype=np.intp,
+                          count=len(entry_seq_indexes))
+    if not filter_index.length or not len(lengths): return lengths
+    max_length = int(lengths.max())
+    padded_indexes = map(bytes.ljust, entry_seq_indexes,
+                         itertools.repeat(max_length), itertools.repeat(b'\0'))
+    index_matrix = np.frombuffer(b''.join(padded_indexes).translate(_READ_BASE_CODES),
+                                 dtype=np.uint8).reshape(-1, max_length)
+    masks = np.array(filter_index.masks, dtype=np.uint64)
+    all_bits = np.uint64((1<<filter_index.length)-1)
+    last_bit = np.uint64(1<<(filter_index.length-1))
+    one = np.uint64(1)
+    up = np.full(len(lengths), all_bits)
+    down = np.zeros_like(up)
+    distances = np.full(len(lengths), filter_index.length, dtype=np.intp)
+    for position in range(max_length):
+        in_index = position<lengths
+        matches = masks[index_matrix[:, position]]
+        vertical = matches | down
+        horizontal = (((matches & up) + up) ^ up) | matches
+        up_horizontal = down | (all_bits & ~(horizontal | up))
+        down_horizontal = up & horizontal
+        distances += in_index & ((up_horizontal & last_bit)!=0)
+        distances -= in_index & ((down_horizontal & last_bit)!=0)
+        up_horizontal = all_bits & (up_horizontal<<one | one)
+        down_horizontal = all_bits & (down_horizontal<<one)
+        up = np.where(in_index, down_horizontal | (all_bits & ~(vertical | up_horizontal)), up)
+        down = np.where(in_index, up_horizontal & vertical, down)
+    return distances
+
+
+def make_batch_index_classifier(filter_seq_index, filter_seq_index2, separator,
+                                max_tolerated_mismatches, distance='hamming'):
+    """
+    Returns a function classifying a list of indexes from reads (bytes) all
+    at once, giving arrays of `(n_mismatches1, n_mismatches2, filtered)` with
+    the same results as the function from `make_index_classifier()` (with the
+    same arguments) for each index. Returns None if numpy is not available,
+    or for edit distances to an index longer than 64 bases. The function
+    raises ValueError if the separator is missing from any index.
+    """
+    if np is None: return None
+    passthrough1 = filter_seq_index == ''
+    passthrough2 = not filter_seq_index2
+    try:
+        filter_seq_index = filter_seq_index.encode('latin-1')
+        if filter_seq_index2 is not None:
+            filter_seq_index2 = filter_seq_index2.encode('latin-1')
+            separator = separator.encode('latin-1')
+    except UnicodeEncodeError: # can't be compared as bytes
+        return None
+    if distance=='levenshtein' and \
+       max(len(filter_seq_index), len(filter_seq_index2 or b''))>64:
+        return None # edit distances computed in uint64s
+    count_batch = edit_distance_batch if distance=='levenshtein' else \
+        count_mismatches_batch
+    def classify_indexes(entry_seq_indexes):
+        entry_seq_indexes = list(map(bytes.rstrip, entry_seq_indexes,
+                                     itertools.repeat(b'\r')))
+        if filter_seq_index2 is None:
+            n_mismatches1 = count_batch(entry_seq_indexes, filter_seq_index)
+            n_mismatches2 = np.zeros_like(n_mismatches1)
+        else:
+            index_parts = list(map(bytes.partition, entry_seq_indexes,
+                                   itertools.repeat(separator)))
+            if not all(map(operator.itemgetter(1), index_parts)):
+                raise ValueError("no separator detected for index")
+            n_mismatches1 = count_batch(
+                list(map(operator.itemgetter(0), index_parts)),
+                b'' if passthrough1 else filter_seq_index)
+            n_mismatches2 = count_batch(
+                list(map(operator.itemgetter(2), index_parts)),
+                b'' if passthrough2 else filter_seq_index2)
+            if passthrough1: n_mismatches1[:] = 0
+            if passthrough2: n_mismatches2[:] = 0
+        filtered = n_mismatches1+n_mismatches2 <= max_tolerated_mismatches
+        return n_mismatches1, n_mismatches2, filtered
+    return classify_indexes
+
+
+def iter_chunks(input_handle, chunk_size=_CHUNK_SIZE):
+    """
+    Yields chunks of complete FASTQ records read from binary `input_handle`,
+    as bytes always ending with a newline.
+    """
+    for chunk in dnaio.read_chunks(input_handle, chunk_size):
+        chunk = bytes(chunk)
+        if not chunk.endswith(b'\n'):
+            chunk += b'\n' # final record lacking newline
+        yield chunk
+
+
+def iter_chunks_lockstep(input_handles, chunk_size=_CHUNK_SIZE):
+    """
+    Yields tuples of chunks, one from each of binary `input_handles` (such as
+    files of read 1, read 2 and index reads), holding the same number of
+    complete FASTQ records and each ending with a newline. Raises
+    `dnaio.FileFormatError` if the files have different numbers of records.
+    """
+    buffers = [b''] * len(input_handles)
+    at_eof = [False] * len(input_handles)
+    while True:
+        for file_number, input_handle in enumerate(input_handles):
+            while not at_eof[file_number] and (len(buffers[file_number])<chunk_size
+                    or buffers[file_number].count(b'\n')<4):
+                data = input_handle.read(chunk_size)
+                if data:
+                    buffers[file_number] += data
+                else:
+                    at_eof[file_number] = True
+                    if buffers[file_number] and not buffers[file_number].endswith(b'\n'):
+                        buffers[file_number] += b'\n' # final record lacking newline
+        n_lines = 4*(min(buffer.count(b'\n') for buffer in buffers)//4)
+        if not n_lines:
+            if any(buffers):
+                raise dnaio.FileFormatError("input files have different numbers "
+                    "of records, or a record is incomplete", line=None)
+            return
+        chunks = []
+        for file_number, buffer in enumerate(buffers):
+            lines = buffer.split(b'\n', n_lines)
+            buffers[file_number] = lines.pop() # rest, after n_lines lines
+            chunks.append(buffer[:len(buffer)-len(buffers[file_number])])
+        yield tuple(chunks)
+
+
+MappedChunk = collections.namedtuple('MappedChunk',
+    ['view', 'record_starts', 'headers', 'normalized'])
+    # complete records of a memory mapped FASTQ file from `iter_mapped_chunks()`:
+    # memoryview of their bytes, numpy array of the offset of each record in
+    # the view followed by the end of the last, header of each record, and
+    # whether the records are as `dnaio` writes them (see `normalize_chunk()`)
+
+@contextlib.contextmanager
+def map_file(path):
+    """
+    Context manager mapping file `path` into memory, read only, as an
+    `mmap.mmap` object.
+    """
+    with open(path, 'rb') as input_handle:
+        mapping = mmap.mmap(input_handle.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mapping, 'madvise'):
+        mapping.madvise(mmap.MADV_SEQUENTIAL)
+    try:
+        yield mapping
+    finally:
+        try:
+            mapping.close()
+        except BufferError:
+            pass # still referenced, e.g. from a traceback, so unmapped once freed
+
+
+def can_map_input(path):
+    """
+    Whether FASTQ file `path` can be read by memory mapping, i.e. it is a
+    regular, non-empty, uncompressed file and `numpy` is available.
+    """
+    return (np is not None and compression_format(path) is None
+            and not is_stream(path) and os.path.getsize(path)>0)
+
+
+def iter_mapped_chunks(mapping, chunk_size=_CHUNK_SIZE, start=0):
+    """
+    Yields `MappedChunk`s of the complete records in about `chunk_size` bytes
+    of an uncompressed FASTQ file at a time, mapped into memory as
+    `mapping`, from offset `start` (the start of a record). Newlines are
+    found with `numpy`, and only the header lines are copied out of the
+    mapping; sequence and quality lines are not otherwise examined. Raises
+    `dnaio.FastqFormatError` if the file is not made of four line records,
+    with the header starting with '@' and third line starting with '+'.
+    """
+    data = np.frombuffer(mapping, dtype=np.uint8)
+    view = memoryview(mapping)
+    try:
+        file_size = len(data)
+        while start<file_size:
+            end = min(start+chunk_size, file_size)
+            while True:
+                newlines = np.flatnonzero(data[start:end]==_NEWLINE)
+                if len(newlines)>=4 or end==file_size: break
+                end = min(end+chunk_size, file_size) # record longer than chunk
+            chunk_view = view
+            if end==file_size and (not len(newlines) or newlines[-1]!=end-start-1):
+                # final line lacking newline, copied with newline added
+                chunk_view = memoryview(mapping[start:file_size]+b'\n')
+                newlines = np.append(newlines, end-start)
+                start_in_view = 0
+            else:
+                start_in_view = start
+            n_records = len(newlines)//4
+            incomplete = not n_records or (end==file_size and len(newlines)%4)
+            newlines = newlines[:4*n_records]
+            record_starts = np.concatenate(([0], newlines[3::4]+1))
+            chunk_data = data[start:end]
+            if incomplete or \
+               not (chunk_data[newlines[1::4]+1]==_PLUS).all():
+                raise dnaio.FastqFormatError("records in FASTQ file must have four "
+                    "lines, with third line starting with '+'", line=None)
+            if not (chunk_data[record_starts[:-1]]==_AT).all():
+                raise dnaio.FastqFormatError("headers in FASTQ file must start "
+                    "with '@'", line=None)
+            headers = list(map(mapping.__getitem__, map(slice,
+                (record_starts[:-1]+start).tolist(), (newlines[0::4]+start).tolist())))
+            normalized = (newlines[2::4]-newlines[1::4]==2).all() and \
+                not (chunk_data[newlines-1]==_CR).any()
+            chunk_length = int(record_starts[-1])
+            yield MappedChunk(chunk_view[start_in_view:start_in_view+chunk_length],
+                              record_starts, headers, bool(normalized))
+            start += chunk_length
+    finally:
+        del data
+        view.release()
+
+
+def head_records(chunk, n_records):
+    """
+    The first `n_records` records of a chunk from `iter_chunks()`, or all of
+    them if fewer.
+    """
+    rest = chunk.split(b'\n', 4*n_records)[-1]
+    return chunk[:len(chunk)-len(rest)]
+
+
+def _record_start(data, offset):
+    # offset of the first record header starting at or after offset of data,
+    # found as a line starting with '@' followed two lines later by a line
+    # starting with '+' (so that quality lines starting with '@' are passed
+    # over), or None if there is none in data
+    position = max(offset-1, 0)
+    while True:
+        position = data.find(b'\n@', position)
+        if position==-1:
+            return None
+        sequence_end = data.find(b'\n', position+2)
+        plus_start = data.find(b'\n', sequence_end+1)+1 if sequence_end!=-1 else 0
+        if not plus_start or plus_start>=len(data):
+            return None
+        if data[plus_start:plus_start+1]==b'+':
+            return position+1
+        position += 1
+
+
+def iter_stride_chunks(input_handle, stride, chunk_size=_CHUNK_SIZE):
+    """
+    Yields chunks of the complete records starting in every `stride`th block
+    of `chunk_size` bytes of uncompressed, seekable binary `input_handle`,
+    seeking past the blocks in between, as for `iter_chunks()`.
+    """
+    file_size = os.fstat(input_handle.fileno()).st_size
+    for block_start in range(0, file_size, stride*chunk_size):
+        # records start after a newline (except at the start of the file), so
+        # the byte before the block is read too
+        lead = 1 if block_start else 0
+        input_handle.seek(block_start-lead)
+        data = input_handle.read(chunk_size+lead)
+        def find_record_start(offset):
+            # reading on as needed to tell where the next record starts
+            nonlocal data
+            while True:
+                record_start = _record_start(data, offset)
+                if record_start is not None:
+                    return record_start
+                read_data = input_handle.read(chunk_size)
+                if not read_data:
+                    return len(data)
+                data += read_data
+        start = find_record_start(lead) if lead else 0
+        if start>=min(chunk_size+lead, len(data)):
+            continue # no record starts in this block
+        # the last record starting in the block ends where the next starts
+        end = find_record_start(chunk_size+lead)
+        chunk = data[start:end]
+        if not chunk.endswith(b'\n'):
+            chunk += b'\n' # final record lacking newline
+        yield chunk
+
+
+def _read_name(header):
+    # name of a read from its header line, without any comment or
+    # `/1`, `/2` suffix (as in older Illumina read names)
+    name = header.partition(b' ')[0]
+    if name[-2:-1] == b'/': name = name[:-2]
+    return name
+
+
+def check_read_names(headers, mate_headers):
+    """
+    Checks that the reads with `headers` and `mate_headers` (from the same
+    position of each input file) have the same names. Raises
+    `dnaio.FileFormatError` on the first read with names not matching.
+    """
+    names = list(map(operator.itemgetter(0),
+                     map(bytes.partition, headers, itertools.repeat(b' '))))
+    mate_names = list(map(operator.itemgetter(0),
+                          map(bytes.partition, mate_headers, itertools.repeat(b' '))))
+    if names == mate_names: return # usual case, checked without a Python loop
+    for header, mate_header in itertools.zip_longest(headers, mate_headers, fillvalue=b''):
+        if _read_name(header) != _read_name(mate_header):
+            raise dnaio.FileFormatError("read names don't match across input "
+                "files: {} and {}".format(header[1:].decode('latin-1'),
+                mate_header[1:].decode('latin-1')), line=None)
+
+
+def split_chunk(chunk):
+    """
+    Splits a chunk from `iter_chunks()` into lines, without newlines, so that
+    the header of each record is `lines[0::4]`. Raises
+    `dnaio.FastqFormatError` if the chunk is not made of four line records.
+    """
+    lines = chunk.split(b'\n')
+    del lines[-1] # empty, after final newline
+    # checking the third line of each record is enough to detect records not
+    # having four lines, as `dnaio.read_chunks()` checks the first header
+    plus_lines = lines[2::4]
+    if len(lines)%4 or \
+       (plus_lines.count(b'+')!=len(plus_lines) and
+        not all(map(bytes.startswith, plus_lines, itertools.repeat(b'+')))):
+        raise dnaio.FastqFormatError("records in FASTQ file must have four "
+            "lines, with third line starting with '+'", line=None)
+    return lines
+
+
+def normalize_chunk(chunk, lines):
+    """
+    Returns `(chunk, lines)` for a chunk and its lines from `split_chunk()`,
+    with records written as `dnaio` writes them: lines ending in '\\r\\n'
+    ending in '\\n' instead, and third lines with a name ('+name') as '+'.
+    Usual chunks, with neither, are returned as they are. Raises
+    `dnaio.FastqFormatError` if the name on the third line of a record is not
+    that of its header, as `dnaio` does.
+    """
+    plus_lines = lines[2::4]
+    if b'\r' not in chunk and plus_lines.count(b'+')==len(plus_lines):
+        return chunk, lines
+    lines = [line[:-1] if line.endswith(b'\r') else line for line in lines]
+    for header, plus_line in zip(lines[0::4], lines[2::4]):
+        if plus_line!=b'+' and plus_line[1:]!=header[1:]:
+            raise dnaio.FastqFormatError("Sequence descriptions don't match "
+                "({!r} != {!r}).\nThe second sequence description must be either "
+                "empty or equal to the first description.".format(
+                header[1:].decode('latin-1'), plus_line[1:].decode('latin-1')),
+                line=None)
+    lines[2::4] = [b'+']*len(plus_lines)
+    return join_chunk_lines(lines, [True]*(len(lines)//4)), lines
+
+
+def join_chunk_lines(lines, selected):
+    """
+    Joins back into bytes the lines from `split_chunk()` for each record where
+    `selected` is true, giving the same bytes as those records in the input.
+    """
+    selected_lines = itertools.compress(lines,
+        itertools.chain.from_iterable(zip(selected, selected, selected, selected)))
+    joined = b'\n'.join(selected_lines)
+    return joined + b'\n' if joined else joined
+
+
+def chunk_runs(chunk, lines, destinations):
+    """
+    Yields `(destination, record_bytes)` for each run of consecutive records in
+    a chunk with the same destination, given lines from `split_chunk()` and
+    the destination of each record. The record bytes are a memoryview of the
+    chunk, so are identical to the input and are not copied.
+    """
+    chunk_view = memoryview(chunk)
+    start = 0
+    line = 0
+    for destination, group in itertools.groupby(destinations):
+        n_lines = 4*len(list(group))
+        end = start + sum(map(len, lines[line:line+n_lines])) + n_lines
+        yield destination, chunk_view[start:end]
+        start = end
+        line += n_lines
+
+
+ChunkResult = collections.namedtuple('ChunkResult',
+    ['n_reads', 'n_filtered', 'cumul_n_mismatches', 'filtered', 'unfiltered',
+     'log_lines', 'decision_log', 'tier_counts'])
+ChunkResult.__doc__ = """
+Result of filtering a chunk: number of reads and filtered reads, counts of
+reads by number of mismatches, bytes of filtered (for each tier in turn) and
+unfiltered records for each input file (empty if not kept), lines to log for
+`-vv`, bytes of decision log lines (empty if not kept) and number of filtered
+reads in each tier.
+"""
+
+
+def decision_log_lines(headers, entry_seq_indexes, decisions):
+    """
+    Lines of the decision log for reads with `headers`, as bytes, given the
+    index of each read and a dict of the decision log fields following the
+    read name for each index (bytes, starting with a tab and ending with a
+    newline), or a single value of these fields for all reads if
+    `entry_seq_indexes` is None.
+    """
+    names = map(operator.itemgetter(0), map(bytes.partition, headers,
+                                             itertools.repeat(b' ')))
+    names = map(operator.getitem, names, itertools.repeat(slice(1, None)))
+    if entry_seq_indexes is None:
+        return decisions.join(names) + decisions if headers else b''
+    fields = map(decisions.__getitem__, entry_seq_indexes)
+    return b''.join(itertools.chain.from_iterable(zip(names, fields)))
+
+
+class BackgroundWriter:
+    """
+    Writes bytes to binary `out_handle` in a background thread, so that
+    writing (and any compression) overlaps with processing. At most
+    `max_pending` writes are queued, after which `write()` (or
+    `writelines()`) waits; the most writes queued at once is kept as
+    `max_depth`, and the number and total seconds of waits as `n_stalls` and
+    `stall_time`. `sync()` waits for queued writes to finish and flushes the
+    handle, and `close()` waits for all writes to finish, closes the handle
+    and raises any exception from writing.
+    """
+
+    def __init__(self, out_handle, max_pending=16):
+        self.out_handle = out_handle
+        self.max_pending = max_pending
+        self.pending = queue.Queue(max_pending)
+        self.exception = None
+        self.max_depth = 0
+        self.n_stalls = 0
+        self.stall_time = 0.0
+        self.n_writes = 0
+        self.thread = threading.Thread(target=self._write_pending, daemon=True)
+        self.thread.start()
+
+    def _write_pending(self):
+        while True:
+            data = self.pending.get()
+            if data is None: break
+            if isinstance(data, threading.Event):
+                data.set() # queued writes done, for sync()
+                continue
+            if self.exception is None:
+                try:
+                    if isinstance(data, list):
+                        self.out_handle.writelines(data)
+                    else:
+                        self.out_handle.write(data)
+                except Exception as exception:
+                    self.exception = exception # raised in main thread
+
+    def _put(self, data):
+        # queues data, timing any wait for the writer thread to catch up
+        if self.exception is not None: raise self.exception
+        try:
+            self.pending.put_nowait(data)
+        except queue.Full:
+            start = time.perf_counter()
+            self.pending.put(data)
+            self.stall_time += time.perf_counter()-start
+            self.n_stalls += 1
+        self.max_depth = max(self.max_depth, self.pending.qsize())
+
+    def write(self, data):
+        self.n_writes += 1
+        self._put(data)
+
+    def writelines(self, lines):
+        self.n_writes += 1
+        self._put(list(lines))
+
+    def sync(self, reopen=None):
+        """
+        Waits for queued writes to finish, then flushes the handle or, if
+        anything was written since the last sync and `reopen` is given,
+        closes it (e.g. ending a gzip member) and writes on to the handle
+        returned by `reopen()`.
+        """
+        written = threading.Event()
+        self._put(written)
+        written.wait()
+        if self.exception is not None: raise self.exception
+        if reopen is not None and self.n_writes:
+            self.out_handle.close()
+            self.out_handle = reopen()
+        else:
+            self.out_handle.flush()
+        self.n_writes = 0
+
+    def close(self):
+        if self.thread.is_alive():
+            self.pending.put(None)
+            self.thread.join()
+            self.out_handle.close()
+        if self.exception is not None: raise self.exception
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def make_chunk_filter(filter_seq_index, filter_seq_index2, separator,
+                      max_tolerated_mismatches, cache_size=65536, verbose=0,
+                      keep_filtered=True, keep_unfiltered=True, classify_index=None,
+                      decision_log=False, thresholds=None, distance='hamming'):
+    """
+    Returns a function filtering a tuple of chunks from
+    `iter_chunks_lockstep()` (or a 1-tuple from `iter_chunks()`), giving a
+    `ChunkResult`. Reads are classified by the index in the headers of the
+    first chunk, with the mates of each read in other chunks given the same
+    outcome. Arguments are as for `make_index_classifier()`, with
+    passthrough mode if both indexes are empty; bytes of filtered or
+    unfiltered records are only kept if needed. A function from
+    `make_index_classifier()` can be given as `classify_index` to share its
+    cache, otherwise a new one is made. If `decision_log`, a line for the
+    decision log is made for each read. `thresholds` are increasing numbers
+    of mismatches, the last being `max_tolerated_mismatches`, for filtered
+    records to be split into tiers by the smallest threshold they are within,
+    with the records of each tier for each input file in turn as the filtered
+    records of the `ChunkResult`. `distance` is as for
+    `make_index_classifier()`.
+    """
+    if thresholds is None: thresholds = [max_tolerated_mismatches]
+    single_threshold = len(thresholds)==1
+    double_index = filter_seq_index2 is not None
+    passthrough1 = filter_seq_index == ''
+    passthrough2 = not filter_seq_index2
+    passthrough_mode = passthrough1 and passthrough2
+    max_tracked_mismatches = max(len(filter_seq_index), len(filter_seq_index2 or ''))
+    separator_bytes = separator.encode('latin-1') if double_index else None
+    if not passthrough_mode:
+        if classify_index is None:
+            classify_index = make_index_classifier(filter_seq_index, filter_seq_index2,
+                separator, max_tolerated_mismatches, cache_size, distance)
+        classify_indexes = make_batch_index_classifier(filter_seq_index,
+            filter_seq_index2, separator, max_tolerated_mismatches, distance)
+    else:
+        classify_index = classify_indexes = None
+
+    def classify_headers(headers):
+        # classifies reads by their headers, returning the number filtered,
+        # the numbers with each number of mismatches, log lines, decision log
+        # lines, the number of reads with each outcome, and the outcome of
+        # each read (or None if all have the same, or no outputs are kept)
+        cumul_n_mismatches = [0 for i in range(max_tracked_mismatches + 2)]
+        log_lines = []
+        if passthrough_mode:
+            # always filtered
+            if verbose>=2:
+                log_lines = ["{} (passthrough-mode) (filtered)".format(
+                    header[1:].decode('latin-1')) for header in headers]
+            decision_log_bytes = decision_log_lines(headers, None,
+                b'\t\t\t0\t0\tpassthrough\n') if decision_log else b''
+            return len(headers), cumul_n_mismatches, log_lines, decision_log_bytes, \
+                [0, len(headers)], None
+
+        # Illimina sequence identifier in FASTQ files:
+        # see https://help.basespace.illumina.com/articles/descriptive/fastq-files/
+        # @<instrument>:<run number>:<flowcell ID>:<lane>:<tile>:<x-pos>:<y-pos> <read>:<is filtered>:<control number>:<sample number>
+        # For the Undetermined FASTQ files only, the sequence observed in the index read is written to the FASTQ header in place of the sample number. This information can be useful for troubleshooting demultiplexing.
+        # grab the sequence index, use simplistic method of value after last : for efficiency
+        header_parts = list(map(bytes.rpartition, headers, itertools.repeat(b':')))
+        if not all(map(operator.itemgetter(1), header_parts)):
+            seqid = next(header for header in headers if b':' not in header)[1:]
+            raise ValueError("no barcode detected for sequence {}".format(
+                seqid.decode('latin-1')))
+        entry_seq_indexes = list(map(operator.itemgetter(2), header_parts))
+        # each distinct index in the chunk is classified once, with
+        # reads having the same index counted together
+        index_counts = collections.Counter(entry_seq_indexes)
+        batch_classification = None
+        if classify_indexes and len(index_counts)>=_BATCH_MIN_INDEXES:
+            # many distinct indexes, as for reads with many sequencing errors,
+            # so classified together rather than mostly missing the cache
+            try:
+                batch_classification = classify_indexes(list(index_counts))
+            except ValueError:
+                pass # raised again for the sequence when classified below
+        if batch_classification is not None:
+            n_mismatches1, n_mismatches2, filtered = batch_classification
+            counts = np.fromiter(index_counts.values(), dtype=np.int64,
+                                 count=len(index_counts))
+            n_mismatches = np.minimum(n_mismatches1+n_mismatches2,
+                                      max_tracked_mismatches+1)
+            cumul_n_mismatches = np.bincount(n_mismatches, weights=counts,
+                minlength=max_tracked_mismatches+2).astype(np.int64).tolist()
+            n_filtered = int(counts[filtered].sum())
+            classifications = dict(zip(index_counts, zip(n_mismatches1.tolist(),
+                n_mismatches2.tolist(), filtered.tolist())))
+        else:
+            classifications = {}
+            n_filtered = 0
+            for entry_seq_index, count in index_counts.items():
+                try:
+                    classification = classify_index(entry_seq_index)
+                except ValueError:
+                    seqid = headers[entry_seq_indexes.index(entry_seq_index)][1:]
+                    raise ValueError("no separator detected for sequence {}".format(
+                        seqid.decode('latin-1'))) from None
+                classifications[entry_seq_index] = classification
+                n_mismatches1, n_mismatches2, filtered = classification
+                n_mismatches = n_mismatches1+n_mismatches2
+                if n_mismatches>max_tracked_mismatches:
+                    n_mismatches = max_tracked_mismatches+1
+                cumul_n_mismatches[n_mismatches] += count
+                if filtered: n_filtered += count
+
+        if verbose>=2:
+            index1 = "(pass)"
+            index2 = "(pass)"
+            for header, entry_seq_index in zip(headers, entry_seq_indexes):
+                n_mismatches1, n_mismatches2, filtered = classifications[entry_seq_index]
+                seqid = header[1:].decode('latin-1')
+                entry_seq_index = entry_seq_index.decode('latin-1')
+                n_mismatches = n_mismatches1+n_mismatches2
+                if not double_index:
+                    log_lines.append("{} -> index {} -> {} mismatches ({})".format(seqid,
+                        entry_seq_index, n_mismatches,
+                        'filtered' if filtered else 'unfiltered'))
+                else:
+                    separator_pos = entry_seq_index.find(separator)
+                    if not passthrough1:
+                        index1 = entry_seq_index[:separator_pos]
+                    if not passthrough2:
+                        index2 = entry_seq_index[separator_pos+len(separator):]
+                    log_lines.append("{} -> {} -> index {} & {} -> {} + {} = {} mismatches ({})".format(seqid,
+                        entry_seq_index, index1, index2,
+                        n_mismatches1, n_mismatches2, n_mismatches,
+                        'filtered' if filtered else 'unfiltered'))
+
+        decision_log_bytes = b''
+        if decision_log:
+            decisions = {}
+            for entry_seq_index, (n_mismatches1, n_mismatches2, filtered) in \
+                    classifications.items():
+                index1 = entry_seq_index.rstrip(b'\r')
+                index2 = b''
+                if double_index:
+                    index1, _, index2 = index1.partition(separator_bytes)
+                decisions[entry_seq_index] = b'\t%s\t%s\t%d\t%d\t%s\n' % (index1,
+                    index2, n_mismatches1, n_mismatches2,
+                    b'filtered' if filtered else b'unfiltered')
+            decision_log_bytes = decision_log_lines(headers, entry_seq_indexes,
+                                                    decisions)
+
+        # outcome of each read: 0 if unfiltered, otherwise the number of the
+        # smallest threshold it is within, from 1 (True with a single threshold)
+        if single_threshold:
+            outcome_counts = [len(headers)-n_filtered, n_filtered]
+        else:
+            outcome_by_index = {entry_seq_index: bisect.bisect_left(thresholds,
+                n_mismatches1+n_mismatches2)+1 if filtered else 0
+                for entry_seq_index, (n_mismatches1, n_mismatches2, filtered)
+                in classifications.items()}
+            outcome_counts = [0 for i in range(len(thresholds)+1)]
+            for entry_seq_index, count in index_counts.items():
+                outcome_counts[outcome_by_index[entry_seq_index]] += count
+        outcomes = None
+        if max(outcome_counts)<len(headers) and (keep_filtered or keep_unfiltered):
+            if single_threshold:
+                outcome_by_index = {entry_seq_index: classification[2]
+                    for entry_seq_index, classification in classifications.items()}
+            outcomes = list(map(outcome_by_index.__getitem__, entry_seq_indexes))
+        return n_filtered, cumul_n_mismatches, log_lines, decision_log_bytes, \
+            outcome_counts, outcomes
+
+    def filter_chunk(chunks):
+        chunks, chunk_lines = zip(*map(normalize_chunk, chunks,
+                                       map(split_chunk, chunks)))
+        headers = chunk_lines[0][0::4]
+        for mate_lines in chunk_lines[1:]:
+            check_read_names(headers, mate_lines[0::4])
+        n_filtered, cumul_n_mismatches, log_lines, decision_log_bytes, outcome_counts, \
+            outcomes = classify_headers(headers)
+        # bytes of records of each input file for each outcome
+        outcome_bytes = [(b'',)*len(chunks) for outcome in outcome_counts]
+        keep_outcomes = [keep_unfiltered]+[keep_filtered]*(len(outcome_counts)-1)
+        if outcomes is None:
+            # all reads have the same outcome
+            if headers and max(outcome_counts)==len(headers):
+                outcome = outcome_counts.index(len(headers))
+                if keep_outcomes[outcome]: outcome_bytes[outcome] = chunks
+        else:
+            n_runs = sum(1 for _ in itertools.groupby(outcomes))
+            outcome_bytes = [[] for outcome in outcome_counts]
+            # mates of each read go to the same output as the read
+            for chunk, lines in zip(chunks, chunk_lines):
+                if n_runs*_RUNS_PER_RECORD_JOIN<len(outcomes):
+                    # copy runs of consecutive records with the same outcome
+                    output_runs = [[] for outcome in outcome_counts]
+                    for outcome, record_bytes in chunk_runs(chunk, lines, outcomes):
+                        output_runs[outcome].append(record_bytes)
+                    for outcome, records in enumerate(output_runs):
+                        outcome_bytes[outcome].append(b''.join(records)
+                            if keep_outcomes[outcome] else b'')
+                else:
+                    # outcomes interleaved, faster to join lines back together
+                    for outcome, keep in enumerate(keep_outcomes):
+                        outcome_bytes[outcome].append(join_chunk_lines(lines,
+                            list(map(operator.eq, outcomes, itertools.repeat(outcome))))
+                            if keep and outcome_counts[outcome] else b'')
+        return ChunkResult(len(headers), n_filtered, cumul_n_mismatches,
+            tuple(itertools.chain.from_iterable(outcome_bytes[1:])),
+            tuple(outcome_bytes[0]), log_lines, decision_log_bytes, outcome_counts[1:])
+
+    def filter_mapped_chunk(mapped_chunk):
+        # as filter_chunk() for a MappedChunk, with lists of memoryviews of
+        # the records of each outcome, mostly of the mapping itself so that
+        # records are written without being copied
+        view, record_starts, headers, normalized = mapped_chunk
+        if not normalized:
+            return filter_chunk((bytes(view),))
+        n_filtered, cumul_n_mismatches, log_lines, decision_log_bytes, outcome_counts, \
+            outcomes = classify_headers(headers)
+        outcome_views = [[] for outcome in outcome_counts]
+        keep_outcomes = [keep_unfiltered]+[keep_filtered]*(len(outcome_counts)-1)
+        if outcomes is None:
+            if max(outcome_counts)==len(headers):
+                outcome = outcome_counts.index(len(headers))
+                if keep_outcomes[outcome]: outcome_views[outcome].append(view)
+        else:
+            outcomes = np.array(outcomes, dtype=np.intp)
+            run_starts = np.flatnonzero(outcomes[1:]!=outcomes[:-1])+1
+            if (len(run_starts)+1)*_RUNS_PER_RECORD_JOIN<len(outcomes):
+                # views of runs of consecutive records with the same outcome
+                run_starts = np.concatenate(([0], run_starts)).tolist()
+                run_ends = run_starts[1:]+[len(outcomes)]
+                for start, end in zip(run_starts, run_ends):
+                    outcome_views[outcomes[start]].append(
+                        view[record_starts[start]:record_starts[end]])
+                for outcome, keep in enumerate(keep_outcomes):
+                    if not keep: outcome_views[outcome].clear()
+            else:
+                # outcomes interleaved, records gathered using numpy
+                chunk_data = np.frombuffer(view, dtype=np.uint8)
+                byte_outcomes = np.repeat(outcomes, np.diff(record_starts))
+                for outcome, keep in enumerate(keep_outcomes):
+                    if keep and outcome_counts[outcome]:
+                        outcome_views[outcome].append(memoryview(
+                            chunk_data[byte_outcomes==outcome]))
+        return ChunkResult(len(headers), n_filtered, cumul_n_mismatches,
+            tuple(outcome_views[1:]), (outcome_views[0],), log_lines,
+            decision_log_bytes, outcome_counts[1:])
+
+    filter_chunk.classify_index = classify_index
+    filter_chunk.filter_mapped_chunk = filter_mapped_chunk
+    return filter_chunk
+
+
+_worker_chunk_filter = None
+    # chunk filter of each worker process, see `_init_worker_chunk_filter()`
+
+def _init_worker_chunk_filter(chunk_filter_args, chunk_filter_kwargs):
+    global _worker_chunk_filter
+    _worker_chunk_filter = make_chunk_filter(*chunk_filter_args, **chunk_filter_kwargs)
+
+def _worker_filter_chunk(chunks):
+    return _worker_chunk_filter(chunks)
+
+
+def imap_ordered(function, items, workers, initializer=None, initargs=()):
+    """
+    Like `map()` but calling `function` in a pool of `workers` processes,
+    yielding results in the same order as `items`. At most `2*workers` items
+    are in progress at once, so results waiting to be yielded in order (and
+    items read ahead) are bounded.
+    """
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=initializer,
+                                                initargs=initargs) as executor:
+        pending = collections.deque()
+        for item in items:
+            if len(pending)>=2*workers:
+                yield pending.popleft().result()
+            pending.append(executor.submit(function, item))
+        while pending:
+            yield pending.popleft().result()
+
+
+def is_stream(path):
+    """
+    Whether `path` is standard input or output ('-'), or an existing file
+    that can only be read or written sequentially, such as a named pipe.
+    """
+    if path==_STDIO_PATH: return True
+    try:
+        return not stat.S_ISREG(os.stat(path).st_mode)
+    except OSError:
+        return False # not yet created, so a regular file
+
+
+def read_ahead(items, depth=_STREAM_QUEUE_DEPTH):
+    """
+    Yields the items of iterable `items`, taken from it in a background thread
+    up to `depth` items ahead, so that reading a stream such as standard input
+    overlaps with processing. An exception raised by `items` is raised again
+    where it is reached.
+    """
+    pending = queue.Queue(depth)
+    stopped = threading.Event()
+    def put(entry):
+        # waits for room in the queue, unless no more items are wanted
+        while not stopped.is_set():
+            try:
+                pending.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)): return
+        except Exception as exception:
+            put((None, exception))
+        else:
+            put((None, StopIteration()))
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, exception = pending.get()
+            if isinstance(exception, StopIteration): return
+            if exception is not None: raise exception
+            yield item
+    finally:
+        stopped.set() # thread left to end once its current item is read
+
+
+def compression_format(path):
+    """
+    Compression format of a file as given by its extension (as used by `xopen`),
+    or None if uncompressed.
+    """
+    for extension in ('.gz', '.bz2', '.xz', '.zst'):
+        if path.endswith(extension):
+            return extension[1:]
+    return None
+
+
+def _is_gzip_header(data, offset=0):
+    # whether a plausible gzip member header starts at offset of data: magic,
+    # deflate method, no reserved flags set
+    return (data[offset:offset+3]==_GZIP_MAGIC and len(data)>=offset+10
+            and not data[offset+3]&0xe0)
+
+
+def _bgzf_block_size(data, offset=0):
+    # size of the BGZF block starting at offset of data, from the BC subfield
+    # of its header, or None if no (complete) BGZF header there
+    header = data[offset:offset+18]
+    if len(header)<18 or header[:4]!=b'\x1f\x8b\x08\x04' or \
+       header[12:16]!=b'BC\x02\x00':
+        return None
+    return int.from_bytes(header[16:18], 'little')+1
+
+
+def splittable_gzip_format(path):
+    """
+    Returns 'bgzf' if `path` is a BGZF file (as written by `bgzip`),
+    'multi-member' if a gzip file of several members (e.g. concatenated gzip
+    files) with the first member ending within `_GZIP_PROBE_SIZE` bytes, and
+    otherwise None; only such files can be split for decompression in
+    parallel.
+    """
+    with open(path, 'rb') as input_handle:
+        head = input_handle.read(_GZIP_PROBE_SIZE)
+    if _bgzf_block_size(head):
+        return 'bgzf'
+    if not _is_gzip_header(head):
+        return None
+    decompressor = zlib.decompressobj(31)
+    try:
+        for start in range(0, len(head), _GZIP_PROBE_BLOCK_SIZE):
+            data = head[start:start+_GZIP_PROBE_BLOCK_SIZE]
+            decompressor.decompress(data)
+            if decompressor.eof:
+                member_end = start+len(data)-len(decompressor.unused_data)
+                return 'multi-member' if _is_gzip_header(head, member_end) else None
+    except zlib.error:
+        pass # left for the usual reader to report
+    return None
+
+
+def _decompress_members(data):
+    # decompresses the gzip members making up all of data, or returns None if
+    # data does not start with a member or ends part way through one
+    try:
+        return igzip.decompress(data)
+    except (EOFError, OSError, zlib.error):
+        return None
+
+
+def _decompress_members_sequential(pieces):
+    # yields blocks decompressed from a stream of gzip members given as an
+    # iterable of pieces of bytes
+    decompressor = zlib.decompressobj(31)
+    started = False
+    for data in pieces:
+        while data:
+            started = True
+            block = decompressor.decompress(data)
+            if block: yield block
+            if not decompressor.eof: break
+            data = decompressor.unused_data
+            decompressor = zlib.decompressobj(31)
+            started = False
+    if started:
+        raise EOFError("Compressed file ended before the end-of-stream marker "
+                       "was reached")
+
+
+class ParallelGzipReader(io.RawIOBase):
+    """
+    Binary file object reading a BGZF or multi-member gzip file `path`
+    (of `gzip_format` as returned by `splittable_gzip_format()`), with
+    segments of about `segment_size` compressed bytes, split at member
+    boundaries, decompressed independently in `threads` threads and joined
+    in order. Records split across segments are joined again when read in
+    chunks. Boundaries in multi-member files are found by searching for
+    gzip headers, so each is checked by the previous segment ending exactly
+    at the end of a member; from the first segment that doesn't (or if no
+    boundary can be found), the rest of the file is decompressed
+    sequentially, and `sequential_fallback` set. Reading starts from
+    `start`, a resume point as given by `resume_point()`.
+    """
+
+    def __init__(self, path, gzip_format, threads, segment_size=_GZIP_SEGMENT_SIZE,
+                 start=(0, 0)):
+        self._input_handle = open(path, 'rb')
+        self._input_handle.seek(start[0])
+        self._gzip_format = gzip_format
+        self._threads = threads
+        self._segment_size = segment_size
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self._resume_points = collections.deque([tuple(start)])
+        self._blocks = self._iter_blocks()
+        self._block = memoryview(b'')
+        self.sequential_fallback = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not len(self._block):
+            block = next(self._blocks, None)
+            if block is None:
+                return 0
+            self._block = memoryview(block)
+        n_bytes = min(len(buffer), len(self._block))
+        buffer[:n_bytes] = self._block[:n_bytes]
+        self._block = self._block[n_bytes:]
+        return n_bytes
+
+    def close(self):
+        if not self.closed:
+            self._blocks.close()
+            self._executor.shutdown(cancel_futures=True)
+            self._input_handle.close()
+        super().close()
+
+    def resume_point(self, offset):
+        """
+        The last member boundary at or before `offset` bytes of decompressed
+        data, as `(compressed offset, decompressed offset)`, from which
+        reading can start again; boundaries before it are forgotten, so
+        offsets must not decrease between calls.
+        """
+        while len(self._resume_points)>1 and self._resume_points[1][1]<=offset:
+            self._resume_points.popleft()
+        return self._resume_points[0]
+
+    def _last_boundary(self, data):
+        # offset of the last member boundary in data (other than at its start),
+        # or 0 if none found
+        if self._gzip_format=='bgzf':
+            offset = 0
+            while True:
+                block_size = _bgzf_block_size(data, offset)
+                if block_size is None or offset+block_size>len(data):
+                    return offset
+                offset += block_size
+        end = len(data)
+        while True:
+            offset = data.rfind(_GZIP_MAGIC, 1, end)
+            if offset==-1 or _is_gzip_header(data, offset):
+                return max(offset, 0)
+            end = offset+len(_GZIP_MAGIC)-1
+
+    def _iter_segments(self):
+        # yields raw segments of the file with their offset, each starting at
+        # a member boundary if the previous one was split at a boundary
+        data = b''
+        offset = self._input_handle.tell()
+        for read_data in iter(partial(self._input_handle.read, self._segment_size), b''):
+            data += read_data
+            boundary = self._last_boundary(data)
+            if not boundary and len(data)>=_GZIP_MAX_SEGMENTS*self._segment_size:
+                # no boundary found, so decompressed sequentially from here
+                boundary = len(data)
+            if boundary:
+                yield offset, data[:boundary]
+                data = data[boundary:]
+                offset += boundary
+        if data:
+            yield offset, data
+
+    def _iter_blocks(self):
+        # yields decompressed segments in order, at most 2*threads in progress,
+        # the start of each being a resume point
+        segments = self._iter_segments()
+        pending = collections.deque()
+        decompressed_offset = self._resume_points[0][1]
+        while True:
+            for offset, segment in itertools.islice(segments, 2*self._threads-len(pending)):
+                pending.append((offset, segment, self._executor.submit(
+                    _decompress_members, segment)))
+            if not pending:
+                return
+            offset, segment, future = pending.popleft()
+            block = future.result()
+            if block is None:
+                self.sequential_fallback = True
+                for _, _, future in pending: future.cancel()
+                yield from _decompress_members_sequential(itertools.chain([segment],
+                    (segment for _, segment, _ in pending),
+                    (segment for _, segment in segments)))
+                return
+            if offset!=self._resume_points[-1][0]:
+                self._resume_points.append((offset, decompressed_offset))
+            decompressed_offset += len(block)
+            yield block
+
+
+def open_input(path, opener=xopen.xopen, threads=0, start=None):
+    """
+    Opens FASTQ file `path` for reading binary with `opener`, or, if `threads`
+    is more than 1 (or `start` is given) and it is a BGZF or multi-member
+    gzip file, as a `ParallelGzipReader` decompressing in `threads` threads
+    (at least 1) from resume point `start`. Standard input ('-') and other
+    streams are always opened with `opener`, which detects their compression
+    from their first bytes.
+    """
+    if (threads>1 or start is not None) and compression_format(path)=='gz' \
+       and not is_stream(path):
+        gzip_format = splittable_gzip_format(path)
+        if gzip_format:
+            return ParallelGzipReader(path, gzip_format, max(threads, 1),
+                                      start=start or (0, 0))
+    return opener(path, mode='rb')
+
+
+def open_input_at(path, offset, opener=xopen.xopen, threads=0, start=None):
+    """
+    Opens FASTQ file `path` as `open_input()`, positioned `offset` bytes into
+    its decompressed data: uncompressed files are seeked to `offset`, BGZF
+    and multi-member gzip files decompressed from resume point `start` (if
+    given), and other files from their start, discarding data before
+    `offset`.
+    """
+    if compression_format(path) is None:
+        input_handle = open(path, 'rb')
+        input_handle.seek(offset)
+        return input_handle
+    input_handle = open_input(path, opener, threads, start or (0, 0))
+    position = start[1] if start and isinstance(input_handle, ParallelGzipReader) else 0
+    while position<offset:
+        data = input_handle.read(min(offset-position, _CHUNK_SIZE))
+        if not data: break
+        position += len(data)
+    return input_handle
+
+
+def block_compressor(path, backend, compresslevel):
+    """
+    Function compressing a block of data for output file `path` using
+    in-process `backend` (one of `_COMPRESSION_BACKENDS`), as a gzip member
+    or zstd frame according to its extension, or None if the file is to be
+    opened with `xopen` instead (backend 'xopen', or other formats).
+    """
+    output_format = compression_format(path)
+    if backend=='xopen' or output_format not in ('gz', 'zst'):
+        return None
+    if output_format=='zst':
+        if zstd is None:
+            raise ImportError("zstd output needs the `backports.zstd` package "
+                              "(or Python 3.14)")
+        return partial(zstd.compress, level=compresslevel)
+    if backend=='isal':
+        if igzip is gzip:
+            raise ImportError("the isal backend needs the `isal` package")
+        # ISA-L has levels 0 to 3, and level 3 compresses no better than 2
+        return partial(igzip.compress, compresslevel=min(compresslevel, 2), mtime=0)
+    if backend=='zlib-ng':
+        if gzip_ng is None:
+            raise ImportError("the zlib-ng backend needs the `zlib-ng` package")
+        # zlib-ng level 1 compresses much worse than zlib level 1, level 2 is
+        # closer (as used by xopen)
+        return partial(gzip_ng.compress, compresslevel=max(compresslevel, 2), mtime=0)
+    return partial(gzip.compress, compresslevel=compresslevel, mtime=0)
+
+
+class BlockCompressingWriter:
+    """
+    Writer compressing the data written to it in blocks of about
+    `block_size` bytes with `compress` (to a gzip member or zstd frame each,
+    which together make a valid file) and writing them to binary
+    `out_handle` in order. Blocks are compressed in `executor` (if given,
+    otherwise as written), which can be shared by several writers so that
+    its threads compress whichever output has most data; at most
+    `max_pending` blocks of each writer are in progress.
+    """
+
+    def __init__(self, out_handle, compress, executor=None,
+                 block_size=_COMPRESS_BLOCK_SIZE, max_pending=4):
+        self._out_handle = out_handle
+        self._compress = compress
+        self._executor = executor
+        self._block_size = block_size
+        self._max_pending = max_pending
+        self._buffer = []
+        self._buffered = 0
+        self._pending = collections.deque()
+        self._n_blocks = 0
+
+    def _submit(self):
+        block = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._n_blocks += 1
+        if self._executor is None:
+            self._out_handle.write(self._compress(block))
+            return
+        if len(self._pending)>=self._max_pending:
+            self._out_handle.write(self._pending.popleft().result())
+        self._pending.append(self._executor.submit(self._compress, block))
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered>=self._block_size:
+            self._submit()
+        return len(data)
+
+    def writelines(self, lines):
+        for data in lines:
+            self.write(data)
+
+    def flush(self):
+        """
+        Compresses and writes all data written so far, so that the file is
+        valid up to here.
+        """
+        if self._buffered:
+            self._submit()
+        while self._pending:
+            self._out_handle.write(self._pending.popleft().result())
+        self._out_handle.flush()
+
+    def close(self):
+        if self._out_handle.closed:
+            return
+        try:
+            if self._buffered or not self._n_blocks:
+                self._submit() # an empty file still gets an (empty) block
+            while self._pending:
+                self._out_handle.write(self._pending.popleft().result())
+        finally:
+            self._out_handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class OutputOpener:
+    """
+    Opens output files for writing binary, compressed according to their
+    extension as for `xopen.xopen()`, at `compresslevel` or the level for
+    the path in `compresslevels`. With an in-process `backend` ('isal',
+    'zlib-ng' or 'zlib' for gzip, with zstd output also compressed
+    in-process), files are written with a `BlockCompressingWriter`, the
+    blocks of all files compressed in a shared pool of `threads` threads
+    (or as written if 0); with backend 'xopen', `threads` are passed to
+    `xopen.xopen()` for each file. Use as a context manager to shut down the
+    pool once all files are closed.
+    """
+
+    def __init__(self, backend='xopen', threads=1, compresslevel=6, compresslevels=None):
+        if backend not in _COMPRESSION_BACKENDS:
+            raise ValueError("unknown compression backend {}".format(backend))
+        self.backend = backend
+        self.threads = threads
+        self.compresslevel = compresslevel
+        self.compresslevels = compresslevels or {}
+        self._executor = None
+
+    def __call__(self, path, mode='wb'):
+        compresslevel = self.compresslevels.get(path, self.compresslevel)
+        compress = block_compressor(path, self.backend, compresslevel)
+        if compress is None:
+            return xopen.xopen(path, mode=mode, threads=self.threads,
+                               compresslevel=compresslevel)
+        if self._executor is None and self.threads:
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+        return BlockCompressingWriter(open(path, mode), compress, self._executor)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _clone_file(input_path, out_path):
+    # try to make out_path a copy-on-write clone (reflink) of input_path,
+    # which takes no time or extra space on filesystems supporting this
+    try:
+        import fcntl
+        with open(input_path, 'rb') as input_handle, open(out_path, 'wb') as out_handle:
+            fcntl.ioctl(out_handle.fileno(), _FICLONE, input_handle.fileno())
+        return True
+    except (ImportError, OSError):
+        return False
+
+
+def copy_record_runs(input_handle, runs, out_handles, data_size, block_size=_CHUNK_SIZE):
+    """
+    Copies runs of consecutive records from binary `input_handle` to
+    `out_handles`, a handle (or None to discard) for each outcome, given
+    `runs` as `(end offset, outcome)` tuples in input order (as from
+    `SidecarIndex.record_runs()`). Runs that are discarded are
+    seeked past if the handle is seekable. A final record ending past
+    `data_size` lacks a newline, so one is added. Returns the number of bytes
+    read and the number written to each output.
+    """
+    seekable = input_handle.seekable()
+    block = memoryview(b'')
+    block_start = 0 # offset of block in input
+    position = 0 # offset of next byte of input to copy
+    n_read = 0
+    n_written = [0 for out_handle in out_handles]
+    parts = [[] for out_handle in out_handles]
+    def write_parts():
+        for outcome, out_parts in enumerate(parts):
+            if out_parts:
+                data = b''.join(out_parts)
+                out_handles[outcome].write(data)
+                n_written[outcome] += len(data)
+                out_parts.clear()
+    for end, outcome in runs:
+        keep = out_handles[outcome] is not None
+        if not keep and seekable and end>block_start+len(block):
+            # discarded records past those read are skipped
+            input_handle.seek(min(end, data_size))
+            block = memoryview(b'')
+            block_start = position = end
+            continue
+        while position<end:
+            if position>=block_start+len(block):
+                write_parts()
+                block_start += len(block)
+                block = memoryview(input_handle.read(block_size))
+                n_read += len(block)
+                if not block:
+                    if position!=data_size or end!=data_size+1:
+                        raise dnaio.FileFormatError("input file ended before the "
+                            "end of a record in sidecar index", line=None)
+                    if keep: parts[outcome].append(b'\n') # final record lacking newline
+                    break
+            piece_end = min(end, block_start+len(block))
+            if keep:
+                parts[outcome].append(block[position-block_start:piece_end-block_start])
+            position = piece_end
+    write_parts()
+    return n_read, n_written
+
+
+def is_same_file(path, other_path):
+    """
+    Whether `path` and `other_path` are the same existing file (not a
+    stream), e.g. an output file that would overwrite an input file.
+    """
+    if is_stream(path) or is_stream(other_path):
+        return False
+    try:
+        return os.path.samefile(path, other_path)
+    except OSError:
+        return False
+
+
+def passthrough_copy(input_path, out_path, opener, verbose=0, block_size=_CHUNK_SIZE,
+                     decompress_threads=0, output_opener=None, log=print, n_reads=None):
+    """
+    Copies all reads in `input_path` to `out_path` (if any) for passthrough
+    mode without parsing records, returning the number of reads. If both
+    have the same compression the file is cloned or copied as is, and reads
+    counted from the number of lines, which still needs a pass decompressing
+    all of a compressed input unless the number of reads is given as
+    `n_reads` (e.g. from a `SidecarIndex`); otherwise the input is
+    decompressed and recompressed in large blocks. The input is opened with
+    `open_input()`, using `decompress_threads`, and the output with
+    `output_opener` (if given, otherwise `opener`). With `verbose`, how the
+    input is copied is passed to `log`. Standard input or output, or other
+    streams, are always copied in blocks. Raises ValueError if `out_path` is
+    `input_path`.
+    """
+    if out_path and is_same_file(input_path, out_path):
+        raise ValueError("output file {} is the input file".format(out_path))
+    if out_path and compression_format(input_path)==compression_format(out_path) \
+       and not is_stream(input_path) and not is_stream(out_path):
+        if _clone_file(input_path, out_path):
+            if verbose>=1: log("Passthrough by cloning input file")
+        else:
+            if verbose>=1: log("Passthrough by copying input file")
+            shutil.copyfile(input_path, out_path)
+        if n_reads is not None:
+            return n_reads
+        out_path = None
+    elif out_path and verbose>=1:
+        log("Passthrough by recompressing input file")
+    n_lines = 0
+    last_block = b''
+    with contextlib.ExitStack() as stack:
+        input_handle = stack.enter_context(open_input(input_path, opener,
+                                                      decompress_threads))
+        out_handle = stack.enter_context((output_opener or opener)(out_path,
+            mode='wb')) if out_path else None
+        blocks = iter(partial(input_handle.read, block_size), b'')
+        if is_stream(input_path) or (out_path and is_stream(out_path)):
+            blocks = read_ahead(blocks)
+        for block in blocks:
+            n_lines += block.count(b'\n')
+            if out_handle: out_handle.write(block)
+            last_block = block
+    if not last_block.endswith(b'\n') and last_block:
+        n_lines += 1 # final line lacking newline
+    if n_lines%4:
+        raise dnaio.FastqFormatError("records in FASTQ file must have four lines",
+                                     line=None)
+    return n_lines//4
+
+
+def print_cache_info(description, cached_function, log=print):
+    cache_info = cached_function.cache_info()
+    log("{}: {} hits, {} misses, {} of max {} indexes cached".format(
+        description, cache_info.hits, cache_info.misses,
+        cache_info.currsize, cache_info.maxsize))
+
+
+class RunStats:
+    """
+    Statistics of a run for `--stats-json`: wall and CPU time spent in each
+    stage of processing, and bytes read from each input and written to each
+    output, with seconds spent waiting for each output's writer thread.
+    Stages are entered and exited with `enter()` and `exit()`, and can
+    be nested, with time charged to the innermost stage; CPU time is that of
+    the main thread. Progress is shown on stderr every `progress_interval`
+    seconds (if not 0) when `progress()` is called.
+    """
+
+    def __init__(self, progress_interval=0):
+        self.progress_interval = progress_interval
+        self.start_wall = self.last_wall = time.perf_counter()
+        self.start_times = os.times()
+        self.last_cpu = time.thread_time()
+        self.next_progress = self.start_wall + progress_interval
+        self.stage_wall = collections.defaultdict(float)
+        self.stage_cpu = collections.defaultdict(float)
+        self.stages = ['other']
+        self.input_bytes = collections.Counter()
+        self.output_bytes = collections.Counter()
+        self.output_stall = collections.Counter()
+
+    def _charge(self):
+        # charge time since last change of stage to current stage
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        self.stage_wall[self.stages[-1]] += wall-self.last_wall
+        self.stage_cpu[self.stages[-1]] += cpu-self.last_cpu
+        self.last_wall = wall
+        self.last_cpu = cpu
+
+    def enter(self, stage):
+        self._charge()
+        self.stages.append(stage)
+
+    def exit(self):
+        self._charge()
+        self.stages.pop()
+
+    def timed(self, stage, iterable):
+        """
+        Yields items of `iterable`, with time taken getting each one charged
+        to `stage`.
+        """
+        iterator = iter(iterable)
+        while True:
+            self.enter(stage)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.exit()
+            yield item
+
+    def timed_function(self, stage, function):
+        """
+        Returns `function` with time taken by each call charged to `stage`.
+        """
+        def timed_function(*args):
+            self.enter(stage)
+            try:
+                return function(*args)
+            finally:
+                self.exit()
+        return timed_function
+
+    def progress(self, n_reads):
+        """
+        Shows progress on stderr if `progress_interval` has passed since it was
+        last shown.
+        """
+        if not self.progress_interval: return
+        now = time.perf_counter()
+        if now<self.next_progress: return
+        self.next_progress = now + self.progress_interval
+        elapsed = now - self.start_wall
+        print("Processed {} reads in {:.1f} s ({:.0f} reads/s, {:.1f} MB/s)".format(
+            n_reads, elapsed, n_reads/elapsed,
+            sum(self.input_bytes.values())/1e6/elapsed), file=sys.stderr)
+
+    def report(self, result, input_paths, output_paths=()):
+        """
+        Statistics as a dict, with the counts from `FilterResult` `result`;
+        bytes are given for each of `input_paths` and `output_paths`, as
+        uncompressed bytes (if known) and bytes of the file.
+        """
+        self._charge()
+        wall = time.perf_counter() - self.start_wall
+        times = os.times()
+        def file_stats(path, n_bytes, stall_time=None):
+            stats = {"path": path, "bytes": n_bytes,
+                     "file_bytes": os.path.getsize(path) if os.path.isfile(path) else None}
+            if stall_time is not None: stats["stall_s"] = round(stall_time, 3)
+            return stats
+        return {
+            "version": _PROGRAM_VERSION,
+            "wall_s": round(wall, 3),
+            "cpu_s": round(times.user+times.system
+                           -self.start_times.user-self.start_times.system, 3),
+            "children_cpu_s": round(times.children_user+times.children_system
+                -self.start_times.children_user-self.start_times.children_system, 3),
+            "reads_per_s": round(result.total/wall) if wall else None,
+            "mb_per_s": round(sum(self.input_bytes.values())/1e6/wall, 2)
+                        if wall and self.input_bytes else None,
+            "stages": {stage: {"wall_s": round(self.stage_wall[stage], 3),
+                               "cpu_s": round(self.stage_cpu[stage], 3)}
+                       for stage in self.stage_wall},
+            "inputs": [file_stats(path, self.input_bytes.get(file_number))
+                       for file_number, path in enumerate(input_paths)],
+            "outputs": [file_stats(path, self.output_bytes.get(path),
+                                   self.output_stall.get(path))
+                        for path in output_paths],
+            "results": result.as_dict(),
+        }
+
+
+class FilterResult:
+    """
+    Counts of reads from an `IndexFilter`: `total`, `filtered` and
+    `unfiltered` reads, and `mismatches`, the number of reads with each number
+    of mismatches from 0 to `max_tracked_mismatches`, then for reads with more
+    mismatches. Mismatches are not counted in passthrough mode. With several
+    `thresholds` (increasing numbers of mismatches), `tiers` are the numbers
+    of filtered reads within each threshold but not the one before.
+    """
+
+    def __init__(self, max_tracked_mismatches, passthrough_mode=False, thresholds=None):
+        self.max_tracked_mismatches = max_tracked_mismatches
+        self.passthrough_mode = passthrough_mode
+        self.thresholds = thresholds if thresholds and len(thresholds)>1 else None
+        self.tiers = [0 for threshold in self.thresholds or []]
+        self.total = 0
+        self.filtered = 0
+        self.unfiltered = 0
+        self.mismatches = [0 for i in range(max_tracked_mismatches + 2)]
+        # array for tracking number of mismatches (0 to indexlen,>indexlen+1)
+        # >indexlen+1 is required because we define mismatch to include extra
+        # characters from desired index OR read index, which may be longer
+
+    def add(self, n_mismatches, filtered, count=1):
+        """
+        Adds `count` reads with `n_mismatches` that were (or were not) filtered.
+        """
+        self.total += count
+        if filtered:
+            self.filtered += count
+            if self.thresholds:
+                self.tiers[bisect.bisect_left(self.thresholds, n_mismatches)] += count
+        else:
+            self.unfiltered += count
+        if not self.passthrough_mode:
+            self.mismatches[min(n_mismatches, self.max_tracked_mismatches+1)] += count
+
+    def add_chunk(self, chunk_result):
+        """
+        Adds the counts from a `ChunkResult`.
+        """
+        self.total += chunk_result.n_reads
+        self.filtered += chunk_result.n_filtered
+        self.unfiltered += chunk_result.n_reads-chunk_result.n_filtered
+        for n_mismatches, count in enumerate(chunk_result.cumul_n_mismatches):
+            self.mismatches[n_mismatches] += count
+        if self.thresholds:
+            for tier, count in enumerate(chunk_result.tier_counts):
+                self.tiers[tier] += count
+
+    def add_counts(self, counts):
+        """
+        Adds the counts from a dict as given by `as_dict()` (or read back
+        from JSON), e.g. of reads filtered before resuming from a checkpoint.
+        """
+        self.total += counts["total"]
+        self.filtered += counts["filtered"]
+        self.unfiltered += counts["unfiltered"]
+        for n_mismatches, count in enumerate(counts["mismatches"].values()):
+            self.mismatches[n_mismatches] += count
+        for tier, tier_counts in enumerate(counts.get("thresholds", {}).values()):
+            self.tiers[tier] += tier_counts["tier"]
+
+    def threshold_counts(self):
+        """
+        `(threshold, tier reads, filtered reads)` for each threshold, the
+        filtered reads being those within the threshold (as if filtered with
+        that maximum number of mismatches), or an empty list without several
+        thresholds.
+        """
+        return list(zip(self.thresholds or [], self.tiers,
+                        itertools.accumulate(self.tiers)))
+
+    def as_dict(self):
+        """
+        Counts as a dict, as returned by `main()` with `return_result`.
+        """
+        counts = {
+            "total" : self.total,
+            "filtered": self.filtered,
+            "unfiltered": self.unfiltered,
+            "mismatches": {n_mismatches : cumul_mismatches
+                           for n_mismatches,cumul_mismatches in enumerate(self.mismatches)}
+        }
+        if self.thresholds:
+            counts["thresholds"] = {threshold: {"tier": tier, "filtered": filtered}
+                for threshold, tier, filtered in self.threshold_counts()}
+        return counts
+
+    def __repr__(self):
+        return "FilterResult(total={}, filtered={}, unfiltered={})".format(
+            self.total, self.filtered, self.unfiltered)
+
+
+class FilterEstimate:
+    """
+    Estimates from an `IndexFilter` of the fraction of reads filtered and
+    with each number of mismatches, from the reads of a sample, with
+    confidence intervals at `confidence`. `result` has the counts of the
+    sample, as a `FilterResult`. Reads are sampled a chunk at a time, and
+    reads in the same chunk are more alike than random reads (e.g. from the
+    same tile), so intervals are from the variance between chunks, as for a
+    ratio estimator in cluster sampling; the Wilson score interval is used
+    with a single chunk, or if no (or all) sampled reads are in a bin.
+    """
+
+    def __init__(self, max_tracked_mismatches, passthrough_mode=False, confidence=0.95):
+        self.result = FilterResult(max_tracked_mismatches, passthrough_mode)
+        self.confidence = confidence
+        self.n_chunks = 0
+        # sums over chunks of squared reads, and, for filtered reads and
+        # reads with each number of mismatches, squared counts and counts
+        # multiplied by reads, for the variance between chunks
+        self._sum_reads_squared = 0
+        self._sum_counts_squared = [0 for i in range(max_tracked_mismatches + 3)]
+        self._sum_counts_reads = [0 for i in range(max_tracked_mismatches + 3)]
+
+    def add_chunk(self, chunk_result):
+        """
+        Adds the counts of a sampled `ChunkResult`.
+        """
+        self.result.add_chunk(chunk_result)
+        self.n_chunks += 1
+        n_reads = chunk_result.n_reads
+        self._sum_reads_squared += n_reads*n_reads
+        for bin_number, count in enumerate([chunk_result.n_filtered]
+                                           +list(chunk_result.cumul_n_mismatches)):
+            self._sum_counts_squared[bin_number] += count*count
+            self._sum_counts_reads[bin_number] += count*n_reads
+
+    def _estimate(self, bin_number, count):
+        # (fraction, lower bound, upper bound) of reads in bin
+        n_reads = self.result.total
+        if not n_reads:
+            return (float('NaN'),)*3
+        fraction = count/n_reads
+        z = statistics.NormalDist().inv_cdf(0.5+self.confidence/2)
+        if self.n_chunks<2 or count in (0, n_reads):
+            # Wilson score interval, also if there is no variance between
+            # chunks as no (or all) reads are in the bin
+            centre = (fraction + z*z/(2*n_reads))/(1 + z*z/n_reads)
+            half_width = z/(1 + z*z/n_reads)*math.sqrt(
+                fraction*(1-fraction)/n_reads + z*z/(4*n_reads*n_reads))
+        else:
+            # sum over chunks of (count - fraction*reads)^2
+            sum_squares = (self._sum_counts_squared[bin_number]
+                           - 2*fraction*self._sum_counts_reads[bin_number]
+                           + fraction*fraction*self._sum_reads_squared)
+            variance = self.n_chunks/(self.n_chunks-1)*max(sum_squares, 0)/(n_reads*n_reads)
+            centre = fraction
+            half_width = z*math.sqrt(variance)
+        return fraction, max(centre-half_width, 0.0), min(centre+half_width, 1.0)
+
+    @property
+    def filtered(self):
+        """
+        (fraction, lower bound, upper bound) of reads filtered.
+        """
+        return self._estimate(0, self.result.filtered)
+
+    @property
+    def mismatches(self):
+        """
+        List of (fraction, lower bound, upper bound) of reads with each
+        number of mismatches, as for `FilterResult.mismatches`.
+        """
+        return [self._estimate(n_mismatches+1, count)
+                for n_mismatches, count in enumerate(self.result.mismatches)]
+
+    def as_dict(self):
+        """
+        Estimates as a dict, as returned by `main()` with `return_result`.
+        """
+        def estimate_dict(estimate):
+            fraction, lower, upper = estimate
+            return {"fraction": fraction, "lower": lower, "upper": upper}
+        return {
+            "sampled": self.result.as_dict(),
+            "chunks": self.n_chunks,
+            "confidence": self.confidence,
+            "filtered": estimate_dict(self.filtered),
+            "mismatches": {n_mismatches: estimate_dict(estimate)
+                           for n_mismatches, estimate in enumerate(self.mismatches)}
+        }
+
+    def __repr__(self):
+        return "FilterEstimate(sampled={}, filtered={:.4f})".format(
+            self.result.total, self.filtered[0])
+
+
+class SidecarIndex:
+    """
+    Index of the records of a FASTQ file, kept in a sidecar file at `path` so
+    that the file can be filtered again with other parameters without being
+    parsed. `barcodes` are the distinct indexes in read headers (bytes, in
+    order of first appearance) and `barcode_counts` the number of records
+    with each. The number in `barcodes` of the index of each record and its
+    length in bytes are kept in the file in compressed blocks, one for each
+    chunk of input, and only read a block at a time (see `blocks()`), so that
+    memory use doesn't grow with the number of records. `n_records` is the
+    number of records and `data_size` the number of bytes of (uncompressed)
+    data, and `input_size` and `input_mtime_ns` are the size and
+    modification time of the file when it was indexed, to tell whether the
+    index is stale.
+    """
+
+    def __init__(self, path, barcodes, barcode_counts, n_records, data_size,
+                 input_size, input_mtime_ns, byteorder=sys.byteorder):
+        self.path = path
+        self.barcodes = barcodes
+        self.barcode_counts = barcode_counts
+        self.n_records = n_records
+        self.data_size = data_size
+        self.input_size = input_size
+        self.input_mtime_ns = input_mtime_ns
+        self.byteorder = byteorder
+
+    @classmethod
+    def build(cls, input_path, path, opener=xopen.xopen, decompress_threads=0,
+              chunk_size=_CHUNK_SIZE):
+        """
+        Indexes FASTQ file `input_path`, opened with `open_input()` using
+        `opener` and `decompress_threads`, writing the index to `path`: a
+        block for each chunk of about `chunk_size` bytes of input, with the
+        number of records and size of the block then the arrays of the block
+        compressed with zlib, followed by a line of JSON with the barcodes and
+        details of the input file and the offset of that line. Written to a
+        temporary file first, so that an index is never partly written.
+        Raises ValueError if a read has no barcode.
+        """
+        input_stat = os.stat(input_path)
+        barcode_numbers = {}
+        barcode_counts = collections.Counter()
+        n_records = 0
+        data_size = 0
+        temp_path = path + '.tmp'
+        with open_input(input_path, opener, decompress_threads) as input_handle, \
+             open(temp_path, 'wb') as handle:
+            for chunk in dnaio.read_chunks(input_handle, chunk_size):
+                chunk = bytes(chunk)
+                data_size += len(chunk)
+                if not chunk.endswith(b'\n'):
+                    chunk += b'\n' # final record lacking newline
+                lines = split_chunk(chunk)
+                header_parts = list(map(bytes.rpartition, lines[0::4],
+                                        itertools.repeat(b':')))
+                if not all(map(operator.itemgetter(1), header_parts)):
+                    seqid = next(header for header in lines[0::4] if b':' not in header)[1:]
+                    raise ValueError("no barcode detected for sequence {}".format(
+                        seqid.decode('latin-1')))
+                barcode_ids = array.array('I', [
+                    barcode_numbers.setdefault(barcode, len(barcode_numbers))
+                    for _, _, barcode in header_parts])
+                barcode_counts.update(barcode_ids)
+                line_lengths = list(map(len, lines))
+                record_lengths = array.array('I', map(operator.add, map(sum,
+                    zip(*[iter(line_lengths)]*4)), itertools.repeat(4)))
+                n_records += len(barcode_ids)
+                block = zlib.compress(barcode_ids.tobytes()+record_lengths.tobytes(), 1)
+                handle.write(len(barcode_ids).to_bytes(4, 'little')
+                             + len(block).to_bytes(4, 'little') + block)
+            sidecar = cls(path, list(barcode_numbers),
+                          [barcode_counts[barcode_id] for barcode_id in range(len(barcode_numbers))],
+                          n_records, data_size, input_stat.st_size, input_stat.st_mtime_ns)
+            header_offset = handle.tell()
+            header = {
+                "format": _SIDECAR_FORMAT,
+                "input_size": sidecar.input_size,
+                "input_mtime_ns": sidecar.input_mtime_ns,
+                "data_size": sidecar.data_size,
+                "records": sidecar.n_records,
+                "byteorder": sidecar.byteorder,
+                "barcodes": [barcode.decode('latin-1') for barcode in sidecar.barcodes],
+                "barcode_counts": sidecar.barcode_counts,
+            }
+            handle.write(json.dumps(header).encode('ascii') + b'\n'
+                         + header_offset.to_bytes(8, 'little'))
+        os.replace(temp_path, path)
+        return sidecar
+
+    @classmethod
+    def load(cls, path, input_path):
+        """
+        Reads the sidecar index at `path` for FASTQ file `input_path`,
+        returning None if it doesn't exist, can't be read or is stale, i.e.
+        the size or modification time of `input_path` have changed. The
+        blocks are checked to add up to the records of the index, but aren't
+        read.
+        """
+        try:
+            with open(path, 'rb') as handle:
+                file_size = handle.seek(0, os.SEEK_END)
+                handle.seek(file_size-8)
+                header_offset = int.from_bytes(handle.read(8), 'little')
+                handle.seek(header_offset)
+                header = json.loads(handle.read(file_size-8-header_offset))
+                if header["format"]!=_SIDECAR_FORMAT:
+                    return None
+                input_stat = os.stat(input_path)
+                if header["input_size"]!=input_stat.st_size or \
+                   header["input_mtime_ns"]!=input_stat.st_mtime_ns:
+                    return None
+                n_records = 0
+                position = 0
+                while position<header_offset:
+                    handle.seek(position)
+                    block_header = handle.read(8)
+                    n_records += int.from_bytes(block_header[:4], 'little')
+                    position += 8 + int.from_bytes(block_header[4:], 'little')
+                if position!=header_offset or n_records!=header["records"]:
+                    return None
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        barcodes = [barcode.encode('latin-1') for barcode in header["barcodes"]]
+        return cls(path, barcodes, header["barcode_counts"], header["records"],
+                   header["data_size"], header["input_size"], header["input_mtime_ns"],
+                   header["byteorder"])
+
+    def blocks(self):
+        """
+        Yields `(barcode_ids, record_lengths)` arrays for each block of the
+        index in turn, read from its file. Raises ValueError if a block is
+        corrupt.
+        """
+        with open(self.path, 'rb') as handle:
+            n_records = 0
+            while n_records<self.n_records:
+                block_header = handle.read(8)
+                block_records = int.from_bytes(block_header[:4], 'little')
+                try:
+                    data = zlib.decompress(handle.read(
+                        int.from_bytes(block_header[4:], 'little')))
+                except zlib.error:
+                    data = b''
+                if len(block_header)<8 or len(data)!=8*block_records:
+                    raise ValueError("sidecar index {} is corrupt".format(self.path))
+                barcode_ids = array.array('I', data[:4*block_records])
+                record_lengths = array.array('I', data[4*block_records:])
+                if self.byteorder!=sys.byteorder:
+                    barcode_ids.byteswap()
+                    record_lengths.byteswap()
+                n_records += block_records
+                yield barcode_ids, record_lengths
+
+    def record_runs(self, barcode_outcomes):
+        """
+        Yields runs of consecutive records with the same outcome, given the
+        outcome (an int) of each barcode as a list, as `(end offset, outcome)`
+        tuples, reading the index a block at a time.
+        """
+        if np is not None:
+            outcome_table = np.array(barcode_outcomes, dtype=np.intp)
+        run = None # last run of the blocks so far, which the next may extend
+        offset = 0 # of the end of the blocks so far in the input
+        for barcode_ids, record_lengths in self.blocks():
+            if not barcode_ids:
+                continue
+            if np is not None:
+                outcomes = outcome_table[np.frombuffer(barcode_ids, dtype=np.uint32)]
+                ends = np.cumsum(np.frombuffer(record_lengths, dtype=np.uint32),
+                                 dtype=np.int64) + offset
+                last_records = np.append(np.flatnonzero(outcomes[1:]!=outcomes[:-1]),
+                                         len(outcomes)-1)
+                block_runs = list(zip(ends[last_records].tolist(),
+                                      outcomes[last_records].tolist()))
+            else:
+                records = zip(itertools.islice(itertools.accumulate(record_lengths,
+                                                                    initial=offset), 1, None),
+                              map(barcode_outcomes.__getitem__, barcode_ids))
+                block_runs = [collections.deque(block_run, maxlen=1)[0] for _, block_run
+                              in itertools.groupby(records, operator.itemgetter(1))]
+            for block_run in block_runs:
+                if run is not None and block_run[1]!=run[1]:
+                    yield run
+                run = block_run
+            offset = run[0]
+        if run is not None:
+            yield run
+
+
+class Checkpoint:
+    """
+    State of a run of `IndexFilter.filter_files()` saved periodically, from
+    which the run can carry on if stopped. `run` describes the run (input
+    files with their size and modification time, indexes, numbers of
+    mismatches, distance and output files), so that a checkpoint is only
+    used for the same run. `input_offsets` are the bytes of decompressed data
+    of each input file filtered so far, with the `resume_points` of BGZF and
+    multi-member gzip files (see `ParallelGzipReader.resume_point()`) or
+    None, `counts` the counts of reads so far as from
+    `FilterResult.as_dict()`, and `output_sizes` the size of each output file
+    when it held the output of those reads, ending on a gzip member or zstd
+    frame for compressed files.
+    """
+
+    def __init__(self, run, input_offsets, resume_points, counts, output_sizes):
+        self.run = run
+        self.input_offsets = input_offsets
+        self.resume_points = resume_points
+        self.counts = counts
+        self.output_sizes = output_sizes
+
+    @staticmethod
+    def describe_run(index_filter, input_paths, output_paths):
+        """
+        Description of a run with `IndexFilter` `index_filter` of
+        `input_paths` to `output_paths`, as a dict for `run`.
+        """
+        inputs = []
+        for input_path in input_paths:
+            input_stat = os.stat(input_path)
+            inputs.append({"path": input_path, "size": input_stat.st_size,
+                           "mtime_ns": input_stat.st_mtime_ns})
+        return {"inputs": inputs, "index": index_filter.index,
+                "index2": index_filter.index2, "separator": index_filter.separator,
+                "thresholds": index_filter.thresholds,
+                "distance": index_filter.distance, "outputs": list(output_paths)}
+
+    @classmethod
+    def load(cls, path, run):
+        """
+        Reads the checkpoint at `path`, returning None if it doesn't exist.
+        Raises ValueError if it can't be read or is for a run other than
+        `run`, e.g. if the input files have changed.
+        """
+        try:
+            with open(path, 'rb') as handle:
+                state = json.load(handle)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as exception:
+            raise ValueError("cannot read checkpoint {}: {}".format(path, exception)) from None
+        if not isinstance(state, dict) or state.get("format")!=_CHECKPOINT_FORMAT:
+            raise ValueError("{} is not a checkpoint".format(path))
+        if state["run"]!=json.loads(json.dumps(run)):
+            raise ValueError("checkpoint {} is for another run, or the input files "
+                             "have changed; remove it to start again".format(path))
+        return cls(state["run"], state["input_offsets"],
+                   [tuple(point) if point else None for point in state["resume_points"]],
+                   state["counts"], state["output_sizes"])
+
+    def save(self, path):
+        """
+        Writes the checkpoint to `path` as JSON, via a temporary file synced
+        to disk, so that a checkpoint is never partly written.
+        """
+        state = {
+            "format": _CHECKPOINT_FORMAT,
+            "version": _PROGRAM_VERSION,
+            "run": self.run,
+            "input_offsets": self.input_offsets,
+            "resume_points": self.resume_points,
+            "counts": self.counts,
+            "output_sizes": self.output_sizes,
+        }
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as handle:
+            json.dump(state, handle, indent=1)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temp_path, path)
+
+    def truncate_outputs(self):
+        """
+        Truncates each output file to its size at the checkpoint, dropping
+        output written after it. Raises ValueError if a file is missing or
+        shorter.
+        """
+        for out_path, size in self.output_sizes.items():
+            if not os.path.isfile(out_path) or os.path.getsize(out_path)<size:
+                raise ValueError("output file {} is missing or shorter than at "
+                                 "the checkpoint".format(out_path))
+            os.truncate(out_path, size)
+
+
+class IndexFilter:
+    """
+    Filter for reads by the index in their sequence identifier, as used by the
+    command line program, which can be configured once and then used for any
+    number of reads or files.
+
+    `index` is the sequence index to filter for, or the index before
+    `separator` if `index2` (the index after the separator) is also given;
+    either index can be '' for passthrough of that index, with passthrough
+    mode (all reads filtered) if both are ''. Reads are filtered if the total
+    number of mismatches is no more than `max_mismatches`. `max_mismatches`
+    can also be a list of thresholds, reads then being filtered by the
+    largest, and filtered reads split into tiers by the smallest threshold
+    they are within (see `filter_files()`). Mismatches are counted as for
+    `count_mismatches()`, or with `distance` of 'levenshtein' as edits (see
+    `edit_distance()`), so that an index with a base inserted or deleted has
+    one mismatch rather than one for each base after it. Matching results
+    are cached for up to `cache_size` distinct indexes, and the cache is
+    shared by all uses of the filter. Raises ValueError for invalid
+    combinations of arguments, or indexes with characters other than A, C, G,
+    T and IUPAC codes (see `check_index()`).
+
+    Reads can be classified one at a time with `classify()`, records from any
+    iterable (such as `dnaio.open()`) filtered with `filter_stream()`, or
+    FASTQ files filtered with `filter_files()`, which copies records to the
+    output files without parsing them.
+    """
+
+    def __init__(self, index, index2=None, separator=None, max_mismatches=0,
+                 cache_size=65536, distance='hamming'):
+        if (separator and index2 is None) or (separator is None and index2):
+            raise ValueError("both separator and index2 must be provided")
+        if distance not in _DISTANCES:
+            raise ValueError("unknown distance {}".format(distance))
+        check_index(index)
+        if index2: check_index(index2)
+        self.double_index = bool(separator) and index2 is not None
+        self.index = index
+        self.index2 = index2 if self.double_index else None
+        self.separator = separator
+        self.passthrough1 = index == ''
+        self.passthrough2 = not self.index2
+        self.passthrough_mode = self.passthrough1 and self.passthrough2
+        self.thresholds = sorted(set(max_mismatches)) \
+            if isinstance(max_mismatches, (list, tuple)) else [max_mismatches]
+        if not self.thresholds:
+            raise ValueError("at least one number of mismatches must be given")
+        max_mismatches = self.thresholds[-1]
+        if self.passthrough_mode:
+            if max_mismatches!=0 or len(self.thresholds)>1:
+                raise ValueError("changing number of tolerated mismatches "
+                                "incompatible with passthrough mode")
+            max_mismatches = float('NaN')
+        self.max_mismatches = max_mismatches
+        self.cache_size = cache_size
+        self.distance = distance
+        self.max_tracked_mismatches = max(len(index), len(self.index2 or ''))
+        self._classify_index = None if self.passthrough_mode else make_index_classifier(
+            index, self.index2, separator, max_mismatches, cache_size, distance)
+
+    def new_result(self):
+        """
+        Returns an empty `FilterResult` for this filter.
+        """
+        return FilterResult(self.max_tracked_mismatches, self.passthrough_mode,
+                            self.thresholds)
+
+    def tier_paths(self, paths):
+        """
+        Paths of the filtered output files given filtered output `paths` (one
+        for each input file), which are unchanged with a single threshold.
+        With several, `{mismatches}` in each path is replaced by each
+        threshold in turn, giving the files of each tier for each input file
+        in turn. Raises ValueError if a path lacks `{mismatches}`.
+        """
+        if len(self.thresholds)==1: return paths
+        if not all('{mismatches}' in path for path in paths):
+            raise ValueError("filtered output files must contain `{mismatches}` "
+                             "with several numbers of mismatches")
+        return [path.replace('{mismatches}', str(threshold))
+                for threshold in self.thresholds for path in paths]
+
+    def classify(self, name):
+        """
+        Classifies a read by the index in its sequence identifier `name` (str
+        or bytes, with or without the leading `@`), giving
+        `(n_mismatches1, n_mismatches2, filtered)`. Raises ValueError if no
+        barcode (or separator, for two indexes) is found in `name`.
+        """
+        if self.passthrough_mode: return 0, 0, True
+        colon = b':' if isinstance(name, bytes) else ':'
+        _, found_colon, entry_seq_index = name.rpartition(colon)
+        if not found_colon:
+            raise ValueError("no barcode detected for sequence {}".format(name))
+        try:
+            return self._classify_index(entry_seq_index)
+        except ValueError:
+            raise ValueError("no separator detected for sequence {}".format(name)) from None
+
+    def filter_stream(self, records, result=None):
+        """
+        Filters `records` with a `name` attribute (such as
+        `dnaio.SequenceRecord`), yielding `(record, filtered)` for each. Counts
+        are added to `result` (a new `FilterResult` if None), which is also
+        returned by the generator when finished.
+        """
+        if result is None: result = self.new_result()
+        for record in records:
+            n_mismatches1, n_mismatches2, filtered = self.classify(record.name)
+            result.add(n_mismatches1+n_mismatches2, filtered)
+            yield record, filtered
+        return result
+
+    def filter_files(self, input_paths, filtered_paths=None, unfiltered_paths=None,
+                     opener=xopen.xopen, workers=0, verbose=0, log=print, stats=None,
+                     decision_log_path=None, decompress_threads=0,
+                     output_opener=None, sidecar_path=None, checkpoint_path=None,
+                     checkpoint_interval=60):
+        """
+        Filters reads from FASTQ file(s) `input_paths` to `filtered_paths`
+        and/or `unfiltered_paths`, with one output of each (if any) per input
+        file, returning a `FilterResult`. Several input files are filtered in
+        lockstep by the index in the first file. Files are opened with
+        `opener` (as for `xopen.xopen()`), and chunks of records are filtered
+        in `workers` processes if not 0. With `verbose` of 2 or more, the
+        classification of each read is passed to `log`. Time spent reading
+        (including decompression), filtering and writing (including
+        compression), and bytes read and written, are added to `stats` (a
+        `RunStats`) if given. A line for each read, with its name, indexes,
+        mismatches and whether it was filtered, is written to
+        `decision_log_path` (if given) as tab separated values. BGZF and
+        multi-member gzip input is decompressed in `decompress_threads`
+        threads, if more than 1. Output files are opened with `output_opener`
+        if given (e.g. an `OutputOpener`), otherwise `opener`. If
+        several thresholds of mismatches were given, filtered records go to
+        the files of the tier of the smallest threshold they are within, as
+        given by `tier_paths()`. If
+        `sidecar_path` is given, a single input file is filtered with the
+        `SidecarIndex` kept there (built first if missing or stale), copying
+        records without parsing them; this can't be used with a decision log
+        or `verbose` of 2 or more, and is not needed in passthrough mode. If
+        `checkpoint_path` is given, a `Checkpoint` is saved there every
+        `checkpoint_interval` seconds, and removed once the run is finished;
+        if it exists when starting, the run carries on from it, the output
+        files being truncated to their size at the checkpoint. Checkpoints
+        can't be used with streams or a sidecar index.
+        """
+        if isinstance(input_paths, str): input_paths = [input_paths]
+        if isinstance(filtered_paths, str): filtered_paths = [filtered_paths]
+        if isinstance(unfiltered_paths, str): unfiltered_paths = [unfiltered_paths]
+        for out_paths in (filtered_paths, unfiltered_paths):
+            if out_paths and len(out_paths)!=len(input_paths):
+                raise ValueError("one output file needed for each input file")
+        if filtered_paths: filtered_paths = self.tier_paths(filtered_paths)
+        result = self.new_result()
+        output_opener = output_opener or opener
+        checkpoint = None
+        input_offsets = [0]*len(input_paths)
+        if checkpoint_path is not None:
+            out_paths = (filtered_paths or []) + (unfiltered_paths or []) + \
+                ([decision_log_path] if decision_log_path else [])
+            if any(map(is_stream, input_paths+out_paths)):
+                raise ValueError("checkpoint can't be used with standard input or "
+                                 "output or other streams")
+            if sidecar_path is not None:
+                raise ValueError("checkpoint can't be used with a sidecar index")
+            checkpoint_run = Checkpoint.describe_run(self, input_paths, out_paths)
+            checkpoint = Checkpoint.load(checkpoint_path, checkpoint_run)
+            if checkpoint is not None:
+                checkpoint.truncate_outputs()
+                result.add_counts(checkpoint.counts)
+                input_offsets = checkpoint.input_offsets
+                log("Resuming from checkpoint {} after {} reads".format(
+                    checkpoint_path, result.total))
+                for input_path, offset in zip(input_paths, input_offsets):
+                    input_format = compression_format(input_path)
+                    if offset and input_format is not None and \
+                       not (input_format=='gz' and splittable_gzip_format(input_path)):
+                        log("Warning: {} is decompressed again from its start up to "
+                            "the checkpoint ({} bytes), as it can't be split "
+                            "(only BGZF and multi-member gzip input can)".format(
+                            input_path, offset))
+        if self.passthrough_mode and verbose<2 and not decision_log_path and \
+           checkpoint_path is None:
+            # no records need to be examined, so input copied without parsing,
+            # with the number of reads from a sidecar index if there is one
+            if stats is not None: stats.enter('copy')
+            sidecar = SidecarIndex.load(sidecar_path, input_paths[0]) \
+                if sidecar_path is not None and len(input_paths)==1 else None
+            for file_number, input_path in enumerate(input_paths):
+                n_reads = passthrough_copy(input_path,
+                    filtered_paths[file_number] if filtered_paths else None,
+                    opener, verbose, decompress_threads=decompress_threads,
+                    output_opener=output_opener, log=log,
+                    n_reads=sidecar.n_records if sidecar else None)
+                if file_number and n_reads!=result.total:
+                    raise dnaio.FileFormatError("input files have different numbers "
+                        "of records", line=None)
+                if not file_number: result.add(0, True, n_reads)
+                if stats is not None: stats.progress(result.total)
+            for unfiltered_path in unfiltered_paths or []:
+                with output_opener(unfiltered_path, mode='wb'): pass
+            if stats is not None: stats.exit()
+            return result
+        if sidecar_path is not None:
+            if len(input_paths)>1 or decision_log_path or verbose>=2:
+                raise ValueError("sidecar index can only be used with one input "
+                                 "file, without decision log or logging each read")
+            if is_stream(input_paths[0]):
+                raise ValueError("sidecar index can't be used with standard input "
+                                 "or other streams")
+            return self._filter_with_sidecar(input_paths[0], sidecar_path,
+                filtered_paths, unfiltered_paths[0] if unfiltered_paths else None,
+                opener, verbose,
+                log, stats, decompress_threads, output_opener)
+
+        # records are handled as raw bytes a chunk at a time, and written out by
+        # copying the lines of each record unchanged, avoiding the cost of
+        # creating and re-formatting record objects
+        chunk_filter_args = (self.index, self.index2, self.separator,
+            self.max_mismatches, self.cache_size, verbose,
+            bool(filtered_paths), bool(unfiltered_paths))
+        chunk_filter_kwargs = {"decision_log": bool(decision_log_path),
+                               "thresholds": self.thresholds, "distance": self.distance}
+        with contextlib.ExitStack() as stack:
+            # a single uncompressed file is memory mapped (unless filtered by
+            # worker processes), with records written straight from the mapping
+            mapped_input = len(input_paths)==1 and not workers and \
+                can_map_input(input_paths[0])
+            if mapped_input:
+                input_handles = [stack.enter_context(map_file(input_paths[0]))]
+                if verbose>=1: log("Memory mapping {}".format(input_paths[0]))
+            elif checkpoint_path is not None:
+                # splittable gzip input read from member boundaries, so that
+                # it can be resumed without decompressing it all again
+                input_handles = [stack.enter_context(open_input_at(input_path, offset,
+                    opener, decompress_threads, start)) for input_path, offset, start in
+                    zip(input_paths, input_offsets, checkpoint.resume_points
+                        if checkpoint else [(0, 0)]*len(input_paths))]
+            else:
+                input_handles = [stack.enter_context(open_input(input_path, opener,
+                    decompress_threads)) for input_path in input_paths]
+            if verbose>=1:
+                for input_path, input_handle in zip(input_paths, input_handles):
+                    if isinstance(input_handle, ParallelGzipReader):
+                        log("Decompressing {} in {} threads".format(input_path,
+                                                                    decompress_threads))
+            out_mode = 'ab' if checkpoint else 'wb'
+            filtered_handles = [stack.enter_context(self._open_output(filtered_path,
+                output_opener, out_mode)) for filtered_path in filtered_paths or []]
+            unfiltered_handles = [stack.enter_context(self._open_output(unfiltered_path,
+                output_opener, out_mode)) for unfiltered_path in unfiltered_paths or []]
+            if decision_log_path:
+                # written (and compressed) in a separate thread as the log is
+                # about as large as the input
+                decision_log_writer = stack.enter_context(BackgroundWriter(
+                    output_opener(decision_log_path, mode=out_mode)))
+                if not checkpoint: decision_log_writer.write(_DECISION_LOG_HEADER)
+            if mapped_input:
+                chunks = iter_mapped_chunks(input_handles[0], start=input_offsets[0])
+            elif len(input_handles)==1:
+                chunks = zip(iter_chunks(input_handles[0]))
+            else:
+                # records of each file read together, mates in the same chunk
+                chunks = iter_chunks_lockstep(input_handles)
+            if any(map(is_stream, input_paths)):
+                # read (and decompressed) in a separate thread, waiting for
+                # the stream overlapping with filtering
+                chunks = read_ahead(chunks)
+            if checkpoint_path is not None:
+                chunk_sizes = collections.deque()
+                chunks = self._record_chunk_sizes(chunks, chunk_sizes)
+                next_checkpoint = time.perf_counter() + checkpoint_interval
+            if stats is not None:
+                chunks = stats.timed('read', self._count_input_bytes(chunks, stats))
+            if workers:
+                # chunks filtered by a pool of processes, results in input order
+                chunk_results = imap_ordered(_worker_filter_chunk,
+                    chunks, workers,
+                    initializer=_init_worker_chunk_filter,
+                    initargs=(chunk_filter_args, chunk_filter_kwargs))
+                if stats is not None:
+                    chunk_results = stats.timed('filter', chunk_results)
+            else:
+                filter_chunk = make_chunk_filter(*chunk_filter_args,
+                    classify_index=self._classify_index, **chunk_filter_kwargs)
+                if mapped_input: filter_chunk = filter_chunk.filter_mapped_chunk
+                if stats is not None:
+                    filter_chunk = stats.timed_function('filter', filter_chunk)
+                chunk_results = map(filter_chunk, chunks)
+            output_handles = list(zip(filtered_handles, filtered_paths or []))
+            output_handles += zip(unfiltered_handles, unfiltered_paths or [])
+            checkpoint_writers = output_handles + ([(decision_log_writer,
+                decision_log_path)] if decision_log_path else [])
+            for chunk_result in chunk_results:
+                result.add_chunk(chunk_result)
+                for log_line in chunk_result.log_lines:
+                    log(log_line)
+                if stats is not None: stats.enter('write')
+                for (out_handle, out_path), out_bytes in zip(output_handles,
+                        chunk_result.filtered[:len(filtered_handles)]
+                        +chunk_result.unfiltered[:len(unfiltered_handles)]):
+                    if isinstance(out_bytes, list):
+                        # views of memory mapped input
+                        out_handle.writelines(out_bytes)
+                        n_bytes = sum(map(len, out_bytes))
+                    else:
+                        if out_bytes: out_handle.write(out_bytes)
+                        n_bytes = len(out_bytes)
+                    if stats is not None: stats.output_bytes[out_path] += n_bytes
+                if chunk_result.decision_log:
+                    decision_log_writer.write(chunk_result.decision_log)
+                    if stats is not None:
+                        stats.output_bytes[decision_log_path] += len(chunk_result.decision_log)
+                if stats is not None:
+                    stats.exit()
+                    stats.progress(result.total)
+                if checkpoint_path is not None:
+                    input_offsets = list(map(operator.add, input_offsets,
+                                             chunk_sizes.popleft()))
+                    if time.perf_counter()>=next_checkpoint:
+                        if stats is not None: stats.enter('checkpoint')
+                        self._save_checkpoint(checkpoint_path, checkpoint_run,
+                            input_handles, input_offsets, result,
+                            checkpoint_writers, output_opener)
+                        if stats is not None: stats.exit()
+                        if verbose>=1:
+                            log("Saved checkpoint {} after {} reads".format(
+                                checkpoint_path, result.total))
+                        next_checkpoint = time.perf_counter() + checkpoint_interval
+            if verbose>=1:
+                for input_path, input_handle in zip(input_paths, input_handles):
+                    if getattr(input_handle, 'sequential_fallback', False):
+                        log("Could not split {} at gzip member boundaries, "
+                            "decompressed sequentially".format(input_path))
+            # remaining output compressed and written when files closed
+            if stats is not None: stats.enter('write')
+        if stats is not None: stats.exit()
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path) # run finished, so not resumed
+        for out_handle, out_path in output_handles:
+            if stats is not None: stats.output_stall[out_path] += out_handle.stall_time
+            if verbose>=1:
+                log("Writer for {}: up to {} of {} chunks queued, waited {} times "
+                    "for {:.3f} s".format(out_path, out_handle.max_depth,
+                    out_handle.max_pending, out_handle.n_stalls, out_handle.stall_time))
+        return result
+
+    def _filter_with_sidecar(self, input_path, sidecar_path, filtered_paths,
+                             unfiltered_path, opener, verbose, log, stats,
+                             decompress_threads, output_opener):
+        # filters input_path by its sidecar index, built first if needed: each
+        # barcode is classified once, then runs of records copied to outputs
+        # (one filtered output for each tier)
+        result = self.new_result()
+        sidecar = SidecarIndex.load(sidecar_path, input_path)
+        if sidecar is None:
+            if verbose>=1: log("Building sidecar index {}".format(sidecar_path))
+            if stats is not None: stats.enter('index')
+            sidecar = SidecarIndex.build(input_path, sidecar_path, opener,
+                                         decompress_threads)
+            if stats is not None: stats.exit()
+        elif verbose>=1:
+            log("Using sidecar index {}".format(sidecar_path))
+        if stats is not None: stats.enter('filter')
+        classifications = None
+        if len(sidecar.barcodes)>=_BATCH_MIN_INDEXES:
+            classify_indexes = make_batch_index_classifier(self.index, self.index2,
+                self.separator, self.max_mismatches, self.distance)
+            if classify_indexes is not None:
+                try:
+                    classifications = list(zip(*(classification.tolist() for
+                        classification in classify_indexes(sidecar.barcodes))))
+                except ValueError:
+                    pass # raised again for the index when classified below
+        barcode_outcomes = [] # 0 if unfiltered, otherwise number of tier from 1
+        for barcode_id, count in enumerate(sidecar.barcode_counts):
+            try:
+                n_mismatches1, n_mismatches2, filtered = \
+                    classifications[barcode_id] if classifications else \
+                    self._classify_index(sidecar.barcodes[barcode_id])
+            except ValueError:
+                raise ValueError("no separator detected for index {}".format(
+                    sidecar.barcodes[barcode_id].decode('latin-1'))) from None
+            result.add(n_mismatches1+n_mismatches2, filtered, count)
+            barcode_outcomes.append(bisect.bisect_left(self.thresholds,
+                n_mismatches1+n_mismatches2)+1 if filtered else 0)
+        if stats is not None: stats.exit()
+        out_paths = [unfiltered_path] + (filtered_paths or [None]*len(self.thresholds))
+        if any(out_paths):
+            if stats is not None: stats.enter('copy')
+            runs = sidecar.record_runs(barcode_outcomes)
+            with contextlib.ExitStack() as stack:
+                input_handle = stack.enter_context(open_input(input_path, opener,
+                                                              decompress_threads))
+                out_handles = [None if out_path is None else
+                    stack.enter_context(output_opener(out_path, mode='wb'))
+                    for out_path in out_paths]
+                n_read, n_written = copy_record_runs(input_handle, runs,
+                                                     out_handles, sidecar.data_size)
+            if stats is not None:
+                stats.input_bytes[0] += n_read
+                for out_path, n_bytes in zip(out_paths, n_written):
+                    if out_path is not None: stats.output_bytes[out_path] += n_bytes
+                stats.exit()
+        if stats is not None: stats.progress(result.total)
+        return result
+
+    def estimate_file(self, input_path, head=None, fraction=None, opener=xopen.xopen,
+                      decompress_threads=0, confidence=0.95):
+        """
+        Estimates the fractions of reads in FASTQ file `input_path` filtered
+        and with each number of mismatches from a sample of its reads,
+        returning a `FilterEstimate`, without writing any output. The sample
+        is a `fraction` of the input if given (otherwise all of it), up to the
+        first `head` reads if given. For uncompressed files, every n-th block
+        of the input is read, seeking past the others; for other files, every
+        n-th chunk of records is parsed; either way with n of
+        `round(1/fraction)`. The input is opened with `open_input()` using
+        `opener` and `decompress_threads`.
+        """
+        estimate = FilterEstimate(self.max_tracked_mismatches, self.passthrough_mode,
+                                  confidence)
+        stride = max(round(1/fraction), 1) if fraction else 1
+        filter_chunk = make_chunk_filter(self.index, self.index2, self.separator,
+            self.max_mismatches, self.cache_size, keep_filtered=False,
+            keep_unfiltered=False, classify_index=self._classify_index,
+            distance=self.distance)
+        if stride>1 and compression_format(input_path) is None \
+           and not is_stream(input_path):
+            input_handle = open(input_path, 'rb')
+            chunks = iter_stride_chunks(input_handle, stride)
+        else:
+            input_handle = open_input(input_path, opener, decompress_threads)
+            chunks = itertools.islice(iter_chunks(input_handle), 0, None, stride)
+        with input_handle:
+            for chunk in chunks:
+                if head is not None:
+                    chunk = head_records(chunk, head-estimate.result.total)
+                estimate.add_chunk(filter_chunk((chunk,)))
+                if head is not None and estimate.result.total>=head:
+                    break # rest of input not read
+        return estimate
+
+    @staticmethod
+    def _open_output(path, output_opener, mode='wb'):
+        # opens an output file written (and compressed) by a thread of its
+        # own, fed by a bounded queue of chunks, so that a slow output only
+        # holds up filtering once its queue is full; standard output and
+        # other streams are double buffered
+        return BackgroundWriter(output_opener(path, mode=mode),
+            _STREAM_QUEUE_DEPTH if is_stream(path) else _WRITE_QUEUE_DEPTH)
+
+    @staticmethod
+    def _record_chunk_sizes(chunks, chunk_sizes):
+        # appends the bytes of the chunk from each input file to chunk_sizes,
+        # as they are read, for the input offsets of checkpoints
+        for file_chunks in chunks:
+            chunk_sizes.append([len(file_chunks.view)] if isinstance(file_chunks, MappedChunk)
+                               else list(map(len, file_chunks)))
+            yield file_chunks
+
+    @staticmethod
+    def _save_checkpoint(checkpoint_path, run, input_handles, input_offsets, result,
+                         writers, output_opener):
+        # saves a checkpoint once output so far is written and synced to disk,
+        # compressed output written by xopen ending a gzip member (or zstd
+        # frame) by being closed and opened again to append
+        output_sizes = {}
+        for writer, out_path in writers:
+            writer.sync(None if compression_format(out_path) is None
+                        or isinstance(writer.out_handle, BlockCompressingWriter)
+                        else partial(output_opener, out_path, mode='ab'))
+            with open(out_path, 'rb') as out_handle:
+                os.fsync(out_handle.fileno())
+            output_sizes[out_path] = os.path.getsize(out_path)
+        resume_points = [input_handle.resume_point(offset)
+                         if isinstance(input_handle, ParallelGzipReader) else None
+                         for input_handle, offset in zip(input_handles, input_offsets)]
+        Checkpoint(run, input_offsets, resume_points, result.as_dict(),
+                   output_sizes).save(checkpoint_path)
+
+    @staticmethod
+    def _count_input_bytes(chunks, stats):
+        # counts bytes of chunks from each input file, as they are read
+        for file_chunks in chunks:
+            if isinstance(file_chunks, MappedChunk):
+                stats.input_bytes[0] += len(file_chunks.view)
+                yield file_chunks
+                continue
+            for file_number, chunk in enumerate(file_chunks):
+                stats.input_bytes[file_number] += len(chunk)
+            yield file_chunks
+
+    def cache_info(self):
+        """
+        Statistics of the classification cache, as for `functools.lru_cache`,
+        or None in passthrough mode.
+        """
+        return self._classify_index.cache_info() if self._classify_index else None
+
+
+def _index_variants(seq_index, max_mismatches):
+    # returns (variant, n_mismatches) for every substitution of up to
+    # max_mismatches positions of seq_index with another base, with any base
+    # at wildcards (e.g. N) without a mismatch, as for count_mismatches()
+    variants = [('', 0)]
+    for c in seq_index:
+        substitutions = [(base, 0 if base==c or c in _IUPAC_WILDCARDS else 1)
+                         for base in _DEMUX_ALPHABET]
+        variants = [(variant+base, n_mismatches+cost)
+                    for variant, n_mismatches in variants
+                    for base, cost in substitutions if n_mismatches+cost<=max_mismatches]
+    return variants
+
+
+def _count_index_variants(seq_index, max_mismatches):
+    # returns the number of variants from _index_variants() with each number
+    # of mismatches, without making them
+    counts = [1]+[0]*max_mismatches
+    for c in seq_index:
+        n_substitutions = 0 if c in _IUPAC_WILDCARDS else len(_DEMUX_ALPHABET)-(c in _DEMUX_ALPHABET)
+        n_same = len(_DEMUX_ALPHABET)-n_substitutions
+        counts = [counts[n_mismatches]*n_same + (counts[n_mismatches-1]*n_substitutions
+                  if n_mismatches else 0) for n_mismatches in range(max_mismatches+1)]
+    return counts
+
+
+def read_samplesheet(samplesheet_path):
+    """
+    Read sample names and indexes from a comma or tab delimited sample sheet.
+
+    Only the `[Data]` section is used if present (as in an Illumina
+    `SampleSheet.csv`). Columns are found from a header row naming `Sample_ID`
+    (or `Sample_Name` or `sample`), `index` and optionally `index2`; if there
+    is no header the columns are sample, index and optionally index2.
+    Returns a list of (sample, index, index2) tuples, with index2 None if
+    the sample sheet has no second index.
+    """
+    with open(samplesheet_path, newline='') as samplesheet_handle:
+        lines = samplesheet_handle.read().splitlines()
+    for line_number, line in enumerate(lines):
+        if line.strip().rstrip(',').lower() == '[data]':
+            lines = lines[line_number+1:]
+            break
+    rows = []
+    for line in lines:
+        if line.startswith('['): break # start of next section
+        if not line.strip() or line.startswith('#'): continue
+        delimiter = '\t' if '\t' in line else ','
+        rows.append([field.strip() for field in
+                     next(csv.reader([line], delimiter=delimiter))])
+    if not rows:
+        raise ValueError("no samples found in sample sheet {}".format(samplesheet_path))
+
+    header = [field.lower() for field in rows[0]]
+    if 'index' in header:
+        sample_columns = [header.index(name) for name in
+                          ('sample_id', 'sample_name', 'sample') if name in header]
+        if not sample_columns:
+            raise ValueError("no sample column in sample sheet {}".format(samplesheet_path))
+        sample_column = sample_columns[0]
+        index_column = header.index('index')
+        index2_column = header.index('index2') if 'index2' in header else None
+        rows = rows[1:]
+    else:
+        sample_column, index_column = 0, 1
+        index2_column = 2 if any(len(row)>2 for row in rows) else None
+
+    samples = []
+    for row in rows:
+        row = row + ['']*(max(sample_column, index_column, index2_column or 0)+1-len(row))
+        sample, seq_index = row[sample_column], row[index_column]
+        seq_index2 = row[index2_column] if index2_column is not None else None
+        if not sample or not seq_index or seq_index2=='':
+            raise ValueError("missing sample name or index in sample sheet "
+                             "row: {}".format(','.join(row)))
+        samples.append((sample, seq_index, seq_index2))
+    sample_names = [sample for sample, _, _ in samples]
+    if len(set(sample_names))!=len(sample_names):
+        raise ValueError("duplicate sample names in sample sheet {}".format(samplesheet_path))
+    return samples
+
+
+class SampleIndexTable:
+    """
+    Lookup table from the index of a read to a sample, for demultiplexing.
+
+    Every substitution variant within `max_mismatches` of each sample's
+    index (or index1, separator and index2) is precomputed, so most reads
+    need only a single dict lookup. Reads are assigned to the sample with the
+    fewest mismatches; reads with equally few mismatches to more than one
+    sample are ambiguous. Wildcards in sample indexes (e.g. N padding a
+    shorter index) match any base. Indexes not in the table (e.g. different
+    length or unusual characters) fall back to counting mismatches against
+    each sample, with the result cached for up to `cache_size` distinct
+    indexes, as do all indexes if a sample index has more than
+    `_DEMUX_MAX_WILDCARDS` wildcards, or if the samples have more than
+    `_DEMUX_MAX_VARIANTS` variants in all (e.g. many dual indexes with
+    several mismatches). Raises ValueError for sample indexes with
+    characters other than A, C, G, T and IUPAC codes (see `check_index()`).
+    """
+
+    def __init__(self, samples, max_mismatches, separator=None, cache_size=65536):
+        self.samples = samples
+        self.max_mismatches = max_mismatches
+        self.separator = separator
+        self.table = {}
+        self.complete_shapes = {}
+        for _, seq_index, seq_index2 in samples:
+            check_index(seq_index)
+            if seq_index2: check_index(seq_index2)
+        self.packed_indexes = [(pack_index(seq_index),
+                                pack_index(seq_index2) if seq_index2 is not None else None)
+                               for _, seq_index, seq_index2 in samples]
+        self.precomputed = all(sum(map((seq_index+(seq_index2 or '')).count,
+                                       _IUPAC_WILDCARDS))<=_DEMUX_MAX_WILDCARDS
+                               for _, seq_index, seq_index2 in samples) and \
+            self.count_variants(samples, max_mismatches)<=_DEMUX_MAX_VARIANTS
+        for sample_number, (_, seq_index, seq_index2) in enumerate(samples):
+            if not self.precomputed:
+                break
+            if separator:
+                variants2 = list(_index_variants(seq_index2, max_mismatches))
+                variants = ((variant1+separator+variant2, n_mismatches1+n_mismatches2)
+                            for variant1, n_mismatches1 in _index_variants(seq_index, max_mismatches)
+                            for variant2, n_mismatches2 in variants2
+                            if n_mismatches1+n_mismatches2<=max_mismatches)
+            else:
+                variants = _index_variants(seq_index, max_mismatches)
+            for variant, n_mismatches in variants:
+                match = self.table.get(variant)
+                if match is None or n_mismatches<match[1]:
+                    self.table[variant] = (sample_number, n_mismatches)
+                elif n_mismatches==match[1] and match[0]!=sample_number:
+                    self.table[variant] = (_AMBIGUOUS, n_mismatches)
+        self.match = functools.lru_cache(maxsize=cache_size)(self._match)
+
+    @staticmethod
+    def count_variants(samples, max_mismatches):
+        """
+        Number of variants of the indexes of `samples` within
+        `max_mismatches`, i.e. the size of a precomputed table at most.
+        """
+        n_variants = 0
+        for _, seq_index, seq_index2 in samples:
+            counts = _count_index_variants(seq_index, max_mismatches)
+            counts2 = _count_index_variants(seq_index2 or '', max_mismatches)
+            n_variants += sum(count*count2 for n_mismatches, count in enumerate(counts)
+                              for count2 in counts2[:max_mismatches-n_mismatches+1])
+        return n_variants
+
+    def _split(self, entry_seq_index):
+        if not self.separator:
+            return entry_seq_index, None
+        separator_pos = entry_seq_index.find(self.separator)
+        if separator_pos==-1:
+            return None, None
+        return (entry_seq_index[:separator_pos],
+                entry_seq_index[separator_pos+len(self.separator):])
+
+    def _is_complete(self, index1, index2):
+        # the table holds every match for indexes of this shape if each
+        # sample either has the same lengths or differs by too many characters
+        shape = (len(index1), len(index2) if index2 is not None else 0)
+        complete = self.complete_shapes.get(shape)
+        if complete is None:
+            complete = all(
+                (len(seq_index), len(seq_index2 or ''))==shape or
+                abs(len(seq_index)-shape[0])+abs(len(seq_index2 or '')-shape[1])>self.max_mismatches
+                for _, seq_index, seq_index2 in self.samples)
+            self.complete_shapes[shape] = complete
+        return complete and self.precomputed and \
+            not set(index1+(index2 or '')).difference(_DEMUX_ALPHABET)
+
+    def lookup(self, entry_seq_index):
+        """
+        Returns (sample number, number of mismatches) for the index of a read;
+        sample number is `_AMBIGUOUS` for ambiguous reads and both are None
+        for unassigned reads.
+        """
+        match = self.table.get(entry_seq_index)
+        if match is not None:
+            return match
+        return self.match(entry_seq_index)
+
+    def _match(self, entry_seq_index):
+        index1, index2 = self._split(entry_seq_index)
+        if index1 is None:
+            raise ValueError("no separator detected for index {}".format(entry_seq_index))
+        if self._is_complete(index1, index2):
+            return None, None
+        best_sample_number, best_n_mismatches = None, None
+        for sample_number, (packed_index, packed_index2) in enumerate(self.packed_indexes):
+            n_mismatches = count_mismatches(index1, packed_index)
+            if index2 is not None:
+                n_mismatches += count_mismatches(index2, packed_index2)
+            if n_mismatches>self.max_mismatches:
+                continue
+            if best_n_mismatches is None or n_mismatches<best_n_mismatches:
+                best_sample_number, best_n_mismatches = sample_number, n_mismatches
+            elif n_mismatches==best_n_mismatches:
+                best_sample_number = _AMBIGUOUS
+        return best_sample_number, best_n_mismatches
+
+
+def demultiplex(input_path, samples, max_tolerated_mismatches, separator,
+                out_template, out_unassigned_path, out_ambiguous_path,
+                opener, verbose, cache_size=65536, log=print):
+    """
+    Demultiplex reads in `input_path` into one output per sample in a single
+    pass; returns a summary of reads per sample and mismatches found, which
+    are also passed to `log`.
+    """
+    sample_table = SampleIndexTable(samples, max_tolerated_mismatches, separator,
+                                    cache_size)
+    if verbose>=1:
+        log("Demultiplexing lookup table entries: {}".format(len(sample_table.table)))
+
+    total_reads = 0
+    ambiguous_reads = 0
+    unassigned_reads = 0
+    sample_reads = [0 for sample in samples]
+    sample_n_mismatches = [
+        [0 for i in range(max(len(seq_index), len(seq_index2 or ''))+2)]
+        for _, seq_index, seq_index2 in samples]
+        # per sample tracking of number of mismatches, as for main()
+    lookup = sample_table.lookup
+    with contextlib.ExitStack() as stack:
+        input_fastq = stack.enter_context(dnaio.open(input_path, mode='r', opener=opener))
+        if out_template:
+            sample_fastqs = [
+                stack.enter_context(dnaio.open(out_template.format(sample=sample),
+                                               mode='w', opener=opener))
+                for sample, _, _ in samples]
+        else:
+            sample_fastqs = [None for sample in samples]
+        unassigned_fastq = stack.enter_context(dnaio.open(out_unassigned_path,
+            mode='w', opener=opener)) if out_unassigned_path else None
+        ambiguous_fastq = stack.enter_context(dnaio.open(out_ambiguous_path,
+            mode='w', opener=opener)) if out_ambiguous_path else None
+        for record in input_fastq:
+            total_reads += 1
+            seqid = record.name
+            last_colon = seqid.rfind(':')
+            if last_colon==-1:
+                raise ValueError("no barcode detected for sequence {}".format(seqid))
+            entry_seq_index = seqid[last_colon+1:]
+            sample_number, n_mismatches = lookup(entry_seq_index)
+            if sample_number is None:
+                unassigned_reads += 1
+                if unassigned_fastq: unassigned_fastq.write(record)
+            elif sample_number==_AMBIGUOUS:
+                ambiguous_reads += 1
+                if ambiguous_fastq: ambiguous_fastq.write(record)
+            else:
+                sample_reads[sample_number] += 1
+                cumul_n_mismatches = sample_n_mismatches[sample_number]
+                cumul_n_mismatches[min(n_mismatches, len(cumul_n_mismatches)-1)] += 1
+                if sample_fastqs[sample_number]: sample_fastqs[sample_number].write(record)
+            if verbose>=2:
+                log("{} -> index {} -> {}".format(seqid, entry_seq_index,
+                    'unassigned' if sample_number is None else
+                    'ambiguous' if sample_number==_AMBIGUOUS else
+                    '{} ({} mismatches)'.format(samples[sample_number][0], n_mismatches)))
+
+    log("Total reads: {}".format(total_reads))
+    log("Assigned reads: {}".format(sum(sample_reads)))
+    log("Ambiguous reads: {}".format(ambiguous_reads))
+    log("Unassigned reads: {}".format(unassigned_reads))
+    for (sample, _, _), reads, cumul_n_mismatches in zip(samples, sample_reads,
+                                                          sample_n_mismatches):
+        log("Sample {}: {}".format(sample, reads))
+        max_tracked_mismatches = len(cumul_n_mismatches)-2
+        for n_mismatches, cumul_mismatches in enumerate(cumul_n_mismatches):
+            log(" Reads with {}{} mismatches: {}".format(
+                '' if n_mismatches<= max_tracked_mismatches else '>=',
+                n_mismatches, cumul_mismatches))
+    if verbose>=1:
+        print_cache_info("Demultiplexing fallback cache", sample_table.match, log)
+
+    return {
+        "total": total_reads,
+        "assigned": sum(sample_reads),
+        "ambiguous": ambiguous_reads,
+        "unassigned": unassigned_reads,
+        "samples": {
+            sample: {
+                "reads": reads,
+                "mismatches": {n_mismatches : cumul_mismatches
+                               for n_mismatches,cumul_mismatches in enumerate(cumul_n_mismatches)}
+            }
+            for (sample, _, _), reads, cumul_n_mismatches in zip(samples, sample_reads,
+                                                                  sample_n_mismatches)}
+    }
+
+
+class SpaceSaving:
+    """
+    Approximate counts of the most frequent items of a stream, kept in memory
+    fixed by `capacity` using the Space-Saving algorithm (Metwally et al.,
+    2005). Exact counts of a batch of items (e.g. the indexes of a chunk of
+    reads) are merged in at a time, as for mergeable summaries (Agarwal et
+    al., 2012), so cost scales with distinct items per batch rather than
+    items. Each tracked item's count overestimates its true count by at most
+    its error, and any item not tracked occurs at most `min_count` times.
+    """
+
+    def __init__(self, capacity):
+        if capacity<1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.total = 0
+        self.min_count = 0
+        self.counts = {} # item: count
+        self.errors = {} # item: maximum overestimate of count
+
+    def update(self, item_counts):
+        """
+        Adds the exact counts of a batch of items, as a mapping of item to
+        count (e.g. `collections.Counter`).
+        """
+        counts = self.counts
+        errors = self.errors
+        # an item not tracked may have occurred up to min_count times; done
+        # with dict and map operations as there can be many distinct items
+        errors.update(dict.fromkeys(item_counts.keys()-errors.keys(), self.min_count))
+        counts.update(zip(item_counts.keys(), map(operator.add,
+            map(counts.get, item_counts.keys(), itertools.repeat(self.min_count)),
+            item_counts.values())))
+        self.total += sum(item_counts.values())
+        if len(counts)>self.capacity:
+            # items with the lowest counts discarded, any of which occurred no
+            # more often than the lowest count kept
+            kept = sorted(counts, key=counts.__getitem__, reverse=True)[:self.capacity]
+            self.counts = dict(zip(kept, map(counts.__getitem__, kept)))
+            self.errors = dict(zip(kept, map(errors.__getitem__, kept)))
+            self.min_count = self.counts[kept[-1]]
+
+    def top(self, n=None):
+        """
+        List of (item, count, error) of the `n` (or all) tracked items with
+        highest counts, from highest.
+        """
+        items = sorted(self.counts.items(),
+                       key=lambda item_count: (-item_count[1], item_count[0]))
+        return [(item, count, self.errors[item]) for item, count in items[:n]]
+
+
+def discover_indexes(input_path, top=20, capacity=10000, separator=None,
+                     seq_index=None, seq_index2=None, opener=xopen.xopen,
+                     decompress_threads=0, distance='hamming'):
+    """
+    Counts the indexes of reads in `input_path` in fixed memory, using a
+    `SpaceSaving` summary of `capacity` indexes, returning a dict with the
+    `top` most frequent indexes, their approximate counts and errors, and
+    mismatches to and closest match to `seq_index` (if given). With
+    `separator`, index 1 and index 2 are also counted separately, compared
+    to `seq_index` and `seq_index2` respectively, mismatches being edits with
+    `distance` of 'levenshtein'. The input is opened with `open_input()`,
+    using `decompress_threads`.
+    """
+    summaries = {"indexes": SpaceSaving(capacity)}
+    if separator:
+        summaries["index1"] = SpaceSaving(capacity)
+        summaries["index2"] = SpaceSaving(capacity)
+        separator_bytes = separator.encode('latin-1')
+    no_separator_reads = 0
+    with open_input(input_path, opener, decompress_threads) as input_handle:
+        for chunk in iter_chunks(input_handle):
+            headers = normalize_chunk(chunk, split_chunk(chunk))[1][0::4]
+            header_parts = list(map(bytes.rpartition, headers, itertools.repeat(b':')))
+            if not all(map(operator.itemgetter(1), header_parts)):
+                seqid = next(header for header in headers if b':' not in header)[1:]
+                raise ValueError("no barcode detected for sequence {}".format(
+                    seqid.decode('latin-1')))
+            entry_seq_indexes = list(map(operator.itemgetter(2), header_parts))
+            # only distinct indexes of each chunk are added to the summaries
+            summaries["indexes"].update(collections.Counter(entry_seq_indexes))
+            if separator:
+                index_parts = list(map(bytes.partition, entry_seq_indexes,
+                                       itertools.repeat(separator_bytes)))
+                if not all(map(operator.itemgetter(1), index_parts)):
+                    index_parts = [parts for parts in index_parts if parts[1]]
+                    no_separator_reads += len(entry_seq_indexes)-len(index_parts)
+                summaries["index1"].update(collections.Counter(
+                    map(operator.itemgetter(0), index_parts)))
+                summaries["index2"].update(collections.Counter(
+                    map(operator.itemgetter(2), index_parts)))
+
+    count_differences = edit_distance if distance=='levenshtein' else count_mismatches
+    def compare(entry_seq_index, name):
+        # mismatches of entry_seq_index to the index given for summary name
+        entry_seq_index = entry_seq_index.decode('latin-1')
+        if name=="index1":
+            return count_differences(entry_seq_index, seq_index) if seq_index else None
+        if name=="index2":
+            return count_differences(entry_seq_index, seq_index2) if seq_index2 else None
+        if not separator:
+            return count_differences(entry_seq_index, seq_index) if seq_index else None
+        if not seq_index and not seq_index2: return None
+        index1, found, index2 = entry_seq_index.partition(separator)
+        if not found: return None
+        return ((count_differences(index1, seq_index) if seq_index else 0) +
+                (count_differences(index2, seq_index2) if seq_index2 else 0))
+
+    results = {
+        "total": summaries["indexes"].total,
+        "capacity": capacity,
+    }
+    if separator: results["no_separator"] = no_separator_reads
+    for name, summary in summaries.items():
+        entries = [{
+            "index": entry_seq_index.decode('latin-1'),
+            "count": count,
+            "error": error,
+            "mismatches": compare(entry_seq_index, name),
+            } for entry_seq_index, count, error in summary.top()]
+        compared = [entry for entry in entries if entry["mismatches"] is not None]
+        results[name] = {
+            "top": entries[:top],
+            "max_untracked_count": summary.min_count,
+            "closest": min(compared, key=lambda entry: entry["mismatches"])
+                       if compared else None,
+        }
+    return results
+
+
+def print_discovered_indexes(results, seq_index=None, seq_index2=None,
+                             separator=None):
+    """
+    Prints the summary returned by `discover_indexes()`.
+    """
+    print("Total reads: {}".format(results["total"]))
+    if separator:
+        print("Reads without separator: {}".format(results["no_separator"]))
+    for name, description, compared_to in (
+            ("indexes", "indexes", separator.join((seq_index or '', seq_index2 or ''))
+                                   if separator else seq_index),
+            ("index1", "index 1", seq_index),
+            ("index2", "index 2", seq_index2)):
+        if name not in results: continue
+        summary = results[name]
+        print("Top {} {} (approximate reads, with lower bound):".format(
+            len(summary["top"]), description))
+        for entry in summary["top"]:
+            print(" {}: {} (at least {}){}".format(entry["index"], entry["count"],
+                entry["count"]-entry["error"],
+                '' if entry["mismatches"] is None else
+                ', {} mismatches'.format(entry["mismatches"])))
+        print(" Other {}: at most {} reads each".format(description,
+            summary["max_untracked_count"]))
+        closest = summary["closest"]
+        if closest:
+            print(" Closest to {}: {} ({} mismatches, {} reads)".format(
+                compared_to, closest["index"], closest["mismatches"],
+                closest["count"]))
+
+
+def print_estimate(estimate, max_tracked_mismatches):
+    """
+    Prints the estimates of a `FilterEstimate`.
+    """
+    def format_estimate(estimate_bounds):
+        return "{:.4f} ({:.0%} confidence interval {:.4f} to {:.4f})".format(
+            estimate_bounds[0], estimate.confidence, *estimate_bounds[1:])
+    print("Sampled reads: {} (in {} chunks)".format(estimate.result.total,
+                                                    estimate.n_chunks))
+    if estimate.result.passthrough_mode:
+        print("Estimated filtered fraction: 1 (passthrough-mode)")
+        return
+    print("Estimated filtered fraction: {}".format(format_estimate(estimate.filtered)))
+    for n_mismatches, mismatches in enumerate(estimate.mismatches):
+        print(" Fraction of reads with {}{} mismatches: {}".format(
+            '' if n_mismatches<= max_tracked_mismatches else '>=',
+            n_mismatches, format_estimate(mismatches)))
+
+
+BatchJob = collections.namedtuple('BatchJob', ['name', 'input_paths', 'filtered_paths',
+    'unfiltered_paths', 'index', 'index2', 'mismatches'])
+    # a job of a batch, as read from a manifest by `read_manifest()`
+
+def read_manifest(manifest_path, index=None, index2=None, mismatches=(0,)):
+    """
+    Reads the jobs of a batch from a comma or tab delimited manifest, with a
+    header row naming its columns: `input`, and optionally `name`,
+    `filtered`, `unfiltered`, `index`, `index2` and `mismatches`. Several
+    files of a job (e.g. read 1 and read 2, filtered in lockstep) are
+    separated by `;`, with one output file for each in the `filtered` and
+    `unfiltered` columns. The index, index2 and mismatches (a list of
+    thresholds) of a job are `index`, `index2` and `mismatches` if missing
+    or empty in its row; the name is its first input file unless given.
+    Returns a list of `BatchJob`s. Raises ValueError if there are no jobs, no
+    `input` column, or a job has no index or invalid outputs or mismatches.
+    """
+    with open(manifest_path, newline='') as manifest_handle:
+        lines = [line for line in manifest_handle.read().splitlines()
+                 if line.strip() and not line.startswith('#')]
+    if not lines:
+        raise ValueError("no jobs found in manifest {}".format(manifest_path))
+    delimiter = '\t' if '\t' in lines[0] else ','
+    rows = csv.reader(lines, delimiter=delimiter)
+    header = [field.strip().lower() for field in next(rows)]
+    if 'input' not in header:
+        raise ValueError("no input column in manifest {}".format(manifest_path))
+    jobs = []
+    for row in rows:
+        fields = dict(zip(header, (field.strip() for field in row)))
+        def paths(column):
+            return [path.strip() for path in fields[column].split(';')] \
+                if fields.get(column) else None
+        input_paths = paths('input')
+        if not input_paths:
+            raise ValueError("job without input in manifest {}".format(manifest_path))
+        name = fields.get('name') or input_paths[0]
+        for out_paths in (paths('filtered'), paths('unfiltered')):
+            if out_paths and len(out_paths)!=len(input_paths):
+                raise ValueError("job {} needs one output file for each input "
+                                 "file".format(name))
+        job_index = fields.get('index') or index
+        if job_index is None:
+            raise ValueError("job {} has no index, give --index or an index "
+                             "column".format(name))
+        job_mismatches = mismatches
+        if fields.get('mismatches'):
+            try:
+                job_mismatches = sorted(set(int(threshold) for threshold in
+                                            fields['mismatches'].split(',')))
+            except ValueError:
+                raise ValueError("invalid number of mismatches for job {}: {}".format(
+                    name, fields['mismatches'])) from None
+        jobs.append(BatchJob(name, input_paths, paths('filtered'), paths('unfiltered'),
+            job_index, fields.get('index2') or index2,
+            list(job_mismatches)))
+    if not jobs:
+        raise ValueError("no jobs found in manifest {}".format(manifest_path))
+    return jobs
+
+
+def split_cpu_budget(cpus, n_jobs):
+    """
+    Splits a budget of `cpus` between `n_jobs` batch jobs, giving `(jobs run
+    at once, input threads, output threads)`, the threads being for each job.
+    The main process of a job classifies reads, with a thread decompressing
+    its input if it has at least `_BATCH_CPUS_PER_JOB` CPUs and the rest
+    compressing its output, so as many jobs as possible (at least one) run
+    at once with that many CPUs each, any CPUs left over going to
+    compression.
+    """
+    parallel_jobs = max(1, min(n_jobs, cpus//_BATCH_CPUS_PER_JOB))
+    job_cpus = max(1, cpus//parallel_jobs)
+    input_threads = 1 if job_cpus>=_BATCH_CPUS_PER_JOB else 0
+    return parallel_jobs, input_threads, job_cpus-1-input_threads
+
+
+def run_batch_job(job, separator=None, cache_size=65536, input_threads=0,
+                  output_threads=0, compression_backend='xopen', compresslevel=6,
+                  filtered_compresslevel=None, unfiltered_compresslevel=None,
+                  distance='hamming'):
+    """
+    Runs a `BatchJob` (in a process of a batch), returning its statistics as
+    from `RunStats.report()` with its name added. Input and output threads
+    are for the whole job: with the xopen compression backend they are
+    divided between its files, otherwise output threads are a pool shared by
+    its output files. Other arguments are as for the command line, with
+    `separator` only used by jobs with an index2.
+    """
+    stats = RunStats()
+    index_filter = IndexFilter(job.index, job.index2,
+        separator if job.index2 is not None else None, job.mismatches, cache_size,
+        distance)
+    filtered_paths = index_filter.tier_paths(job.filtered_paths or [])
+    out_paths = filtered_paths + (job.unfiltered_paths or [])
+    file_input_threads = input_threads//len(job.input_paths)
+    if compression_backend=='xopen' and out_paths:
+        output_threads = output_threads//len(out_paths)
+    compresslevels = {}
+    for paths, out_compresslevel in ((filtered_paths, filtered_compresslevel),
+                                     (job.unfiltered_paths, unfiltered_compresslevel)):
+        if out_compresslevel is not None:
+            compresslevels.update(dict.fromkeys(paths or [], out_compresslevel))
+    with OutputOpener(compression_backend, output_threads, compresslevel,
+                      compresslevels) as output_opener:
+        result = index_filter.filter_files(job.input_paths, job.filtered_paths,
+            job.unfiltered_paths, partial(xopen.xopen, threads=file_input_threads),
+            stats=stats, decompress_threads=file_input_threads,
+            output_opener=output_opener)
+    return dict(name=job.name, **stats.report(result, job.input_paths, out_paths))
+
+
+def run_batch(jobs, cpus, log=print, **job_options):
+    """
+    Runs `BatchJob`s on a pool of processes, splitting `cpus` between them
+    with `split_cpu_budget()`, and returns a report of the batch as a dict,
+    with the totals of all jobs and the statistics of each (in the order of
+    `jobs`), or the error if it failed. Jobs are started largest input first,
+    so that the batch isn't left waiting on a large job started last. Each
+    job is passed to `log` as it finishes. Other arguments are passed to
+    `run_batch_job()`.
+    """
+    parallel_jobs, input_threads, output_threads = split_cpu_budget(cpus, len(jobs))
+    start_wall = time.perf_counter()
+    start_times = os.times()
+    def input_size(job):
+        return sum(os.path.getsize(path) for path in job.input_paths
+                   if os.path.isfile(path))
+    order = sorted(range(len(jobs)), key=lambda job_number: -input_size(jobs[job_number]))
+    job_reports = [None]*len(jobs)
+    with concurrent.futures.ProcessPoolExecutor(parallel_jobs) as executor:
+        futures = {executor.submit(run_batch_job, jobs[job_number],
+                                   input_threads=input_threads,
+                                   output_threads=output_threads, **job_options):
+                   job_number for job_number in order}
+        for future in concurrent.futures.as_completed(futures):
+            job = jobs[futures[future]]
+            try:
+                job_report = future.result()
+            except Exception as exception:
+                job_report = {"name": job.name, "error": "{}: {}".format(
+                    type(exception).__name__, exception)}
+                log("Job {} failed: {}".format(job.name, job_report["error"]))
+            else:
+                log("Job {}: {} reads, {} filtered in {:.1f} s".format(job.name,
+                    job_report["results"]["total"], job_report["results"]["filtered"],
+                    job_report["wall_s"]))
+            job_report["finished_s"] = round(time.perf_counter()-start_wall, 3)
+            job_reports[futures[future]] = job_report
+    wall = time.perf_counter()-start_wall
+    times = os.times()
+    done_reports = [job_report for job_report in job_reports if "error" not in job_report]
+    def total(key):
+        return sum(job_report["results"][key] for job_report in done_reports)
+    input_bytes = sum(file_stats["bytes"] or 0 for job_report in done_reports
+                      for file_stats in job_report["inputs"])
+    return {
+        "version": _PROGRAM_VERSION,
+        "cpus": cpus,
+        "parallel_jobs": parallel_jobs,
+        "input_threads": input_threads,
+        "output_threads": output_threads,
+        "wall_s": round(wall, 3),
+        "cpu_s": round(times.user+times.system
+                       -start_times.user-start_times.system, 3),
+        "children_cpu_s": round(times.children_user+times.children_system
+            -start_times.children_user-start_times.children_system, 3),
+        "jobs_done": len(done_reports),
+        "jobs_failed": len(jobs)-len(done_reports),
+        "reads": total("total"),
+        "filtered": total("filtered"),
+        "unfiltered": total("unfiltered"),
+        "input_bytes": input_bytes,
+        "output_bytes": sum(file_stats["bytes"] or 0 for job_report in done_reports
+                            for file_stats in job_report["outputs"]),
+        "reads_per_s": round(total("total")/wall) if wall else None,
+        "mb_per_s": round(input_bytes/1e6/wall, 2) if wall else None,
+        "jobs": job_reports,
+    }
+
+
+_serving = False
+    # set in processes running requests of `--serve`
+
+def _init_serve_worker():
+    # interrupting the server lets running requests finish
+    global _serving
+    _serving = True
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def run_request(request):
+    """
+    Runs a request of `--serve` (in a process of the server), a dict with
+    the command line `argv` and working directory `cwd` of the client, as
+    `main()` with `return_result`. Returns a dict of the result (or None),
+    exit status and messages written to stdout and stderr.
+    """
+    stdout, stderr = io.StringIO(), io.StringIO()
+    result, exit_status = None, 0
+    try:
+        os.chdir(request["cwd"])
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            result = main(request["argv"], return_result=True)
+    except SystemExit as exception:
+        if exception.code is None or isinstance(exception.code, int):
+            exit_status = exception.code or 0
+        else:
+            stderr.write("{}\n".format(exception.code))
+            exit_status = 1
+    except Exception:
+        stderr.write(traceback.format_exc())
+        exit_status = 1
+    return {"result": result, "exit_status": exit_status,
+            "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+
+def _remove_stale_socket(socket_path):
+    # removes a socket left by a server no longer running
+    if not os.path.exists(socket_path):
+        return
+    if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+        raise FileExistsError("{} exists and is not a socket".format(socket_path))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe_socket:
+        try:
+            probe_socket.connect(socket_path)
+        except ConnectionRefusedError:
+            os.unlink(socket_path)
+        else:
+            raise FileExistsError("a server is already listening on {}".format(socket_path))
+
+
+def serve(socket_path, max_concurrent, log=print):
+    """
+    Listens on a Unix socket at `socket_path` for requests to run the program,
+    each a line of JSON with the command line `argv` and working directory
+    `cwd` of the client (see `filter_illumina_index.client`), replying with a
+    line of JSON from `run_request()`. Requests are run on a pool of
+    `max_concurrent` processes forked once imports are done, so that they
+    start without the interpreter and imports starting again, further
+    requests waiting for one to finish. Runs until interrupted, sent
+    SIGTERM or sent a request with `shutdown`, letting running requests
+    finish; returns the number of requests run.
+    """
+    # modules imported on first use are imported before forking, rather
+    # than by each request
+    if np is not None: np.ndarray
+    statistics.NormalDist
+    _remove_stale_socket(socket_path)
+    stop = threading.Event()
+    request_numbers = itertools.count(1)
+    handlers = []
+
+    def handle(connection, executor):
+        with connection, connection.makefile('rwb') as stream:
+            try:
+                request = json.loads(stream.readline())
+                if request.get("shutdown"):
+                    stop.set()
+                    reply = {"result": None, "exit_status": 0, "stdout": "", "stderr": ""}
+                else:
+                    request_number = next(request_numbers)
+                    start_wall = time.perf_counter()
+                    reply = executor.submit(run_request, request).result()
+                    log("Request {}: {} exited with status {} in {:.3f} s".format(
+                        request_number, ' '.join(request["argv"]),
+                        reply["exit_status"], time.perf_counter()-start_wall))
+                stream.write(json.dumps(reply, default=str).encode()+b'\n')
+                stream.flush()
+            except (OSError, ValueError, KeyError) as exception:
+                log("Request failed: {}: {}".format(type(exception).__name__, exception))
+
+    with concurrent.futures.ProcessPoolExecutor(max_concurrent,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_serve_worker) as executor, \
+         socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server_socket:
+        executor.submit(int).result() # processes all forked now, before any threads
+        server_socket.bind(socket_path)
+        try:
+            server_socket.listen()
+            server_socket.settimeout(_SERVE_POLL_INTERVAL)
+            previous_handler = signal.signal(signal.SIGTERM, lambda *_: stop.set())
+            log("Serving requests on {}, running up to {} at once".format(
+                socket_path, max_concurrent))
+            try:
+                while not stop.is_set():
+                    try:
+                        connection, _ = server_socket.accept()
+                    except socket.timeout:
+                        continue
+                    connection.settimeout(None)
+                    handler = threading.Thread(target=handle, args=(connection, executor),
+                                               daemon=True)
+                    handler.start()
+                    handlers.append(handler)
+                    handlers = [handler for handler in handlers if handler.is_alive()]
+            except KeyboardInterrupt:
+                pass
+            finally:
+                signal.signal(signal.SIGTERM, previous_handler)
+            log("Shutting down, waiting for running requests")
+            for handler in handlers:
+                handler.join()
+        finally:
+            os.unlink(socket_path)
+    return next(request_numbers)-1
+
+
+def mismatch_thresholds(text):
+    """
+    Parses the argument of `--mismatches`, a number of mismatches or several
+    separated by commas, as a sorted list of ints.
+    """
+    try:
+        return sorted(set(int(threshold) for threshold in text.split(',')))
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid number of mismatches: {}".format(
+            text)) from None
+
+
 def main(argv = None, return_result = False):
         # return_result = True will return summary of output to caller (for testing)
     if argv is None: argv = sys.argv[1:] # if parameters not provided, use sys.argv
@@ -89,23 +3795,33 @@ def main(argv = None, return_result = False):
     parser_required_named = parser.add_argument_group('required named arguments')
     parser.add_argument('--version', action='version',
                         version=_PROGRAM_NAME_VERSION)
-    parser.add_argument('inputfile',
+    parser.add_argument('inputfile', nargs='*',
                         help='Input FASTQ file, compression (`.gz`, `.bz2` and '
-                        '`.xz`) supported')
-    parser.add_argument('-f', '--filtered',
+                        '`.xz`) supported. Several files (e.g. read 1, read 2 '
+                        'and index reads) can be given to filter in lockstep, '
+                        'by the index in the headers of the first file; `-` '
+                        'reads standard input, its compression detected from '
+                        'its content')
+    parser.add_argument('-f', '--filtered', action='append',
                         help='Output FASTQ file containing filtered (positive) reads; '
-                        'compression detected by extension')
-    parser.add_argument('-u', '--unfiltered',
+                        'compression detected by extension, `-` for standard '
+                        'output. Give once per input file, in the same order')
+    parser.add_argument('-u', '--unfiltered', action='append',
                         help='Output FASTQ file containing unfiltered (negative) reads; '
-                        'compression detected by extension')
-    parser_required_named.add_argument('-i', '--index', required=True, const='', nargs='?',
+                        'compression detected by extension, `-` for standard '
+                        'output. Give once per input file, in the same order')
+    parser_required_named.add_argument('-i', '--index', const='', nargs='?',
                                        help='Sequence index to filter for; if empty '
                                        '(i.e. no argument or "") then program will '
                                        'run in "passthrough" mode with all reads '
                                        'directed to filtered file with no processing. '
                                        'If index2 is provided, this is the index '
                                        'before the separator; no argument or "" '
-                                       'will mean no filtering by this index.')
+                                       'will mean no filtering by this index. '
+                                       'N and other IUPAC codes match any base; '
+                                       'other characters than A, C, G, T and '
+                                       'IUPAC codes are an error. '
+                                       'Not used with --samplesheet.')
     parser_required_named.add_argument('-j', '--index2', const='', nargs='?',
                                        help='Optional second sequence index to filter for; '
                                        'this is the index after the separator; '
@@ -115,196 +3831,489 @@ def main(argv = None, return_result = False):
     parser_required_named.add_argument('-s', '--separator', 
                                        help='Optional separator between indexes (e.g. "+"); '
                                        'second index must be set if this is used.')
-    parser.add_argument('-m', '--mismatches', default=0, type=int,
+    parser.add_argument('-S', '--samplesheet',
+                        help='Sample sheet for demultiplex mode, used instead '
+                        'of --index; comma or tab delimited with columns '
+                        'sample, index and optional index2 (or an Illumina '
+                        '`SampleSheet.csv` with a [Data] section); --separator '
+                        'must be set if index2 is used')
+    parser.add_argument('-o', '--output',
+                        help='Output FASTQ file template for demultiplex mode, '
+                        'with `{sample}` replaced by each sample name, e.g. '
+                        '`out/{sample}.fastq.gz`; unassigned reads are written '
+                        'to the unfiltered file')
+    parser.add_argument('--ambiguous',
+                        help='Output FASTQ file for reads in demultiplex mode '
+                        'matching more than one sample equally well')
+    parser.add_argument('--discover', nargs='?', const=20, type=int, metavar='N',
+                        help='Discover mode: count the indexes of reads in fixed '
+                        'memory and show the N most frequent (default N if no '
+                        'argument: 20), with approximate counts and mismatches '
+                        'to --index (and --index2) if given; index 1 and 2 are '
+                        'also counted separately if --separator is set')
+    parser.add_argument('--discover-capacity', default=10000, type=int,
+                        help='Number of distinct indexes tracked in discover '
+                        'mode; counts are exact until more distinct indexes '
+                        'than this are seen, and more accurate the larger it is')
+    parser.add_argument('-m', '--mismatches', default='0', type=mismatch_thresholds,
                         help='Maximum number of mismatches to tolerate '
-                        '(total if two indexes used)')
+                        '(total if two indexes used); several separated by '
+                        'commas (e.g. 0,1,2) split filtered reads into tiers '
+                        'by the smallest that they are within, with one '
+                        '--filtered file for each, named by replacing '
+                        '`{mismatches}` with each number')
+    parser.add_argument('--distance', default='hamming', choices=_DISTANCES,
+                        help='How mismatches are counted: `hamming` counts '
+                        'bases differing at the same position (plus any '
+                        'difference in length), `levenshtein` counts the '
+                        'fewest substitutions, insertions and deletions, so '
+                        'that an inserted or deleted base is one mismatch; '
+                        'read indexes within --mismatches edits are looked up '
+                        'in a table of them made first. Not used with '
+                        '--samplesheet')
+    parser.add_argument('--cache-size', default=65536, type=int,
+                        help='Maximum number of distinct read indexes to cache '
+                        'the result of matching for; the least recently seen '
+                        'indexes are discarded once this is reached, and 0 '
+                        'turns off caching')
+    parser.add_argument('-w', '--workers', default=0, type=int,
+                        help='Number of worker processes to filter chunks of '
+                        'reads in parallel, with output kept in input order; '
+                        'use 0 to filter in the main process.')
     parser.add_argument('-t', '--threads', default=1, type=int,
                         help='Number of threads to pass to `xopen` for each '
                         'open file; use 0 to turn off `pigz` use and rely '
-                        'on `gzip.open` so no extra threads spawned.')
+                        'on `gzip.open` so no extra threads spawned. If more '
+                        'than 1, BGZF and multi-member gzip input is '
+                        'decompressed in this many threads.')
     parser.add_argument('-l', '--compresslevel', default=6, type=int, choices=range(1,10),
                         help='Compression level for writing gzip files; '
                         'ignored if gzip compression not used')
+    parser.add_argument('--filtered-compresslevel', type=int, choices=range(1,10),
+                        help='Compression level for the filtered files, '
+                        'if different from --compresslevel')
+    parser.add_argument('--unfiltered-compresslevel', type=int, choices=range(1,10),
+                        help='Compression level for the unfiltered files, '
+                        'if different from --compresslevel')
+    parser.add_argument('--input-threads', type=int,
+                        help='Number of threads for reading each input file, '
+                        'used as --threads is for input (default: --threads)')
+    parser.add_argument('--output-threads', type=int,
+                        help='Number of threads for compressing output: for '
+                        'each file with the xopen backend, or shared by all '
+                        'files with other backends, 0 compressing in the main '
+                        'thread (default: --threads)')
+    parser.add_argument('--compression-backend', default='xopen',
+                        choices=_COMPRESSION_BACKENDS,
+                        help='How gzip and zstd output is compressed: by '
+                        '`xopen` (with `pigz`, `zstd` or a library), or in '
+                        'blocks in this process with the `isal`, `zlib-ng` or '
+                        '`zlib` library for gzip (and `backports.zstd` for '
+                        'zstd), on a pool of --output-threads threads')
+    parser.add_argument('--batch', metavar='MANIFEST',
+                        help='Batch mode: run the jobs of a comma or tab '
+                        'delimited manifest, with columns input, and '
+                        'optionally name, filtered, unfiltered, index, index2 '
+                        'and mismatches (defaults from --index, --index2 and '
+                        '--mismatches), several files of a job separated by '
+                        '`;`, on a pool of processes sharing --cpus, largest '
+                        'input first; --stats-json reports each job and the '
+                        'totals')
+    parser.add_argument('--cpus', type=int, default=len(os.sched_getaffinity(0))
+                        if hasattr(os, 'sched_getaffinity') else os.cpu_count(),
+                        help='Number of CPUs shared by the jobs of --batch, '
+                        'between jobs run at once and their decompression, '
+                        'classification and compression threads')
+    parser.add_argument('--serve', metavar='SOCKET',
+                        help='Serve requests to run this program with the '
+                        'options given to `python -m filter_illumina_index.client '
+                        'SOCKET`, on a Unix socket at SOCKET, from processes '
+                        'already started with modules imported, until '
+                        'interrupted')
+    parser.add_argument('--max-concurrent', type=int, metavar='N',
+                        default=len(os.sched_getaffinity(0))
+                        if hasattr(os, 'sched_getaffinity') else os.cpu_count(),
+                        help='Number of requests to --serve run at once, others '
+                        'waiting for one to finish')
+    parser.add_argument('--head', type=int, metavar='N',
+                        help='Only estimate statistics from the first N reads '
+                        '(of the sample, with --sample), without writing output')
+    parser.add_argument('--sample', type=float, metavar='FRACTION',
+                        help='Only estimate statistics from a sample of this '
+                        'fraction of the input, without writing output: every '
+                        'n-th block of an uncompressed input is read, seeking '
+                        'past the others, or every n-th chunk of records of a '
+                        'compressed input is parsed')
+    parser.add_argument('--decision-log', metavar='PATH',
+                        help='Write a line for each read to this file, with '
+                        'the read name, indexes, mismatches for each index and '
+                        'whether filtered, as tab separated values; '
+                        'compression detected by extension')
+    parser.add_argument('--sidecar', nargs='?', const='', metavar='PATH',
+                        help='Filter using a sidecar index of the input file '
+                        'kept at PATH (default if no argument: input file name '
+                        'with `{}` added), with the length and index of each '
+                        'record, so that later runs with other --index, '
+                        '--index2 or --mismatches copy records without parsing '
+                        'them; built first if missing or stale (if the input '
+                        'has changed size or modification time). In passthrough '
+                        'mode, only an existing index is used, for the number '
+                        'of reads'.format(_SIDECAR_SUFFIX))
+    parser.add_argument('--checkpoint', metavar='PATH',
+                        help='Save the position in the input, counts and size of '
+                        'each output to PATH every --checkpoint-interval seconds, '
+                        'outputs being flushed (compressed output ending a gzip '
+                        'member) first; if PATH exists, carry on from it, '
+                        'truncating outputs back to the checkpoint, e.g. after the '
+                        'run was killed. Removed once the run finishes. Input '
+                        'other than uncompressed, BGZF or multi-member gzip '
+                        '(e.g. single-member gzip, bz2, xz) is decompressed '
+                        'again up to the checkpoint on resuming')
+    parser.add_argument('--checkpoint-interval', type=float, default=60,
+                        metavar='SECONDS',
+                        help='Seconds between checkpoints saved to --checkpoint')
+    parser.add_argument('--stats-json', metavar='PATH',
+                        help='Write statistics of the run as JSON to this file: '
+                        'wall and CPU time of each stage, bytes read and written '
+                        'for each file and numbers of reads and mismatches')
+    parser.add_argument('--progress', default=0, type=float, metavar='SECONDS',
+                        help='Show progress on stderr at this interval; use 0 '
+                        'for no progress')
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help='Increase logging verbosity, available levels 1 to 2 '
                              'with `-v` to `-vv`')
 
-    print(_PROGRAM_NAME_VERSION)
     args = parser.parse_args(argv)
 
-    input_path = args.inputfile
-    out_filtered_path = args.filtered
-    out_unfiltered_path = args.unfiltered
+    # with output to stdout ('-'), messages are shown on stderr instead
+    stdout_paths = [path for path in (args.filtered or [])+(args.unfiltered or [])
+                    +[args.decision_log, args.ambiguous, args.stats_json]
+                    if path==_STDIO_PATH]
+    info = partial(print, file=sys.stderr) if stdout_paths else print
+    info(_PROGRAM_NAME_VERSION)
+
+    input_paths = args.inputfile
+    out_filtered_paths = args.filtered
+    out_unfiltered_paths = args.unfiltered
     filter_seq_index = args.index
-    max_tolerated_mismatches = args.mismatches
+    max_tolerated_mismatches = args.mismatches[-1]
     threads = args.threads
     compresslevel = args.compresslevel
     verbose = args.verbose
+    cache_size = args.cache_size
+    workers = args.workers
     separator = args.separator
     filter_seq_index2 = args.index2
+    input_threads = threads if args.input_threads is None else args.input_threads
+    output_threads = threads if args.output_threads is None else args.output_threads
 
-    if (separator and filter_seq_index2 is None) or \
-       (separator is None and filter_seq_index2):
-            raise ValueError("both separator and index2 must be provided")
+    for out_paths, option in ((out_filtered_paths, '--filtered'),
+                              (out_unfiltered_paths, '--unfiltered')):
+        if out_paths and len(out_paths)!=len(input_paths):
+            parser.error("{} must be given once for each input file".format(option))
+    if len(stdout_paths)>1:
+        parser.error("only one output can be standard output (`-`)")
+    if input_paths.count(_STDIO_PATH)>1:
+        parser.error("standard input (`-`) can only be given as one input file")
+    if _serving and (args.serve is not None or stdout_paths or _STDIO_PATH in input_paths):
+        parser.error("--serve and standard input or output (`-`) cannot be used "
+                     "in a served request")
+    if not input_paths and args.batch is None and args.serve is None:
+        parser.error("the following arguments are required: inputfile")
+    for out_path in (out_filtered_paths or [])+(out_unfiltered_paths or []) \
+                    +[args.decision_log, args.ambiguous, args.stats_json]:
+        if out_path and any(is_same_file(input_path, out_path) for input_path in input_paths):
+            parser.error("output file {} is also an input file".format(out_path))
+
+    if args.serve is not None:
+        if input_paths or args.batch is not None:
+            parser.error("--serve cannot be used with input files or --batch")
+        if args.max_concurrent<1:
+            parser.error("--max-concurrent must be at least 1")
+        n_requests = serve(args.serve, args.max_concurrent, info)
+        info("Served {} requests".format(n_requests))
+        return
+
+    if args.checkpoint is not None:
+        if args.batch is not None or args.samplesheet or args.discover is not None \
+           or args.head is not None or args.sample is not None or \
+           args.sidecar is not None:
+            parser.error("--checkpoint cannot be used with --batch, --samplesheet, "
+                         "--discover, --head, --sample or --sidecar")
+        if stdout_paths or any(map(is_stream, input_paths)):
+            parser.error("--checkpoint cannot be used with standard input or "
+                         "output or other streams")
+        if args.checkpoint_interval<=0:
+            parser.error("--checkpoint-interval must be more than 0")
+
+    if args.batch is not None:
+        if input_paths or out_filtered_paths or out_unfiltered_paths or \
+           args.samplesheet or args.output or args.ambiguous or \
+           args.discover is not None or args.head is not None or \
+           args.sample is not None or args.decision_log or \
+           args.sidecar is not None or workers or \
+           args.input_threads is not None or args.output_threads is not None:
+            parser.error("--batch cannot be used with input or output files, "
+                         "other modes, --decision-log, --sidecar, --workers, "
+                         "--input-threads or --output-threads")
+        if args.cpus<1:
+            parser.error("--cpus must be at least 1")
+        if filter_seq_index2 and not separator:
+            parser.error("--index2 requires --separator")
+        jobs = read_manifest(args.batch, filter_seq_index, filter_seq_index2,
+                             args.mismatches)
+        parallel_jobs, job_input_threads, job_output_threads = \
+            split_cpu_budget(args.cpus, len(jobs))
+        info("Batch manifest: {} ({} jobs)".format(args.batch, len(jobs)))
+        info("Running {} jobs at once on {} CPUs, each with {} input and {} "
+             "output threads".format(parallel_jobs, args.cpus, job_input_threads,
+                                     job_output_threads))
+        if verbose>=1:
+            info("Compressing output with {} backend".format(args.compression_backend))
+            info("Compression level: {}".format(compresslevel))
+        report = run_batch(jobs, args.cpus, info, separator=separator,
+            cache_size=cache_size, compression_backend=args.compression_backend,
+            compresslevel=compresslevel,
+            filtered_compresslevel=args.filtered_compresslevel,
+            unfiltered_compresslevel=args.unfiltered_compresslevel,
+            distance=args.distance)
+        info("Total reads: {}".format(report["reads"]))
+        info("Filtered reads: {}".format(report["filtered"]))
+        info("Unfiltered reads: {}".format(report["unfiltered"]))
+        info("Batch finished in {:.1f} s".format(report["wall_s"]))
+        if args.stats_json:
+            with xopen.xopen(args.stats_json, 'w') as stats_handle:
+                json.dump(report, stats_handle, indent=1)
+        if report["jobs_failed"]:
+            parser.exit(1, "{}: {} of {} jobs failed\n".format(_PROGRAM_NAME,
+                report["jobs_failed"], len(jobs)))
+        if return_result: return(report)
+        return
+
+    if args.discover is not None:
+        if args.samplesheet or out_filtered_paths or out_unfiltered_paths or \
+           args.output or args.ambiguous or args.decision_log or \
+           args.stats_json or args.progress:
+            parser.error("--discover cannot be used with --samplesheet or "
+                         "output options")
+        if len(input_paths)>1:
+            parser.error("--discover can only be used with one input file")
+        if args.discover<1 or args.discover_capacity<1:
+            parser.error("--discover and --discover-capacity must be at least 1")
+        if filter_seq_index2 and not separator:
+            parser.error("--index2 requires --separator")
+        input_path, = input_paths
+        info("Input file: {}".format(input_path))
+        info("Discovering top {} indexes, tracking up to {} distinct indexes".format(
+            args.discover, args.discover_capacity))
+        if separator:
+            info("Separator between index 1 and 2: {}".format(separator))
+        if filter_seq_index:
+            info("Comparing to sequence index{}: {}".format(
+                ' 1' if separator else '', filter_seq_index))
+        if filter_seq_index2:
+            info("Comparing to sequence index 2: {}".format(filter_seq_index2))
+        xopen_xthreads = functools.partial(xopen.xopen, threads=input_threads)
+        results = discover_indexes(input_path, args.discover,
+                                   args.discover_capacity, separator,
+                                   filter_seq_index, filter_seq_index2,
+                                   xopen_xthreads, input_threads, args.distance)
+        print_discovered_indexes(results, filter_seq_index, filter_seq_index2,
+                                 separator)
+        if return_result: return(results)
+        return
 
-    if separator and filter_seq_index2 is not None:
-        double_index = True
+    if args.sidecar is not None:
+        if len(input_paths)>1 or args.samplesheet or args.decision_log or verbose>=2:
+            parser.error("--sidecar can only be used with one input file, and "
+                         "not with --samplesheet, --decision-log or -vv")
+        if is_stream(input_paths[0]):
+            parser.error("--sidecar cannot be used with standard input or other streams")
+        sidecar_path = args.sidecar or input_paths[0]+_SIDECAR_SUFFIX
     else:
-        double_index = False
+        sidecar_path = None
 
-    if double_index:
-        passthrough1 = filter_seq_index == ''
-        passthrough2 = filter_seq_index2 == ''
-        passthrough_mode = passthrough1 and passthrough2
+    if args.samplesheet is None:
+        if filter_seq_index is None:
+            parser.error("the following arguments are required: -i/--index "
+                         "(or -S/--samplesheet)")
+        if args.output or args.ambiguous:
+            parser.error("--output and --ambiguous require --samplesheet")
     else:
-        passthrough_mode = filter_seq_index == ''
+        if filter_seq_index is not None or filter_seq_index2 is not None:
+            parser.error("--index/--index2 cannot be used with --samplesheet")
+        if out_filtered_paths:
+            parser.error("--filtered cannot be used with --samplesheet, "
+                         "use --output")
+        if len(input_paths)>1:
+            parser.error("--samplesheet can only be used with one input file")
+        input_path, = input_paths
+        out_unfiltered_path = out_unfiltered_paths[0] if out_unfiltered_paths else None
+        if args.output and '{sample}' not in args.output:
+            parser.error("--output must contain `{sample}`")
+        if args.stats_json or args.progress or args.decision_log:
+            parser.error("--stats-json, --progress and --decision-log cannot be "
+                         "used with --samplesheet")
+        if len(args.mismatches)>1:
+            parser.error("several --mismatches cannot be used with --samplesheet")
+        if args.distance!='hamming':
+            parser.error("--distance cannot be used with --samplesheet")
+        samples = read_samplesheet(args.samplesheet)
+        if any(seq_index2 is None for _, _, seq_index2 in samples) == bool(separator):
+            raise ValueError("both separator and index2 in sample sheet must be provided")
+        info("Input file: {}".format(input_path))
+        info("Demultiplexing {} samples from sample sheet: {}".format(
+            len(samples), args.samplesheet))
+        if separator:
+            info("Separator between index 1 and 2: {}".format(separator))
+        info("Max mismatches tolerated: {}".format(max_tolerated_mismatches))
+        info("Output sample files: {}".format(args.output))
+        info("Output unassigned file: {}".format(out_unfiltered_path))
+        info("Output ambiguous file: {}".format(args.ambiguous))
+        xopen_xthreads = functools.partial(xopen.xopen, threads=threads,
+                                           compresslevel = compresslevel)
+        results = demultiplex(input_path, samples, max_tolerated_mismatches,
+                              separator, args.output, out_unfiltered_path,
+                              args.ambiguous, xopen_xthreads, verbose,
+                              cache_size, info)
+        if return_result: return(results)
+        return
 
-    if passthrough_mode:
-        if max_tolerated_mismatches!=0: 
-            raise ValueError("changing number of tolerated mismatches "
-                            "incompatible with passthrough mode")
-        max_tolerated_mismatches = float('NaN')
+    index_filter = IndexFilter(filter_seq_index, filter_seq_index2, separator,
+                               args.mismatches, cache_size, args.distance)
+    passthrough_mode = index_filter.passthrough_mode
+    tiered = len(index_filter.thresholds)>1
+    if tiered and out_filtered_paths and \
+       not all('{mismatches}' in path for path in out_filtered_paths):
+        parser.error("--filtered must contain `{mismatches}` with several --mismatches")
 
 
     # HELPER FUNCTIONS
-    print("Input file: {}".format(input_path))
+    if len(input_paths)==1:
+        info("Input file: {}".format(input_paths[0]))
+    else:
+        info("Input files (filtered by index in first file): {}".format(
+            ', '.join(input_paths)))
     if not separator:
-        print("Filtering for sequence index: {}{}".format(filter_seq_index,
+        info("Filtering for sequence index: {}{}".format(filter_seq_index,
             "(passthrough mode)" if passthrough_mode else ""))
     else:
-        print("Filtering for sequence index 1: {}{}".format(filter_seq_index,
-            "(passthrough)" if passthrough1 else ""))
-        print("Filtering for sequence index 2: {}{}".format(filter_seq_index2,
-            "(passthrough)" if passthrough2 else ""))
-        print("Separator between index 1 and 2: {}".format(separator))
-    print("Max mismatches tolerated: {}".format(max_tolerated_mismatches))
-    print("Output filtered file: {}".format(out_filtered_path))
-    print("Output unfiltered file: {}".format(out_unfiltered_path))
+        info("Filtering for sequence index 1: {}{}".format(filter_seq_index,
+            "(passthrough)" if index_filter.passthrough1 else ""))
+        info("Filtering for sequence index 2: {}{}".format(filter_seq_index2,
+            "(passthrough)" if index_filter.passthrough2 else ""))
+        info("Separator between index 1 and 2: {}".format(separator))
+    info("Max mismatches tolerated: {}".format(index_filter.max_mismatches))
+    if args.distance!='hamming':
+        info("Mismatches counted as: {} distance (substitutions, insertions "
+             "and deletions)".format(args.distance))
+    if tiered:
+        info("Mismatches of tiers of filtered reads: {}".format(
+            ', '.join(map(str, index_filter.thresholds))))
+    info("Output filtered file{}: {}".format('s' if len(input_paths)>1 or tiered else '',
+        ', '.join(index_filter.tier_paths(out_filtered_paths)) if out_filtered_paths
+        else None))
+    info("Output unfiltered file{}: {}".format('s' if len(input_paths)>1 else '',
+        ', '.join(out_unfiltered_paths) if out_unfiltered_paths else None))
+    if args.decision_log:
+        info("Output decision log: {}".format(args.decision_log))
+    if sidecar_path and not passthrough_mode:
+        info("Sidecar index: {}".format(sidecar_path))
+    if args.checkpoint:
+        info("Checkpoint: {} (every {} s)".format(args.checkpoint,
+                                                 args.checkpoint_interval))
+    sampling = args.head is not None or args.sample is not None
+    if sampling:
+        if out_filtered_paths or out_unfiltered_paths or args.decision_log or \
+           args.stats_json:
+            parser.error("--head and --sample cannot be used with output options")
+        if tiered:
+            parser.error("several --mismatches cannot be used with --head or --sample")
+        if args.head is not None and args.head<1:
+            parser.error("--head must be at least 1")
+        if args.sample is not None and not 0<args.sample<=1:
+            parser.error("--sample must be more than 0 and at most 1")
+        if args.head is not None:
+            info("Estimating from first {} reads{}".format(args.head,
+                ' of sample' if args.sample else ''))
+        if args.sample is not None:
+            info("Estimating from sample of {} of input".format(args.sample))
+        if len(input_paths)>1:
+            info("Only the first input file is read")
+        estimate = index_filter.estimate_file(input_paths[0], args.head,
+            args.sample, functools.partial(xopen.xopen, threads=input_threads),
+            input_threads)
+        print_estimate(estimate, index_filter.max_tracked_mismatches)
+        if return_result: return(estimate.as_dict())
+        return
+
+    compresslevels = {}
+    for out_paths, out_compresslevel in (
+            (out_filtered_paths, args.filtered_compresslevel),
+            (out_unfiltered_paths, args.unfiltered_compresslevel)):
+        if out_compresslevel is not None:
+            compresslevels.update(dict.fromkeys(out_paths or [], out_compresslevel))
     if verbose>=1:
-        print("Using {} threads per open file".format(threads))
-        print("Compression level: {}".format(compresslevel))
-        print("Showing verbose level {} logging".format(verbose))
+        info("Using {} threads per input file".format(input_threads))
+        info("Compressing output with {} backend, using {} threads{}".format(
+            args.compression_backend, output_threads,
+            ' per output file' if args.compression_backend=='xopen' else ''))
+        if workers: info("Using {} worker processes".format(workers))
+        info("Compression level: {}".format(compresslevel))
+        if compresslevels:
+            info("Compression level of filtered files: {}, unfiltered files: {}".format(
+                args.filtered_compresslevel or compresslevel,
+                args.unfiltered_compresslevel or compresslevel))
+        info("Showing verbose level {} logging".format(verbose))
 
 
-    xopen_xthreads = functools.partial(xopen.xopen, threads=threads,
-                                       compresslevel = compresslevel)
+    xopen_input = functools.partial(xopen.xopen, threads=input_threads)
 
     # PROCESSING
-    total_reads = 0
-    filtered_reads = 0
-    unfiltered_reads = 0
-    max_tracked_mismatches = max(len(filter_seq_index), 
-        len(filter_seq_index2) if filter_seq_index2 else 0)
-    cumul_n_mismatches = [0 for i in range(max_tracked_mismatches + 2)]
-    # array for tracking number of mismatches (0 to indexlen,>indexlen+1)
-    # >indexlen+1 is required because we define mismatch to include extra
-    # characters from desired index OR read index, which may be longer
-    if passthrough_mode: filtered = True
-    with dnaio.open(input_path, mode='r', opener=xopen_xthreads) as input_fastq:
-        if out_filtered_path:
-            filtered_fastq = dnaio.open(out_filtered_path, mode='w', opener=xopen_xthreads)
-        else:
-            filtered_fastq = None
-        if out_unfiltered_path:
-            unfiltered_fastq = dnaio.open(out_unfiltered_path, mode='w', opener=xopen_xthreads)
-        else:
-            unfiltered_fastq = None
-        if double_index:
-            if passthrough1: index1 = "(pass)"
-            if passthrough2: index2 = "(pass)"
-        for record in input_fastq:
-            total_reads += 1
-            if passthrough_mode:
-                # always filtered
-                if verbose>=2:
-                    seqid = record.name
-                    print("{} (passthrough-mode) (filtered)".format(seqid))
-
-            else:
-                # Illimina sequence identifier in FASTQ files:
-                # see https://help.basespace.illumina.com/articles/descriptive/fastq-files/
-                # @<instrument>:<run number>:<flowcell ID>:<lane>:<tile>:<x-pos>:<y-pos> <read>:<is filtered>:<control number>:<sample number>
-                # For the Undetermined FASTQ files only, the sequence observed in the index read is written to the FASTQ header in place of the sample number. This information can be useful for troubleshooting demultiplexing.
-                # grab the sequence index, use simplistic method of value after last : for efficiency
-                seqid = record.name
-                last_colon = seqid.rfind(':')
-                if last_colon==-1:
-                    raise ValueError("no barcode detected for sequence {}".format(seqid))
-                entry_seq_index = seqid[last_colon+1:]
-
-                if not double_index:
-                    n_mismatches = abs(len(entry_seq_index)-len(filter_seq_index))
-                    if entry_seq_index!=filter_seq_index:
-                        for c1,c2 in zip(entry_seq_index,filter_seq_index):
-                            if c1!=c2: n_mismatches+=1
-                    filtered = (n_mismatches <= max_tolerated_mismatches)
-                    if verbose>=2:
-                        print("{} -> index {} -> {} mismatches ({})".format(seqid,
-                            entry_seq_index, n_mismatches,
-                            'filtered' if filtered else 'unfiltered'))
-                else:
-                    separator_pos = entry_seq_index.find(separator)
-                    if separator_pos==-1:
-                        raise ValueError("no separator detected for sequence {}".format(seqid))
-
-                    n_mismatches1 = 0
-                    if not passthrough1:
-                        index1 = entry_seq_index[:separator_pos]
-                        n_mismatches1 += abs(len(index1)-len(filter_seq_index))
-                        if index1!=filter_seq_index:
-                            for c1,c2 in zip(index1,filter_seq_index):
-                                if c1!=c2: n_mismatches1+=1
-
-                    n_mismatches2 = 0
-                    if not passthrough2:
-                        index2 = entry_seq_index[separator_pos+len(separator):]
-                        n_mismatches2 += abs(len(index2)-len(filter_seq_index2))
-                        if index2!=filter_seq_index2:
-                            for c1,c2 in zip(index2,filter_seq_index2):
-                                if c1!=c2: n_mismatches2+=1
-
-                    n_mismatches = n_mismatches1+n_mismatches2
-                    filtered = (n_mismatches <= max_tolerated_mismatches)
-                    if verbose>=2:
-                        print("{} -> {} -> index {} & {} -> {} + {} = {} mismatches ({})".format(seqid,
-                            entry_seq_index, index1, index2, 
-                            n_mismatches1, n_mismatches2, n_mismatches,
-                            'filtered' if filtered else 'unfiltered'))
-
-                if n_mismatches>max_tracked_mismatches:
-                    n_mismatches = max_tracked_mismatches+1
-                cumul_n_mismatches[n_mismatches] += 1
-            if filtered:
-                filtered_reads += 1
-                if filtered_fastq: filtered_fastq.write(record)
-            else:
-                unfiltered_reads += 1
-                if unfiltered_fastq: unfiltered_fastq.write(record)
-        if filtered_fastq: filtered_fastq.close()
-        if unfiltered_fastq: unfiltered_fastq.close()
+    stats = RunStats(args.progress) if args.stats_json or args.progress else None
+    try:
+        with OutputOpener(args.compression_backend, output_threads, compresslevel,
+                          compresslevels) as output_opener:
+            result = index_filter.filter_files(input_paths, out_filtered_paths,
+                out_unfiltered_paths, xopen_input, workers, verbose, info, stats=stats,
+                decision_log_path=args.decision_log, decompress_threads=input_threads,
+                output_opener=output_opener, sidecar_path=sidecar_path,
+                checkpoint_path=args.checkpoint,
+                checkpoint_interval=args.checkpoint_interval)
+    except BrokenPipeError:
+        if not stdout_paths: raise
+        # standard output closed by the reader (e.g. piped into `head`), so
+        # stopped quietly, as other command line tools do
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
 
 
     # OUTPUT
-    print("Total reads: {}".format(total_reads))
+    info("Total reads: {}".format(result.total))
     if passthrough_mode:
-        print("Filtered reads: {} (passthrough-mode)".format(filtered_reads))
+        info("Filtered reads: {} (passthrough-mode)".format(result.filtered))
     else:
-        print("Filtered reads: {}".format(filtered_reads))
-        print("Unfiltered reads: {}".format(unfiltered_reads))
-        for n_mismatches, cumul_mismatches in enumerate(cumul_n_mismatches):
-            print(" Reads with {}{} mismatches: {}".format(
-                '' if n_mismatches<= max_tracked_mismatches else '>=',
+        info("Filtered reads: {}".format(result.filtered))
+        info("Unfiltered reads: {}".format(result.unfiltered))
+        for n_mismatches, cumul_mismatches in enumerate(result.mismatches):
+            info(" Reads with {}{} mismatches: {}".format(
+                '' if n_mismatches<= index_filter.max_tracked_mismatches else '>=',
                 n_mismatches, cumul_mismatches))
+        for threshold, tier, filtered in result.threshold_counts():
+            info(" Filtered reads with up to {} mismatches: {} ({} in tier)".format(
+                threshold, filtered, tier))
+        if verbose>=1 and not workers:
+            print_cache_info("Index classification cache", index_filter, info)
+    if args.stats_json:
+        with xopen.xopen(args.stats_json, 'w') as stats_handle:
+            json.dump(stats.report(result, input_paths,
+                index_filter.tier_paths(out_filtered_paths or [])
+                +(out_unfiltered_paths or [])
+                +([args.decision_log] if args.decision_log else [])),
+                stats_handle, indent=1)
 
     if return_result: 
-        results = {
-            "total" : total_reads,
-            "filtered": filtered_reads,
-            "unfiltered": unfiltered_reads,
-            "mismatches": {n_mismatches : cumul_mismatches 
-                          for n_mismatches,cumul_mismatches in enumerate(cumul_n_mismatches)}
-        }
-        return(results)
+        return(result.as_dict())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+filter_illumina_index Benchmarks
+========================
+
+Generates a synthetic Illumina FASTQ file and times the script on it in a
+number of scenarios, reporting reads/s, MB/s (of uncompressed FASTQ) and peak
+memory use (RSS) for each as JSON, so that runs can be compared between
+versions.
+
+To run benchmarks with the default scenarios, use:
+|   python -m filter_illumina_index.tests.benchmark --reads 1000000 --output results.json
+
+To only generate a synthetic FASTQ file, use:
+|   python -m filter_illumina_index.tests.benchmark --generate reads.fastq.gz
+
+Barcodes are drawn from a distribution given as `BARCODE=WEIGHT` pairs, where
+`random` stands for a random barcode of the same length, e.g.
+`--barcodes GATCGTGT=0.8 AATCGTGT=0.1 random=0.1`; each base of each barcode
+is then replaced by a different base or N with probability `--error-rate`.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import xopen
+
+from filter_illumina_index.filter_illumina_index import _PROGRAM_VERSION
+
+_PROGRAM_NAME = 'filter_illumina_index.tests.benchmark'
+
+_BASES = 'ACGT'
+_SEQUENCE_POOL_SIZE = 4096
+    # reads take their sequence and quality from a pool of random ones, as
+    # only the header is examined by the script
+
+SCENARIOS = {
+    # name: (input compression, output compression, [options]); the first
+    # barcode of the distribution is filtered for, unless `--passthrough`
+    'plain_m0': ('', '', ['-m', '0']),
+    'plain_m3': ('', '', ['-m', '3']),
+    'gz_m0_t0': ('.gz', '.gz', ['-m', '0', '-t', '0']),
+    'gz_m0_t1': ('.gz', '.gz', ['-m', '0', '-t', '1']),
+    'gz_m3_t1': ('.gz', '.gz', ['-m', '3', '-t', '1']),
+    'gz_to_plain_m0': ('.gz', '', ['-m', '0']),
+    'passthrough_plain': ('', '', ['--passthrough']),
+    'passthrough_gz': ('.gz', '.gz', ['--passthrough']),
+}
+
+
+def parse_barcode_distribution(barcode_weights):
+    """
+    Parses a list of `BARCODE=WEIGHT` strings into a list of (barcode, weight)
+    tuples, with `random` as the barcode for random barcodes.
+    """
+    distribution = []
+    for barcode_weight in barcode_weights:
+        barcode, _, weight = barcode_weight.partition('=')
+        distribution.append((barcode, float(weight) if weight else 1.0))
+    return distribution
+
+
+def _random_barcode(rng, length):
+    return ''.join(rng.choice(_BASES) for _ in range(length))
+
+
+def _add_errors(rng, barcode, error_rate):
+    # substitutes each base of barcode with another base or N at error_rate
+    if not error_rate: return barcode
+    return ''.join(rng.choice('ACGTN'.replace(c, '')) if rng.random()<error_rate
+                   else c for c in barcode)
+
+
+def generate_fastq(path, n_reads, read_length=100, barcodes=(('GATCGTGT', 1.0),),
+                   separator='+', error_rate=0.0, seed=0):
+    """
+    Writes `n_reads` synthetic reads with Illumina sequence identifiers to
+    `path` (compressed according to extension). `barcodes` is a list of
+    (barcode, weight) tuples, with `random` giving a random barcode of the
+    same length as the first barcode; a barcode containing `separator` is a
+    dual index, each part of a random barcode then being random. Returns
+    the number of bytes of (uncompressed) FASTQ written.
+    """
+    rng = random.Random(seed)
+    sequence_pool = [_random_barcode(rng, read_length) for _ in range(_SEQUENCE_POOL_SIZE)]
+    quality_pool = [''.join(rng.choice('#,:FFFF') for _ in range(read_length))
+                    for _ in range(_SEQUENCE_POOL_SIZE)]
+    template = next(barcode for barcode, _ in barcodes if barcode != 'random')
+    template_parts = template.split(separator)
+    choices = [barcode for barcode, _ in barcodes]
+    weights = [weight for _, weight in barcodes]
+    n_bytes = 0
+    block = []
+    with xopen.xopen(path, mode='w', compresslevel=1, threads=0) as out_handle:
+        for read_number, barcode in enumerate(rng.choices(choices, weights, k=n_reads)):
+            if barcode == 'random':
+                parts = [_random_barcode(rng, len(part)) for part in template_parts]
+            else:
+                parts = barcode.split(separator)
+            barcode = separator.join(_add_errors(rng, part, error_rate) for part in parts)
+            pool_index = rng.randrange(_SEQUENCE_POOL_SIZE)
+            block.append('@SYNTH:1:FC0000001:1:{}:{}:{} 1:N:0:{}\n{}\n+\n{}\n'.format(
+                1101+read_number//1000000, read_number%1000000//1000, read_number%1000,
+                barcode, sequence_pool[pool_index], quality_pool[pool_index]))
+            if len(block)>=10000:
+                text = ''.join(block)
+                n_bytes += len(text)
+                out_handle.write(text)
+                block = []
+        text = ''.join(block)
+        n_bytes += len(text)
+        out_handle.write(text)
+    return n_bytes
+
+
+def run_timed(args):
+    """
+    Runs a command, returning `(wall time, user+system CPU time, peak RSS in
+    MB)`, with CPU time and peak RSS including any processes it waits for.
+    Raises `subprocess.CalledProcessError` if the command fails.
+    """
+    start_time = time.perf_counter()
+    process = subprocess.Popen(args, stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start_time
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args)
+    # ru_maxrss is in kB on Linux, bytes on macOS
+    peak_rss = rusage.ru_maxrss / (1024**2 if sys.platform == 'darwin' else 1024)
+    return wall_time, rusage.ru_utime+rusage.ru_stime, peak_rss
+
+
+def run_scenario(name, input_path, n_reads, n_bytes, index, index2, separator,
+                 work_dir, repeat=1, extra_options=()):
+    """
+    Times the script for a scenario from `SCENARIOS` on an uncompressed input
+    file (compressed first if needed), returning a dict of results for the
+    fastest of `repeat` runs.
+    """
+    input_compression, output_compression, options = SCENARIOS[name]
+    if input_compression and not os.path.exists(input_path+input_compression):
+        with open(input_path, 'rb') as input_handle, \
+             xopen.xopen(input_path+input_compression, mode='wb') as out_handle:
+            shutil.copyfileobj(input_handle, out_handle, 4*1024**2)
+    input_path += input_compression
+    if '--passthrough' in options:
+        options = [option for option in options if option != '--passthrough']
+        options += ['--index', '']
+        if index2 is not None: options += ['--separator', separator, '--index2', '']
+    else:
+        options = options + ['--index', index]
+        if index2 is not None: options += ['--separator', separator, '--index2', index2]
+    filtered_path = os.path.join(work_dir, 'filtered.fastq'+output_compression)
+    unfiltered_path = os.path.join(work_dir, 'unfiltered.fastq'+output_compression)
+    args = [sys.executable, '-m', 'filter_illumina_index.filter_illumina_index',
+            input_path, '-f', filtered_path, '-u', unfiltered_path]
+    options += list(extra_options)
+    args += options
+    runs = [run_timed(args) for _ in range(repeat)]
+    wall_time, cpu_time, peak_rss = min(runs)
+    for path in (filtered_path, unfiltered_path):
+        if os.path.exists(path): os.remove(path)
+    return {
+        "options": options,
+        "wall_s": round(wall_time, 3),
+        "cpu_s": round(cpu_time, 3),
+        "reads_per_s": round(n_reads/wall_time),
+        "mb_per_s": round(n_bytes/1e6/wall_time, 2),
+        "peak_rss_mb": round(peak_rss, 1),
+    }
+
+
+def _git_commit():
+    # commit of the working tree being benchmarked, if in a git repository
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv = None):
+    if argv is None: argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(prog=_PROGRAM_NAME,
+                                     description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--reads', type=int, default=1000000,
+                        help='Number of reads to generate (default: %(default)s)')
+    parser.add_argument('--read-length', type=int, default=100,
+                        help='Length of reads (default: %(default)s)')
+    parser.add_argument('--barcodes', nargs='+', default=['GATCGTGT=0.9', 'random=0.1'],
+                        help='Barcode distribution as BARCODE=WEIGHT pairs, '
+                        '`random` giving random barcodes; use the separator for '
+                        'dual indexes, e.g. GATCGTGT+TCTATCCT=1 (default: %(default)s)')
+    parser.add_argument('-s', '--separator', default='+',
+                        help='Separator between index 1 and 2 of dual indexes '
+                        '(default: %(default)s)')
+    parser.add_argument('-e', '--error-rate', type=float, default=0.01,
+                        help='Probability of each index base being substituted '
+                        '(default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for random number generator (default: %(default)s)')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS),
+                        default=list(SCENARIOS),
+                        help='Scenarios to run (default: all)')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='Runs of each scenario, fastest is reported '
+                        '(default: %(default)s)')
+    parser.add_argument('-x', '--extra', nargs=argparse.REMAINDER, default=[],
+                        help='Extra options passed to the script in all scenarios')
+    parser.add_argument('-d', '--work-dir',
+                        help='Directory for generated files, kept after the run '
+                        '(default: temporary directory)')
+    parser.add_argument('-o', '--output',
+                        help='Output JSON file (default: stdout)')
+    parser.add_argument('--generate', metavar='PATH',
+                        help='Only generate a synthetic FASTQ file to PATH')
+    args = parser.parse_args(argv)
+
+    barcodes = parse_barcode_distribution(args.barcodes)
+    if all(barcode == 'random' for barcode, _ in barcodes):
+        parser.error("--barcodes must include at least one barcode other than `random`")
+    generate_args = (args.reads, args.read_length, barcodes, args.separator,
+                     args.error_rate, args.seed)
+    if args.generate:
+        generate_fastq(args.generate, *generate_args)
+        return
+
+    index = next(barcode for barcode, _ in barcodes if barcode != 'random')
+    index, _, index2 = index.partition(args.separator)
+    if not index2: index2 = None
+
+    with contextlib.ExitStack() as stack:
+        if args.work_dir:
+            work_dir = args.work_dir
+            os.makedirs(work_dir, exist_ok=True)
+        else:
+            work_dir = stack.enter_context(tempfile.TemporaryDirectory(
+                prefix='filter_illumina_index_'))
+        input_path = os.path.join(work_dir, 'synthetic_reads.fastq')
+        print("Generating {} reads to {}".format(args.reads, input_path), file=sys.stderr)
+        n_bytes = generate_fastq(input_path, *generate_args)
+        results = {
+            "version": _PROGRAM_VERSION,
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "pigz": shutil.which('pigz') is not None,
+            "reads": args.reads,
+            "read_length": args.read_length,
+            "barcodes": args.barcodes,
+            "error_rate": args.error_rate,
+            "input_mb": round(n_bytes/1e6, 2),
+            "scenarios": {},
+        }
+        for name in args.scenarios:
+            print("Running scenario {}".format(name), file=sys.stderr)
+            results["scenarios"][name] = run_scenario(name, input_path, args.reads,
+                n_bytes, index, index2, args.separator, work_dir, args.repeat,
+                args.extra)
+
+    if args.output:
+        with open(args.output, 'w') as output_handle:
+            json.dump(results, output_handle, indent=1)
+    else:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -26,20 +26,66 @@ prior to packaging these in a new version:
 #   Reading fastq and fastq.gz
 #   Mismatch counting by comparing summaries (compared to expected)
 #     With different index
+#     With IUPAC and N wildcards in the index
+#     Exception for other characters in the index
+#     With edit distance, looked up in precomputed neighborhoods of the index
+#     With classification cache off or evicting
+#     With indexes classified together using numpy (if available)
 #   Writing fastq and fastq.gz to filtered/unfiltered (compared to expected)
 #     With different index and diff # tolerated mismatches
+#     Output byte-identical to expected
+#     '+name' and '\r\n' records written as dnaio writes them
+#   Filtering in worker processes (compared to expected)
 #   Exception if no barcode in non-passthrough mode
 #   Passthrough mode
 #     Correct summary, correct output
+#     Number of reads from a sidecar index, error if output is input
 #     Exception if changing number of mismatches tolerated in this mode
+#   Demultiplex mode with sample sheet
+#     Correct per-sample summary, correct per-sample output
+#     Without precomputed variants for many samples and mismatches
+#   Synthetic reads from benchmark generator filtered as expected
+#   Decision log of each read (compared to expected)
+#   Discover mode, with approximate counts within error bounds
+#   BGZF and multi-member gzip input decompressed in parallel
+#   Output compressed in-process with each backend, in gzip and zstd formats
+#   Estimates from first reads or a sample of the input, records found when
+#     seeking to blocks of input
+#   Statistics report and progress
+#   Output written by a thread for each file, with queue depth and waits
+#   IndexFilter API
+#     Classifying single reads, filtering a stream of records, filtering
+#     files with one filter reused (compared to expected)
+#   Standard input and output, with messages on stderr
+#   Batch mode, with jobs of a manifest on a process pool sharing CPUs
+#   Server mode, with requests from the client run concurrently
+#   Checkpoints, with interrupted runs resumed from plain and gzip input
+#     Warning when gzip input can't be split, so is decompressed again
+#   Paired input files filtered in lockstep
+#     Correct output for each input file, mates given same outcome
+#     Exception if read names or number of reads differ across files
 
 import unittest
 import sys
+import collections
+import concurrent.futures
 import functools
 import json
 import itertools
 import gzip
+import zlib
+import contextlib
+import io
+import os
+import subprocess
+import time
+import unittest.mock
 
+import dnaio
+import xopen
+from filter_illumina_index import filter_illumina_index
+from filter_illumina_index import client
+from filter_illumina_index.tests import benchmark
 from filter_illumina_index.filter_illumina_index import main as filter_illumina_index_main2
 filter_illumina_index_main = functools.partial(filter_illumina_index_main2, return_result = True)
 
@@ -56,6 +102,12 @@ input_test_file_fastq_double = tests_root + 'test_reads_GATCGTGT+TCTATCCT.fastq'
 input_test_file_fastq_double_2charsep = tests_root + 'test_reads_GATCGTGT++TCTATCCT.fastq'
 input_test_file_fastq_triple = tests_root + 'test_reads_GATCGTGT+TCTATCCT+ATG.fastq'
 input_test_file_invaliddouble = tests_root + 'test_reads_invaliddouble.fastq'
+input_test_file_fastq_double_r2 = tests_root + 'test_reads_GATCGTGT+TCTATCCT_R2.fastq'
+input_test_file_fastq_double_r2_mismatchednames = tests_root + 'test_reads_GATCGTGT+TCTATCCT_R2_mismatchednames.fastq'
+input_test_file_fastq_double_r2_truncated = tests_root + 'test_reads_GATCGTGT+TCTATCCT_R2_truncated.fastq'
+
+input_test_samplesheet_diffbarcodes = tests_root + 'test_samplesheet_diffbarcodes.csv'
+input_test_samplesheet_double = tests_root + 'test_samplesheet_GATCGTGT+TCTATCCT.csv'
 
 
 test_set_exitcodes = [
@@ -66,6 +118,37 @@ test_set_exitcodes = [
     (['--help'], 0),
     ([input_test_file_fastq], 2),
     (['--index','GATCGTGT'], 2),
+    ([input_test_file_fastq_double, input_test_file_fastq_double_r2, '--index','GATCGTGT',
+        '-f', tests_output_root + 'test_reads_paired_filtered.fastq'], 2), # -f per input
+    ([input_test_file_fastq_double, input_test_file_fastq_double_r2,
+        '--samplesheet',input_test_samplesheet_double,'--separator','+'], 2),
+    ([input_test_file_fastq, '--discover','-f', tests_output_root + 'test_reads_discover.fastq'], 2),
+    ([input_test_file_fastq, '--discover','0'], 2),
+    ([input_test_file_fastq, '--index','GATCGTGT','--compression-backend','pigz'], 2),
+    ([input_test_file_fastq, '--index','GATCGTGT','--head','10','-f',
+        tests_output_root + 'test_reads_head.fastq'], 2),
+    ([input_test_file_fastq, '--index','GATCGTGT','--sample','1.5'], 2),
+    ([input_test_file_fastq, input_test_file_fastq, '--index','GATCGTGT','--sidecar'], 2),
+    ([input_test_file_fastq, '--index','GATCGTGT','--sidecar','-vv'], 2),
+    ([input_test_file_fastq, '--index','GATCGTGT','-m','0,1','-f',
+        tests_output_root + 'test_reads_tiers.fastq'], 2),
+    ([input_test_file_fastq, '--index','GATCGTGT','-m','0,x'], 2),
+    (['-', '-', '--index','GATCGTGT'], 2), # standard input more than once
+    ([input_test_file_fastq, '--index','GATCGTGT','-f','-','-u','-'], 2), # stdout more than once
+    (['-', '--index','GATCGTGT','--sidecar'], 2), # sidecar index of standard input
+    (['--batch', tests_root + 'missing.csv', input_test_file_fastq], 2), # batch and input
+    (['--batch', tests_root + 'missing.csv', '--cpus', '0'], 2),
+    (['--serve', tests_output_root + 'test.sock', input_test_file_fastq], 2), # serve and input
+    (['--serve', tests_output_root + 'test.sock', '--max-concurrent', '0'], 2),
+    ([input_test_file_fastq, '--index','GATCGTGT','--checkpoint',
+        tests_output_root + 'test.ckpt','-f','-'], 2), # checkpoint and stdout
+    ([input_test_file_fastq, '--index','GATCGTGT','--checkpoint',
+        tests_output_root + 'test.ckpt','--checkpoint-interval','0'], 2),
+    ([input_test_file_diffbarcodes, '--samplesheet',input_test_samplesheet_diffbarcodes,
+        '--distance','levenshtein'], 2),
+    ([input_test_file_fastq, '--index','GATCGTGT','--distance','jaro'], 2),
+    ([input_test_file_fastq, '--index','-u',input_test_file_fastq], 2), # output is input
+    ([input_test_file_fastq, '--index','GATCGTGT','-f',input_test_file_fastq], 2),
 ]
 
 test_sets_vs_summary = [
@@ -87,6 +170,31 @@ test_sets_vs_summary = [
     ([input_test_file_diffbarcodes, '--index','TGACCAAT','-vv'],'test_reads_diffbarcodes_results_TGACCAAT.json'),
     ([input_test_file_diffbarcodes, '--index','NNNCCAAT','-vv'],'test_reads_diffbarcodes_results_NNNCCAAT.json'),
 
+    # test classification cache turned off or evicting on every new index gives same results
+    ([input_test_file_diffbarcodes, '--index','TGACCAAT','-vv','--cache-size','0'],
+        'test_reads_diffbarcodes_results_TGACCAAT.json', False),
+    ([input_test_file_diffbarcodes, '--index','TGACCAAT','-vv','--cache-size','1'],
+        'test_reads_diffbarcodes_results_TGACCAAT.json', False),
+    ([input_test_file_fastq_double, '--index','NNNCGTGT','--separator','+','--index2','NNNATCCT','-vv','-m 2','--cache-size','2'],
+        'test_reads_GATCGTGT+TCTATCCT_results_NNNCGTGT+NNNATCCT_m2.json', False),
+    ([input_test_file_diffbarcodes, '--samplesheet',input_test_samplesheet_diffbarcodes,'-vv','-m 3','--cache-size','1'],
+        'test_reads_diffbarcodes_results_demux_m3.json', False),
+
+    # test filtering with a sidecar index (built by the first, reused by the
+    # others) gives same results
+    ([input_test_file_diffbarcodes, '--index','TGACCAAT','-m 1','--sidecar',
+        tests_output_root + 'test_reads_diffbarcodes.fastq.fii'],
+        'test_reads_diffbarcodes_results_TGACCAAT_m1.json', False),
+    ([input_test_file_diffbarcodes, '--index','NNNCCAAT','-m 3','--sidecar',
+        tests_output_root + 'test_reads_diffbarcodes.fastq.fii'],
+        'test_reads_diffbarcodes_results_NNNCCAAT_m3.json', False),
+
+    # test filtering in worker processes gives same results
+    ([input_test_file_fastq_double, '--index','NNNCGTGT','--separator','+','--index2','NNNATCCT','-vv','-m 2','--workers','2'],
+        'test_reads_GATCGTGT+TCTATCCT_results_NNNCGTGT+NNNATCCT_m2.json', False),
+    ([input_test_file_invalidbarcodes, '--index','','-vv','--workers','2'],
+        'test_reads_invalidbarcodes_passthrough.json', False),
+
     # MISMATCH FILTER/UNFILTER TESTS
     # test number of filtered/unfiltered with diff mismatch tolerances
     ([input_test_file_diffbarcodes, '--index','TGACCAAT','-vv','-m 1'],'test_reads_diffbarcodes_results_TGACCAAT_m1.json'),
@@ -109,6 +217,8 @@ test_sets_vs_summary = [
     ([input_test_file_diffbarcodes, '--index','NNNCCAAT','-vv','-m 10'],'test_reads_diffbarcodes_results_NNNCCAAT_m10.json'),
     ([input_test_file_diffbarcodes, '--index','TGACCAAT','-vv','-m 20'],'test_reads_diffbarcodes_results_TGACCAAT_m20.json'),
     ([input_test_file_diffbarcodes, '--index','NNNCCAAT','-vv','-m 20'],'test_reads_diffbarcodes_results_NNNCCAAT_m20.json'),
+    # test several thresholds of mismatches
+    ([input_test_file_diffbarcodes, '--index','TGACCAAT','-vv','-m','0,1,3'],'test_reads_diffbarcodes_results_TGACCAAT_m0,1,3.json'),
 
     # for double index
     # test number of filtered/unfiltered with diff mismatch tolerances
@@ -163,6 +273,9 @@ test_sets_vs_summary = [
     # PASSTHROUGH MODE
     ([input_test_file_invalidbarcodes, '--index','-vv'],'test_reads_invalidbarcodes_passthrough.json'),
     ([input_test_file_invalidbarcodes, '--index','','-vv'],'test_reads_invalidbarcodes_passthrough.json', False),
+    # passthrough without -vv does not parse records
+    ([input_test_file_invalidbarcodes, '--index',''],'test_reads_invalidbarcodes_passthrough.json', False),
+    ([input_test_file_fastq_gz, '--index','','-v'],'test_reads_GATCGTGT_results_passthrough.json'),
         # test for error in non-passhtrough mode under exception tests
     
     ([input_test_file_fastq_double, '--index','','--separator','+','--index2','TCTATCCT','-vv','-m 1'],
@@ -170,6 +283,37 @@ test_sets_vs_summary = [
     ([input_test_file_fastq_double, '--index','GATCGTGT','--separator','+','--index2','','-vv','-m 1'],
         'test_reads_GATCGTGT+TCTATCCT_results_GATCGTGT+pass_m1.json'),
 
+    # DEMULTIPLEX MODE
+    # sampleC is 1 mismatch from sampleA for one read, so ambiguous with -m 1
+    ([input_test_file_diffbarcodes, '--samplesheet',input_test_samplesheet_diffbarcodes,'-vv','-m 0'],
+        'test_reads_diffbarcodes_results_demux_m0.json'),
+    ([input_test_file_diffbarcodes, '--samplesheet',input_test_samplesheet_diffbarcodes,'-vv','-m 1'],
+        'test_reads_diffbarcodes_results_demux_m1.json'),
+    ([input_test_file_diffbarcodes, '--samplesheet',input_test_samplesheet_diffbarcodes,'-vv','-m 3'],
+        'test_reads_diffbarcodes_results_demux_m3.json'),
+    ([input_test_file_fastq_double, '--samplesheet',input_test_samplesheet_double,'--separator','+','-vv','-m 1'],
+        'test_reads_GATCGTGT+TCTATCCT_results_demux_m1.json'),
+    ([input_test_file_fastq_triple, '--samplesheet',input_test_samplesheet_double,'--separator','+','-vv','-m 3'],
+        'test_reads_GATCGTGT+TCTATCCT+ATG_results_demux_m3.json'),
+
+    # SAMPLING
+    ([input_test_file_fastq_double, '--index','GATCGTGT','--separator','+','--index2','TCTATCCT',
+        '-m 1','--head','20'],
+        'test_reads_GATCGTGT+TCTATCCT_results_GATCGTGT+TCTATCCT_m1_head20.json'),
+    ([input_test_file_fastq_gz, '--index','GATCGTGT','--sample','0.5'],
+        'test_reads_GATCGTGT_results_GATCGTGT_m0_sample.json'),
+
+    # DISCOVER MODE
+    ([input_test_file_diffbarcodes, '--discover','3','--index','NNNCCAAT'],
+        'test_reads_diffbarcodes_results_discover_NNNCCAAT.json'),
+    ([input_test_file_fastq_double, '--discover','--separator','+','--index','GATCGTGT',
+        '--index2','TCTATCCT'],
+        'test_reads_GATCGTGT+TCTATCCT_results_discover_GATCGTGT+TCTATCCT.json'),
+    # fewer indexes tracked than distinct, so approximate counts
+    ([input_test_file_fastq_double, '--discover','3','--discover-capacity','4',
+        '--separator','+','--index2','ACTATCCT'],
+        'test_reads_GATCGTGT+TCTATCCT_results_discover_c4.json'),
+
 ]
 
 test_sets_vs_output = [
@@ -249,6 +393,13 @@ test_sets_vs_output = [
       'test_reads_GATCGTGT+TCTATCCT_unfiltered_GATCGTGT+TCTATCCT_m5.fastq')
     ), 
 
+    # filtering in worker processes
+    ([input_test_file_fastq_double, '--index','GATCGTGT','--separator','+',
+        '--index2','TCTATCCT','-m 1','--workers','2'],
+     ('test_reads_GATCGTGT+TCTATCCT_filtered_GATCGTGT+TCTATCCT_m1.fastq',
+      'test_reads_GATCGTGT+TCTATCCT_unfiltered_GATCGTGT+TCTATCCT_m1.fastq'), False
+    ),
+
     # tests of passthrough output
     ([input_test_file_invalidbarcodes, '--index','-vv'],
      ('test_reads_invalidbarcodes_passthrough_filtered.fastq.gz',
@@ -256,6 +407,19 @@ test_sets_vs_output = [
      ),
     ),
 
+    # passthrough without -vv copies or recompresses input without parsing
+    ([input_test_file_invalidbarcodes, '--index'],
+     ('test_reads_invalidbarcodes_passthrough_filtered.fastq.gz',
+      'test_reads_invalidbarcodes_passthrough_unfiltered.fastq',
+     ), False
+    ),
+    ([input_test_file_fastq_gz, '--index', '-v'],
+     ('test_reads_GATCGTGT_passthrough_filtered.fastq', None),
+    ),
+    ([input_test_file_fastq_gz, '--index', '-v'],
+     ('test_reads_GATCGTGT_passthrough_filtered.fastq.gz', None), False
+    ),
+
     # double index pass
     ([input_test_file_fastq_double, '--index','','--separator','+',
         '--index2','TCTATCCT','-vv','-m 0'],
@@ -270,6 +434,67 @@ test_sets_vs_output = [
 
 ]
 
+test_sets_paired_output = [
+    # tuples of ([options], [(expected filtered file, expected unfiltered file)], [generate])
+    # with a pair of expected files for each input file
+    ([input_test_file_fastq_double, input_test_file_fastq_double_r2, '--index','GATCGTGT',
+        '--separator','+','--index2','TCTATCCT','-vv','-m 1'],
+     [('test_reads_GATCGTGT+TCTATCCT_filtered_GATCGTGT+TCTATCCT_m1.fastq',
+       'test_reads_GATCGTGT+TCTATCCT_unfiltered_GATCGTGT+TCTATCCT_m1.fastq'),
+      ('test_reads_GATCGTGT+TCTATCCT_R2_filtered_GATCGTGT+TCTATCCT_m1.fastq',
+       'test_reads_GATCGTGT+TCTATCCT_R2_unfiltered_GATCGTGT+TCTATCCT_m1.fastq')], False
+    ),
+    ([input_test_file_fastq_double_r2, input_test_file_fastq_double, input_test_file_fastq_double_r2,
+        '--index','GATCGTGT','--separator','+','--index2','TCTATCCT','-m 1','--workers','2'],
+     [('test_reads_GATCGTGT+TCTATCCT_R2_filtered_GATCGTGT+TCTATCCT_m1.fastq',
+       'test_reads_GATCGTGT+TCTATCCT_R2_unfiltered_GATCGTGT+TCTATCCT_m1.fastq'),
+      ('test_reads_GATCGTGT+TCTATCCT_filtered_GATCGTGT+TCTATCCT_m1.fastq',
+       'test_reads_GATCGTGT+TCTATCCT_unfiltered_GATCGTGT+TCTATCCT_m1.fastq'),
+      ('test_reads_GATCGTGT+TCTATCCT_R2_filtered_GATCGTGT+TCTATCCT_m1.fastq',
+       'test_reads_GATCGTGT+TCTATCCT_R2_unfiltered_GATCGTGT+TCTATCCT_m1.fastq')], False
+    ),
+    ([input_test_file_fastq_double_r2, input_test_file_fastq_double,
+        '--index','GATCGTGT','--separator','+','--index2','TCTATCCT','-m 1'],
+     [('test_reads_GATCGTGT+TCTATCCT_R2_filtered_GATCGTGT+TCTATCCT_m1.fastq',
+       'test_reads_GATCGTGT+TCTATCCT_R2_unfiltered_GATCGTGT+TCTATCCT_m1.fastq'),
+      (None, None)]
+    ),
+]
+
+test_sets_decision_log = [
+    # tuples of ([options], expected decision log file, [generate])
+    ([input_test_file_fastq_double, '--index','GATCGTGT','--separator','+',
+        '--index2','TCTATCCT','-m 1'],
+     'test_reads_GATCGTGT+TCTATCCT_decisions_GATCGTGT+TCTATCCT_m1.tsv'
+    ),
+    ([input_test_file_fastq_double, input_test_file_fastq_double_r2, '--index','GATCGTGT',
+        '--separator','+','--index2','TCTATCCT','-m 1','--workers','2'],
+     'test_reads_GATCGTGT+TCTATCCT_decisions_GATCGTGT+TCTATCCT_m1.tsv.gz', False
+    ),
+    ([input_test_file_diffbarcodes, '--index','NNNCCAAT','-m 3'],
+     'test_reads_diffbarcodes_decisions_NNNCCAAT_m3.tsv'
+    ),
+    ([input_test_file_invalidbarcodes, '--index'],
+     'test_reads_invalidbarcodes_decisions_passthrough.tsv'
+    ),
+]
+
+test_sets_demux_output = [
+    # tuples of ([options], output file template, [samples], expected unassigned file)
+    # expected output for each sample has the name given by the template;
+    # unassigned file can be None in which case not checked against
+    ([input_test_file_fastq_double, '--samplesheet',input_test_samplesheet_double,
+        '--separator','+','-vv','-m 1'],
+     'test_reads_GATCGTGT+TCTATCCT_demux_{sample}_m1.fastq', ['S1', 'S2'],
+     'test_reads_GATCGTGT+TCTATCCT_demux_unassigned_m1.fastq'
+    ),
+    ([input_test_file_fastq_double, '--samplesheet',input_test_samplesheet_double,
+        '--separator','+','-vv','-m 0'],
+     'test_reads_GATCGTGT+TCTATCCT_demux_{sample}_m0.fastq.gz', ['S1', 'S2'],
+     None
+    ),
+]
+
 exception_test_sets = [
     # tuples of (options, exception, expected exception regex)
     ([input_test_file_invalidbarcodes, '--index','','--mismatches','1','-vv'],
@@ -281,10 +506,41 @@ exception_test_sets = [
     ([input_test_file_invaliddouble, '--index','GATCGTGT','--separator','+','-vv'],
         ValueError, "both"), # need both index/seperator
     ([input_test_file_invaliddouble, '--index','GATCGTGT','--separator','+','--index2','TCTATCCT','-vv'],
-        ValueError, "no separator") # failure to find barcode
+        ValueError, "no separator"), # failure to find barcode
+    ([input_test_file_invalidbarcodes, '--index','TGACCAAT','--workers','2'],
+        ValueError, "no barcode"), # failure to find barcode in worker process
+    ([input_test_file_fastq, '--index','GATCGTGt'],
+        ValueError, "other than A, C, G, T and IUPAC codes .*: t"), # not a base or wildcard
+    ([input_test_file_fastq_double, '--index','GATCGTGT','--separator','+','--index2','TCTATC.T'],
+        ValueError, "other than A, C, G, T and IUPAC codes .*: \\."), # not a base or wildcard
+    ([input_test_file_fastq_double, '--samplesheet',input_test_samplesheet_double,'-vv'],
+        ValueError, "both"), # need separator for sample sheet with index2
+    ([input_test_file_invaliddouble, '--samplesheet',input_test_samplesheet_double,'--separator','+','-vv'],
+        ValueError, "no separator"), # failure to find separator in demultiplex mode
+    ([input_test_file_fastq_double, input_test_file_fastq_double_r2_mismatchednames,
+        '--index','GATCGTGT','--separator','+','--index2','TCTATCCT'],
+        dnaio.FileFormatError, "don't match"), # paired reads out of step
+    ([input_test_file_fastq_double, input_test_file_fastq_double_r2_truncated,
+        '--index','GATCGTGT','--separator','+','--index2','TCTATCCT'],
+        dnaio.FileFormatError, "different numbers"), # paired file with fewer reads
+    ([input_test_file_fastq_double, input_test_file_fastq_double_r2_truncated, '--index'],
+        dnaio.FileFormatError, "different numbers"), # paired file with fewer reads, passthrough
 ]
 
 
+def write_bgzf(path, data, block_size):
+    # writes data as a BGZF file with blocks of block_size uncompressed bytes,
+    # followed by the empty end of file block
+    with open(path, 'wb') as out_handle:
+        for start in list(range(0, len(data), block_size))+[len(data)]:
+            block = data[start:start+block_size]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            deflated = compressor.compress(block)+compressor.flush()
+            out_handle.write(b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+                + (len(deflated)+25).to_bytes(2, 'little') + deflated
+                + zlib.crc32(block).to_bytes(4, 'little') + len(block).to_bytes(4, 'little'))
+
+
 class TestFilerIlluminaIndex(unittest.TestCase):
     def test_exitcodes(self):
         for test_set in test_set_exitcodes:
@@ -320,6 +576,604 @@ class TestFilerIlluminaIndex(unittest.TestCase):
                 self.assertEqual(test_json_safe, expected_result,'Mismatch results {} vs {}'.format(
                     test_json_safe, expected_result))
 
+    @unittest.skipIf(filter_illumina_index.np is None, "numpy not available")
+    def test_batch_classification(self):
+        # classifying all indexes in each chunk together gives same results
+        with unittest.mock.patch.object(filter_illumina_index, '_BATCH_MIN_INDEXES', 1):
+            self.test_results_summary()
+            self.test_decision_log()
+            self.test_errors()
+            self.test_edit_distance()
+
+    def test_count_mismatches(self):
+        # wildcards in the filter index match any base, Ns in the read index
+        # are mismatches, extra bases of either count as mismatches
+        for entry_seq_index, filter_seq_index, expected in [
+                ('GATCGTGT', 'GATCGTGT', 0), ('GATCGTGT', 'AATCGTGA', 2),
+                ('GATCGTGT', 'NNNCGTGT', 0), ('NATCGTGT', 'GATCGTGT', 1),
+                ('NATCGTGT', 'NATCGTGT', 0), ('GATCGTGT', 'RYWSKMBV', 0),
+                ('GATCGTGT', 'DHNN', 4), ('GATCG', 'GATCGTGT', 3),
+                ('GATCGTGTAA', 'GATCGTGT', 2), ('gatcgtgt', 'GATCGTGT', 8),
+                ('', '', 0), ('GATC', '', 4)]:
+            with self.subTest(entry_seq_index = entry_seq_index,
+                              filter_seq_index = filter_seq_index):
+                self.assertEqual(filter_illumina_index.count_mismatches(
+                    entry_seq_index, filter_seq_index), expected)
+                self.assertEqual(filter_illumina_index.count_mismatches(
+                    entry_seq_index.encode(),
+                    filter_illumina_index.pack_index(filter_seq_index)), expected)
+
+    def test_edit_distance(self):
+        # an inserted or deleted base is one edit, with characters matching as
+        # for counting mismatches; indexes in the neighborhood have the same
+        # edit distance
+        for entry_seq_index, filter_seq_index, expected in [
+                ('GATCGTGT', 'GATCGTGT', 0), ('GATCGTGT', 'AATCGTGA', 2),
+                ('GTCGTGT', 'GATCGTGT', 1), ('GAATCGTGT', 'GATCGTGT', 1),
+                ('ATCGTGTA', 'GATCGTGT', 2), ('GATCGTGT', 'NNNCGTGT', 0),
+                ('NATCGTGT', 'GATCGTGT', 1), ('NATCGTGT', 'NATCGTGT', 0),
+                ('GATCGTGT', 'DHNN', 4), ('GATCG', 'GATCGTGT', 3),
+                ('gatcgtgt', 'GATCGTGT', 8), ('', '', 0), ('GATC', '', 4)]:
+            with self.subTest(entry_seq_index = entry_seq_index,
+                              filter_seq_index = filter_seq_index):
+                self.assertEqual(filter_illumina_index.edit_distance(
+                    entry_seq_index, filter_seq_index), expected)
+                neighborhood = filter_illumina_index.edit_neighborhood(filter_seq_index, 2)
+                self.assertEqual(neighborhood.get(entry_seq_index.encode()),
+                                 expected if expected<=2 and 'g' not in entry_seq_index
+                                 and 'DH' not in filter_seq_index else None)
+        # every index of up to 6 bases within 2 edits is in the neighborhood
+        indexes = [''.join(bases) for length in range(7)
+                   for bases in itertools.product('ACGTN', repeat = length)]
+        for filter_seq_index in ['GATC', 'GANC']:
+            with self.subTest(filter_seq_index = filter_seq_index):
+                neighborhood = filter_illumina_index.edit_neighborhood(filter_seq_index, 2)
+                self.assertEqual(neighborhood, {index.encode(): n_edits
+                    for index, n_edits in ((index, filter_illumina_index.edit_distance(
+                    index, filter_seq_index)) for index in indexes) if n_edits<=2})
+        # only whole numbers of edits kept within max_size
+        neighborhood = filter_illumina_index.edit_neighborhood('GATCGTGT', 2, 1000)
+        self.assertEqual(set(neighborhood.values()), {0, 1})
+        # indexes with an inserted or deleted base filtered
+        for distance, expected_classifications in [
+                ('hamming', [(0, 0, True), (7, 0, False), (1, 0, True), (1, 7, False)]),
+                ('levenshtein', [(0, 0, True), (1, 0, True), (1, 0, True), (1, 2, False)])]:
+            with self.subTest(distance = distance):
+                index_filter = filter_illumina_index.IndexFilter('GATCGTGT', 'TCTATCCT',
+                    '+', 1, distance = distance)
+                self.assertEqual([index_filter.classify('read 1:N:0:' + index) for index
+                    in ['GATCGTGT+TCTATCCT', 'GTCGTGT+TCTATCCT', 'GATCGTGTA+TCTATCCT',
+                        'GATNGTGT+CTATCCTA']], expected_classifications)
+        # same classification of reads in files, with edit distances counted
+        test_input_path = tests_output_root + 'test_reads_indels.fastq'
+        test_output_path = tests_output_root + 'test_reads_indels_filtered.fastq'
+        records = [b'@r%d 1:N:0:%s\nACGT\n+\nFFFF\n' % (i, index) for i, index in
+                   enumerate([b'GATCGTGT', b'GTCGTGT', b'GAATCGTGT', b'ATCGTGTA',
+                              b'GATCGTGT', b'CCCC', b'GATCGTG'])]
+        with open(test_input_path, 'wb') as out_handle:
+            out_handle.write(b''.join(records))
+        index_filter = filter_illumina_index.IndexFilter('GATCGTGT', max_mismatches = 1,
+                                                         distance = 'levenshtein')
+        test_result = index_filter.filter_files(test_input_path, test_output_path)
+        self.assertEqual(test_result.mismatches, [2, 3, 1, 0, 0, 0, 0, 1, 0, 0])
+        with open(test_output_path, 'rb') as output_handle:
+            self.assertEqual(output_handle.read(), b''.join(records[:3]+records[4:5]+records[6:]))
+        with self.assertRaisesRegex(ValueError, "unknown distance"):
+            filter_illumina_index.IndexFilter('GATCGTGT', distance = 'jaro')
+
+    def test_demux_wildcards(self):
+        # samples with many wildcards are matched without precomputed
+        # variants, with the same assignments
+        samples = [('sampleA', 'TGACCAAT', None), ('sampleB', 'NNNCCAAT', None),
+                   ('sampleC', 'NNNNNAAA', None)]
+        indexes = ['TGACCAAT', 'AAACCAAT', 'TTTTTAAA', 'TGACCAAA', 'NGACCAAT', 'CCCC']
+        expected_matches = [(filter_illumina_index._AMBIGUOUS, 0), (1, 0), (2, 0),
+                            (2, 0), (1, 0), (None, None)]
+        for max_wildcards in [8, 4]:
+            with self.subTest(max_wildcards = max_wildcards), \
+                 unittest.mock.patch.object(filter_illumina_index,
+                                            '_DEMUX_MAX_WILDCARDS', max_wildcards):
+                sample_table = filter_illumina_index.SampleIndexTable(samples, 1)
+                self.assertEqual(sample_table.precomputed, max_wildcards == 8)
+                self.assertEqual([sample_table.lookup(index) for index in indexes],
+                                 expected_matches)
+        # characters other than bases and wildcards, which would match nothing
+        with self.assertRaisesRegex(ValueError, "IUPAC codes .*: X"):
+            filter_illumina_index.SampleIndexTable(samples+[('sampleD', 'TGAXCAAT', None)], 1)
+
+    def test_demux_max_variants(self):
+        # a large sample sheet with many mismatches is matched without a
+        # precomputed table, with the same assignments as with one
+        rng = benchmark.random.Random(1)
+        samples = [('sample{}'.format(i), benchmark._random_barcode(rng, 8),
+                    benchmark._random_barcode(rng, 8)) for i in range(96)]
+        self.assertGreater(filter_illumina_index.SampleIndexTable.count_variants(samples, 3),
+                           filter_illumina_index._DEMUX_MAX_VARIANTS)
+        sample_table = filter_illumina_index.SampleIndexTable(samples, 3, '+')
+        self.assertFalse(sample_table.precomputed)
+        self.assertEqual(sample_table.table, {})
+        self.assertEqual(sample_table.lookup(samples[5][1]+'+'+samples[5][2]), (5, 0))
+        indexes = ['+'.join(benchmark._add_errors(rng, seq_index, 0.1)
+                            for seq_index in sample[1:]) for sample in samples[:4]*5]
+        expected_matches = [filter_illumina_index.SampleIndexTable(samples[:4], 1, '+').lookup(index)
+                            for index in indexes]
+        with unittest.mock.patch.object(filter_illumina_index, '_DEMUX_MAX_VARIANTS', 100):
+            sample_table = filter_illumina_index.SampleIndexTable(samples[:4], 1, '+')
+            self.assertFalse(sample_table.precomputed)
+            self.assertEqual([sample_table.lookup(index) for index in indexes], expected_matches)
+
+    @unittest.skipIf(filter_illumina_index.np is None, "numpy not available")
+    def test_count_mismatches_batch(self):
+        entry_seq_indexes = [b'GATCGTGT', b'AATCGTGT', b'GATCG', b'GATCGTGTAA',
+                             b'NNNNNNNN', b'', b'G\0TCGTGT', b'TCGTGTGA']
+        for filter_seq_index in ['GATCGTGT', 'NNNCGTGT', 'GATCGTGTA', 'GRYCGTGT', 'GA', '']:
+            with self.subTest(filter_seq_index = filter_seq_index):
+                n_mismatches = filter_illumina_index.count_mismatches_batch(
+                    entry_seq_indexes, filter_seq_index.encode())
+                expected_n_mismatches = [filter_illumina_index.count_mismatches(
+                    entry_seq_index.decode(), filter_seq_index)
+                    for entry_seq_index in entry_seq_indexes]
+                self.assertEqual(n_mismatches.tolist(), expected_n_mismatches)
+                n_edits = filter_illumina_index.edit_distance_batch(
+                    entry_seq_indexes, filter_seq_index.encode())
+                expected_n_edits = [filter_illumina_index.edit_distance(
+                    entry_seq_index, filter_seq_index)
+                    for entry_seq_index in entry_seq_indexes]
+                self.assertEqual(n_edits.tolist(), expected_n_edits)
+
+    def test_space_saving(self):
+        # counts of tracked items within error bounds, untracked items no more
+        # frequent than lowest count, for batches of a skewed stream
+        rng = benchmark.random.Random(1)
+        items = rng.choices(range(200), weights=[1/(i+1) for i in range(200)], k=5000)
+        for capacity in [1, 10, 50, 500]:
+            with self.subTest(capacity = capacity):
+                summary = filter_illumina_index.SpaceSaving(capacity)
+                for start in range(0, len(items), 300):
+                    summary.update(collections.Counter(items[start:start+300]))
+                true_counts = collections.Counter(items)
+                self.assertEqual(summary.total, len(items))
+                self.assertLessEqual(len(summary.counts), capacity)
+                for item, count, error in summary.top():
+                    self.assertLessEqual(count-error, true_counts[item])
+                    self.assertLessEqual(true_counts[item], count)
+                for item, true_count in true_counts.items():
+                    if item not in summary.counts:
+                        self.assertLessEqual(true_count, summary.min_count)
+                self.assertEqual(summary.top(1)[0][0], 0)
+
+    def test_parallel_gzip(self):
+        # BGZF and multi-member gzip input decompressed in parallel, with
+        # sequential fallback where split at a false member boundary
+        with open(input_test_file_fastq_double, 'rb') as input_handle:
+            data = input_handle.read()
+        fake_header = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+        bgzf_path = tests_output_root + 'test_reads_GATCGTGT+TCTATCCT_bgzf.fastq.gz'
+        write_bgzf(bgzf_path, data, 500)
+        members_path = tests_output_root + 'test_reads_GATCGTGT+TCTATCCT_members.fastq.gz'
+        with open(members_path, 'wb') as out_handle:
+            for start in range(0, len(data), 700):
+                out_handle.write(gzip.compress(data[start:start+700]))
+        stored_path = tests_output_root + 'test_reads_fakeheader.gz'
+        stored_data = b'A'*100 + fake_header + b'C'*100
+        with open(stored_path, 'wb') as out_handle:
+            out_handle.write(gzip.compress(stored_data, compresslevel=0))
+            out_handle.write(gzip.compress(data))
+        single_path = tests_output_root + 'test_reads_single.gz'
+        with open(single_path, 'wb') as out_handle:
+            out_handle.write(gzip.compress(data))
+        for path, expected_format, expected_data, expected_fallback in [
+                (bgzf_path, 'bgzf', data, False),
+                (members_path, 'multi-member', data, False),
+                (stored_path, 'multi-member', stored_data+data, True),
+                (single_path, None, None, None)]:
+            with self.subTest(path = path):
+                gzip_format = filter_illumina_index.splittable_gzip_format(path)
+                self.assertEqual(gzip_format, expected_format)
+                if gzip_format is None: continue
+                for segment_size in [150, 1000, 10**6]:
+                    with filter_illumina_index.ParallelGzipReader(path, gzip_format, 2,
+                            segment_size) as reader:
+                        self.assertEqual(reader.read(), expected_data)
+                        if segment_size==150:
+                            self.assertEqual(reader.sequential_fallback, expected_fallback)
+        with open(members_path, 'rb') as input_handle:
+            truncated_data = input_handle.read()[:-5]
+        truncated_path = tests_output_root + 'test_reads_truncated.gz'
+        with open(truncated_path, 'wb') as out_handle:
+            out_handle.write(truncated_data)
+        with self.assertRaises(EOFError):
+            with filter_illumina_index.ParallelGzipReader(truncated_path,
+                    'multi-member', 2, 150) as reader:
+                reader.read()
+        # filtered output same as from uncompressed input
+        for path in [bgzf_path, members_path]:
+            with self.subTest(path = path):
+                test_output_path = tests_output_root + 'test_reads_parallel_filtered.fastq'
+                filter_illumina_index_main([path, '--index','GATCGTGT','--separator','+',
+                    '--index2','TCTATCCT','-m','1','--threads','2',
+                    '-f', test_output_path])
+                self.helper_compare_bytes(tests_results_root +
+                    'test_reads_GATCGTGT+TCTATCCT_filtered_GATCGTGT+TCTATCCT_m1.fastq',
+                    test_output_path)
+
+    def test_compression_backends(self):
+        # output compressed in blocks in-process same when decompressed, for
+        # each backend and output format, with shared or no threads
+        expected_filtered_path = tests_results_root + \
+            'test_reads_GATCGTGT+TCTATCCT_filtered_GATCGTGT+TCTATCCT_m1.fastq'
+        expected_unfiltered_path = tests_results_root + \
+            'test_reads_GATCGTGT+TCTATCCT_unfiltered_GATCGTGT+TCTATCCT_m1.fastq'
+        for backend in ['isal', 'zlib-ng', 'zlib', 'xopen']:
+            for extension, output_threads in [('.gz', '2'), ('.gz', '0'), ('.zst', '2')]:
+                with self.subTest(backend = backend, extension = extension,
+                                  output_threads = output_threads):
+                    if backend=='isal' and filter_illumina_index.igzip is gzip or \
+                       backend=='zlib-ng' and filter_illumina_index.gzip_ng is None or \
+                       extension=='.zst' and filter_illumina_index.zstd is None:
+                        self.skipTest("{} not available".format(backend))
+                    test_filtered_path = tests_output_root + 'test_reads_backend_filtered.fastq' + extension
+                    test_unfiltered_path = tests_output_root + 'test_reads_backend_unfiltered.fastq' + extension
+                    filter_illumina_index_main([input_test_file_fastq_double,
+                        '--index','GATCGTGT','--separator','+','--index2','TCTATCCT','-m','1',
+                        '--compression-backend', backend, '--output-threads', output_threads,
+                        '--unfiltered-compresslevel', '1',
+                        '-f', test_filtered_path, '-u', test_unfiltered_path])
+                    for expected_path, test_path in [(expected_filtered_path, test_filtered_path),
+                                                     (expected_unfiltered_path, test_unfiltered_path)]:
+                        with open(expected_path, 'rb') as expected_handle, \
+                             xopen.xopen(test_path, 'rb') as test_handle:
+                            self.assertEqual(test_handle.read(), expected_handle.read())
+        # blocks make a multi-member gzip file, which can be read in parallel
+        test_output_path = tests_output_root + 'test_reads_blocks.fastq.gz'
+        with open(input_test_file_fastq_double, 'rb') as input_handle:
+            data = input_handle.read()
+        with filter_illumina_index.BlockCompressingWriter(open(test_output_path, 'wb'),
+                filter_illumina_index.block_compressor(test_output_path, 'zlib', 6),
+                block_size = 1000) as writer:
+            for start in range(0, len(data), 300):
+                writer.write(data[start:start+300])
+        self.assertEqual(filter_illumina_index.splittable_gzip_format(test_output_path),
+                         'multi-member')
+        with gzip.open(test_output_path, 'rb') as test_handle:
+            self.assertEqual(test_handle.read(), data)
+
+    def test_sampling(self):
+        # blocks of input read with seeking have each record once, found
+        # despite quality lines starting with '@'
+        test_output_path = tests_output_root + 'test_reads_sampling.fastq'
+        records = [b'@r%d:1:N:0:GATCGTGT\nACGT\n+\n@@@%s\n' % (i, b'@I'[i%2:i%2+1])
+                   for i in range(200)]
+        with open(test_output_path, 'wb') as out_handle:
+            out_handle.write(b''.join(records))
+        for chunk_size in [30, 100, 1000, 10**6]:
+            with self.subTest(chunk_size = chunk_size):
+                with open(test_output_path, 'rb') as input_handle:
+                    chunks = list(filter_illumina_index.iter_stride_chunks(input_handle,
+                                                                          1, chunk_size))
+                self.assertEqual(b''.join(chunks), b''.join(records))
+                with open(test_output_path, 'rb') as input_handle:
+                    chunks = list(filter_illumina_index.iter_stride_chunks(input_handle,
+                                                                          3, chunk_size))
+                sampled = b''.join(chunks)
+                if chunk_size<len(b''.join(records))/3:
+                    self.assertLess(len(sampled), len(b''.join(records))/2)
+                self.assertEqual(len(filter_illumina_index.split_chunk(sampled))%4, 0)
+        # estimates with intervals containing the fraction of all reads
+        index_filter = filter_illumina_index.IndexFilter('GATCGTGT', max_mismatches=1)
+        full_result = index_filter.filter_files(input_test_file_fastq)
+        for head, fraction in [(5, None), (None, 0.5), (None, 1)]:
+            with self.subTest(head = head, fraction = fraction):
+                estimate = index_filter.estimate_file(input_test_file_fastq, head, fraction)
+                self.assertEqual(estimate.result.total, head or full_result.total)
+                fraction, lower, upper = estimate.filtered
+                self.assertLessEqual(lower, full_result.filtered/full_result.total)
+                self.assertGreaterEqual(upper, full_result.filtered/full_result.total)
+
+    @unittest.skipIf(filter_illumina_index.np is None, "numpy not installed")
+    def test_mapped_input(self):
+        # chunks of a mapped file have each record once, including a final
+        # record lacking a newline
+        test_output_path = tests_output_root + 'test_reads_mapped.fastq'
+        records = [b'@r%d:1:N:0:GATCGTGT\nACGT\n+\n@@@%s\n' % (i, b'@I'[i%2:i%2+1])
+                   for i in range(200)]
+        with open(test_output_path, 'wb') as out_handle:
+            out_handle.write(b''.join(records)[:-1])
+        for chunk_size in [1, 30, 100, 10**6]:
+            with self.subTest(chunk_size = chunk_size):
+                with filter_illumina_index.map_file(test_output_path) as mapping:
+                    chunks = list(filter_illumina_index.iter_mapped_chunks(mapping,
+                                                                           chunk_size))
+                    self.assertEqual(b''.join(chunk.view for chunk in chunks),
+                                     b''.join(records))
+                    self.assertEqual(list(itertools.chain.from_iterable(chunk.headers
+                        for chunk in chunks)), [record.split(b'\n')[0] for record in records])
+                    del chunks
+        # same output and decision log as when read as a stream, including
+        # with filtered and unfiltered records interleaved
+        test_interleaved_path = tests_output_root + 'test_reads_interleaved.fastq'
+        with open(test_interleaved_path, 'wb') as out_handle:
+            out_handle.write(b''.join(record.replace(b'GATCGTGT', b'AAAAAAAA')
+                if i%3 else record for i, record in enumerate(records)))
+        index_filter = filter_illumina_index.IndexFilter('GATCGTGT', max_mismatches=1)
+        for input_path in [input_test_file_fastq, test_interleaved_path]:
+            outputs = []
+            for mapped in [True, False]:
+                output_paths = [tests_output_root + 'test_reads_mapped_{}_{}.fastq'.format(
+                    output, mapped) for output in ['filtered', 'unfiltered', 'decisions']]
+                with unittest.mock.patch.object(filter_illumina_index, 'can_map_input',
+                                                return_value = mapped):
+                    index_filter.filter_files(input_path, output_paths[0],
+                        output_paths[1], decision_log_path = output_paths[2])
+                outputs.append([open(path, 'rb').read() for path in output_paths])
+            self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0][0], b''.join(records[::3]))
+        # records not starting with '@'
+        with open(test_output_path, 'wb') as out_handle:
+            out_handle.write(b''.join(records).replace(b'@r1:', b'r1:'))
+        with self.assertRaises(dnaio.FastqFormatError):
+            index_filter.filter_files(test_output_path)
+
+    def test_normalized_records(self):
+        # records with a '+name' third line or '\r\n' line endings are written
+        # byte for byte as dnaio writes them, whether read as a stream or
+        # memory mapped
+        test_input_path = tests_output_root + 'test_reads_normalized.fastq'
+        with open(test_input_path, 'wb') as out_handle:
+            out_handle.write(b'@r1 1:N:0:GATCGTGT\nACGT\n+r1 1:N:0:GATCGTGT\nFFFF\n'
+                             b'@r2 1:N:0:GATCGTGT\r\nAC\r\n+\r\nFF\r\n'
+                             b'@r3 1:N:0:AAAAAAAA\r\nAC\r\n+r3 1:N:0:AAAAAAAA\r\nFF\r\n'
+                             b'@r4 1:N:0:GATCGTGT\nACGT\n+\nFFFF\n')
+        expected_path = tests_output_root + 'test_reads_normalized_dnaio.fastq'
+        with dnaio.open(test_input_path) as input_fastq, \
+             dnaio.open(expected_path, mode='w') as output_fastq:
+            for record in input_fastq:
+                output_fastq.write(record)
+        with open(expected_path, 'rb') as expected_handle:
+            lines = expected_handle.read().splitlines(keepends=True)
+        expected = list(map(b''.join, zip(*[iter(lines)]*4)))
+        index_filter = filter_illumina_index.IndexFilter('GATCGTGT')
+        output_paths = [tests_output_root + 'test_reads_normalized_{}.fastq'.format(output)
+                        for output in ['filtered', 'unfiltered']]
+        for mapped in [True, False]:
+            with self.subTest(mapped = mapped):
+                with unittest.mock.patch.object(filter_illumina_index, 'can_map_input',
+                                                return_value = mapped):
+                    index_filter.filter_files(test_input_path, *output_paths)
+                with open(output_paths[0], 'rb') as filtered_handle, \
+                     open(output_paths[1], 'rb') as unfiltered_handle:
+                    self.assertEqual(filtered_handle.read(),
+                                     b''.join(expected[:2]+expected[3:]))
+                    self.assertEqual(unfiltered_handle.read(), expected[2])
+        # name on the third line not that of the header
+        with open(test_input_path, 'wb') as out_handle:
+            out_handle.write(b'@r1 1:N:0:GATCGTGT\nACGT\n+r2 1:N:0:GATCGTGT\nFFFF\n')
+        for mapped in [True, False]:
+            with self.subTest(mapped = mapped):
+                with unittest.mock.patch.object(filter_illumina_index, 'can_map_input',
+                                                return_value = mapped):
+                    with self.assertRaisesRegex(dnaio.FastqFormatError,
+                                                "Sequence descriptions don't match"):
+                        index_filter.filter_files(test_input_path, *output_paths)
+
+    def test_background_writer(self):
+        # a slow output fills its queue, then writes wait for it; all data is
+        # written in order
+        class SlowHandle(io.BytesIO):
+            def write(self, data):
+                time.sleep(0.01)
+                return super().write(data)
+            def close(self):
+                self.written = self.getvalue()
+                super().close()
+        out_handle = SlowHandle()
+        with filter_illumina_index.BackgroundWriter(out_handle, 2) as writer:
+            for i in range(10):
+                writer.write(b'%d\n' % i)
+            writer.writelines([b'a\n', memoryview(b'b\n')])
+        self.assertEqual(out_handle.written, b''.join(b'%d\n' % i for i in range(10))+b'a\nb\n')
+        self.assertEqual(writer.max_depth, 2)
+        self.assertGreater(writer.n_stalls, 0)
+        self.assertGreater(writer.stall_time, 0)
+        # queue depth and waits of each output shown with -v
+        with contextlib.redirect_stdout(io.StringIO()) as test_stdout:
+            filter_illumina_index_main([input_test_file_fastq, '--index','GATCGTGT','-v',
+                '-f', tests_output_root + 'test_reads_writer_filtered.fastq.gz',
+                '-u', tests_output_root + 'test_reads_writer_unfiltered.fastq'])
+        self.assertRegex(test_stdout.getvalue(), "Writer for .*test_reads_writer_filtered"
+            r"\.fastq\.gz: up to [0-9] of 4 chunks queued, waited [0-9]+ times")
+        self.assertEqual(test_stdout.getvalue().count("Writer for"), 2)
+
+    def test_sidecar(self):
+        # same output and counts as without sidecar index, with or without
+        # numpy, rebuilt when the input changes
+        test_input_path = tests_output_root + 'test_reads_sidecar.fastq'
+        test_sidecar_path = test_input_path + '.fii'
+        with open(input_test_file_fastq_double, 'rb') as input_handle:
+            test_input = input_handle.read()
+        with open(test_input_path, 'wb') as out_handle:
+            out_handle.write(test_input)
+        if os.path.exists(test_sidecar_path): os.remove(test_sidecar_path)
+        output_paths = [tests_output_root + 'test_reads_sidecar_{}.fastq'.format(output)
+                        for output in ['filtered', 'unfiltered']]
+        for max_mismatches, no_numpy in itertools.product([0, 1, 5], [False, True]):
+            with self.subTest(max_mismatches = max_mismatches, no_numpy = no_numpy):
+                index_filter = filter_illumina_index.IndexFilter('GATCGTGT',
+                    'TCTATCCT', '+', max_mismatches)
+                expected_result = index_filter.filter_files(test_input_path, *output_paths)
+                expected_outputs = [open(path, 'rb').read() for path in output_paths]
+                with unittest.mock.patch.object(filter_illumina_index, 'np',
+                        None if no_numpy else filter_illumina_index.np):
+                    test_result = index_filter.filter_files(test_input_path,
+                        *output_paths, sidecar_path = test_sidecar_path)
+                self.assertEqual(test_result.as_dict(), expected_result.as_dict())
+                self.assertEqual([open(path, 'rb').read() for path in output_paths],
+                                 expected_outputs)
+        # only filtered output, with the final record lacking a newline
+        with open(test_input_path, 'wb') as out_handle:
+            out_handle.write(test_input[:-1])
+        self.assertIsNone(filter_illumina_index.SidecarIndex.load(test_sidecar_path,
+                                                                  test_input_path))
+        test_result = index_filter.filter_files(test_input_path, output_paths[0],
+                                                sidecar_path = test_sidecar_path)
+        self.assertEqual(test_result.as_dict(), expected_result.as_dict())
+        self.assertEqual(open(output_paths[0], 'rb').read(), expected_outputs[0])
+        self.assertIsNotNone(filter_illumina_index.SidecarIndex.load(test_sidecar_path,
+                                                                     test_input_path))
+        # index of many small blocks, read a block at a time, with runs of
+        # records carrying on from one block to the next
+        sidecar = filter_illumina_index.SidecarIndex.build(test_input_path,
+            test_sidecar_path, chunk_size = 1000)
+        self.assertGreater(len(list(sidecar.blocks())), 1)
+        for no_numpy in [False, True]:
+            with self.subTest(no_numpy = no_numpy), \
+                 unittest.mock.patch.object(filter_illumina_index, 'np',
+                     None if no_numpy else filter_illumina_index.np):
+                test_result = index_filter.filter_files(test_input_path, output_paths[0],
+                                                        sidecar_path = test_sidecar_path)
+                self.assertEqual(test_result.as_dict(), expected_result.as_dict())
+                self.assertEqual(open(output_paths[0], 'rb').read(), expected_outputs[0])
+                self.assertEqual(list(sidecar.record_runs([0]*len(sidecar.barcodes))),
+                                 [(len(test_input), 0)])
+        # passthrough mode copying compressed input as is, with the number of
+        # reads from the sidecar index rather than decompressing the input
+        test_input_gz_path = tests_output_root + 'test_reads_sidecar.fastq.gz'
+        with open(test_input_gz_path, 'wb') as out_handle:
+            out_handle.write(gzip.compress(test_input))
+        test_output_gz_path = tests_output_root + 'test_reads_sidecar_passthrough.fastq.gz'
+        passthrough_filter = filter_illumina_index.IndexFilter('')
+        filter_illumina_index.SidecarIndex.build(test_input_gz_path, test_sidecar_path)
+        with unittest.mock.patch.object(filter_illumina_index, 'open_input',
+                                        side_effect = AssertionError):
+            test_result = passthrough_filter.filter_files(test_input_gz_path,
+                test_output_gz_path, sidecar_path = test_sidecar_path)
+        self.assertEqual(test_result.total, expected_result.total)
+        with open(test_input_gz_path, 'rb') as input_handle, \
+             open(test_output_gz_path, 'rb') as output_handle:
+            self.assertEqual(output_handle.read(), input_handle.read())
+        with self.assertRaisesRegex(ValueError, "is the input file"):
+            passthrough_filter.filter_files(test_input_gz_path, test_input_gz_path)
+        # corrupt index not used
+        with open(test_sidecar_path, 'r+b') as handle:
+            handle.truncate(100)
+        self.assertIsNone(filter_illumina_index.SidecarIndex.load(test_sidecar_path,
+                                                                  test_input_path))
+
+    def test_benchmark_generator(self):
+        # synthetic reads have the requested barcodes and number of errors
+        test_output_path = tests_output_root + 'test_reads_synthetic.fastq.gz'
+        for barcodes, error_rate, expected_filtered in [
+                ([('GATCGTGT+TCTATCCT', 1.0)], 0.0, 500),
+                ([('GATCGTGT+TCTATCCT', 0.5), ('AATCGTGT+TCTATCCT', 0.5)], 0.0, 259),
+                ([('GATCGTGT+TCTATCCT', 1.0)], 1.0, 0),
+                ([('GATCGTGT+TCTATCCT', 1.0), ('random', 1.0)], 0.0, 259)]:
+            with self.subTest(barcodes = barcodes, error_rate = error_rate):
+                benchmark.generate_fastq(test_output_path, 500, 50, barcodes,
+                                         '+', error_rate, seed = 1)
+                test_result = filter_illumina_index_main([test_output_path,
+                    '--index','GATCGTGT','--separator','+','--index2','TCTATCCT'])
+                self.assertEqual(test_result["total"], 500)
+                self.assertEqual(test_result["filtered"], expected_filtered)
+
+    def test_decision_log(self):
+        for test_set in test_sets_decision_log:
+            test_options, test_expected_file = test_set[:2]
+            test_output_path = tests_output_root + test_expected_file
+            test_options = test_options + ['--decision-log', test_output_path]
+            flat_test_options = " ".join(test_options)
+            with self.subTest(options = flat_test_options):
+                filter_illumina_index_main(test_options)
+                self.helper_compare_bytes(tests_results_root + test_expected_file.replace('.gz', ''),
+                                          test_output_path)
+
+    def test_stats_json(self):
+        test_stats_path = tests_output_root + 'test_reads_stats.json'
+        for test_options, test_expected_output_file, expected_stages in [
+                ([input_test_file_fastq_double, '--index','GATCGTGT','--separator','+',
+                  '--index2','TCTATCCT','-m 1'],
+                 'test_reads_GATCGTGT+TCTATCCT_results_GATCGTGT+TCTATCCT_m1.json',
+                 {'read', 'filter', 'write'}),
+                ([input_test_file_fastq_double, input_test_file_fastq_double_r2,
+                  '--index','GATCGTGT','--separator','+','--index2','TCTATCCT','-m 1',
+                  '--workers','2'],
+                 'test_reads_GATCGTGT+TCTATCCT_results_GATCGTGT+TCTATCCT_m1.json',
+                 {'read', 'filter', 'write'}),
+                ([input_test_file_fastq_gz, '--index',''],
+                 'test_reads_GATCGTGT_results_passthrough.json', {'copy'})]:
+            test_options = test_options + ['--stats-json', test_stats_path,
+                '-f', tests_output_root + 'test_reads_stats_filtered.fastq.gz',
+                '--progress', '1e-9']
+            if '--workers' in test_options: # one output for each input
+                test_options += ['-f', tests_output_root + 'test_reads_stats_filtered_R2.fastq']
+            flat_test_options = " ".join(test_options)
+            with self.subTest(options = flat_test_options):
+                with contextlib.redirect_stderr(io.StringIO()) as test_stderr:
+                    filter_illumina_index_main(test_options)
+                self.assertRegex(test_stderr.getvalue(), "Processed [0-9]+ reads")
+                with open(test_stats_path) as stats_handle:
+                    test_stats = json.load(stats_handle)
+                with open(tests_results_root + test_expected_output_file) as expected_obj:
+                    expected_result = json.load(expected_obj)
+                self.assertEqual(test_stats["results"], expected_result)
+                self.assertTrue(expected_stages <= set(test_stats["stages"]))
+                for test_input_stats in test_stats["inputs"]:
+                    self.assertEqual(test_input_stats["file_bytes"],
+                                     os.path.getsize(test_input_stats["path"]))
+                    if not test_input_stats["path"].endswith('.gz'):
+                        self.assertEqual(test_input_stats["bytes"],
+                                         test_input_stats["file_bytes"])
+                for test_output_stats in test_stats["outputs"]:
+                    self.assertEqual(test_output_stats["file_bytes"],
+                                     os.path.getsize(test_output_stats["path"]))
+                    # time waiting for writer thread, unless input copied
+                    self.assertEqual("stall_s" in test_output_stats,
+                                     expected_stages != {'copy'})
+
+    def test_index_filter_api(self):
+        index_filter = filter_illumina_index.IndexFilter('GATCGTGT', 'TCTATCCT', '+', 1)
+        for name, expected_classification in [
+                ('FAKE-SEQ:1:FAKE-FLOWCELL-ID:1:1:0:1 1:N:0:GATCGTGT+TCTATCCT', (0, 0, True)),
+                ('@FAKE-SEQ:1:FAKE-FLOWCELL-ID:1:1:0:1 1:N:0:AATCGTGT+TCTATCCT', (1, 0, True)),
+                (b'@FAKE-SEQ:1:FAKE-FLOWCELL-ID:1:1:0:1 1:N:0:AATCGTGT+TGTATCCT', (1, 1, False)),
+                ('read 1:N:0:GATCGTGT+TCTATCCTAA', (0, 2, False))]:
+            with self.subTest(name = name):
+                self.assertEqual(index_filter.classify(name), expected_classification)
+        with self.assertRaisesRegex(ValueError, "no barcode"):
+            index_filter.classify('read')
+        with self.assertRaisesRegex(ValueError, "no separator"):
+            index_filter.classify('read 1:N:0:GATCGTGT')
+
+        # filtering a stream of records, giving same results as command line
+        with open(tests_results_root + 'test_reads_GATCGTGT+TCTATCCT_results_GATCGTGT+TCTATCCT_m1.json') as expected_obj:
+            expected_result = json.load(expected_obj)
+        with dnaio.open(input_test_file_fastq_double) as records:
+            stream = index_filter.filter_stream(records)
+            filtered_names = []
+            while True:
+                try:
+                    record, filtered = next(stream)
+                except StopIteration as stop:
+                    test_result = stop.value
+                    break
+                if filtered: filtered_names.append(record.name)
+        self.assertEqual(json.loads(json.dumps(test_result.as_dict())), expected_result)
+        with dnaio.open(tests_results_root +
+                'test_reads_GATCGTGT+TCTATCCT_filtered_GATCGTGT+TCTATCCT_m1.fastq') as records:
+            self.assertEqual(filtered_names, [record.name for record in records])
+
+        # same filter reused for files, with indexes cached from first file
+        test_expected_filtered_file = 'test_reads_GATCGTGT+TCTATCCT_filtered_GATCGTGT+TCTATCCT_m1.fastq'
+        cache_misses = []
+        for test_output_file in [test_expected_filtered_file, test_expected_filtered_file+'.gz']:
+            test_output_path = tests_output_root + test_output_file
+            test_result = index_filter.filter_files(input_test_file_fastq_double,
+                                                    test_output_path)
+            self.assertEqual(json.loads(json.dumps(test_result.as_dict())), expected_result)
+            self.helper_compare_bytes(tests_results_root + test_expected_filtered_file,
+                                      test_output_path)
+            cache_misses.append(index_filter.cache_info().misses)
+        self.assertEqual(cache_misses[0], cache_misses[1])
+
     def helper_compare_files(self, path1, path2):
         opener1 = functools.partial(gzip.open, mode='rt') if path1.endswith('gz') else functools.partial(open, mode='r')
         opener2 = functools.partial(gzip.open, mode='rt') if path2.endswith('gz') else functools.partial(open, mode='r')
@@ -332,6 +1186,14 @@ class TestFilerIlluminaIndex(unittest.TestCase):
                         '{} vs {}, line {} mismatch'.format(path1,
                             path2, line_index))
 
+    def helper_compare_bytes(self, path1, path2):
+        opener1 = gzip.open if path1.endswith('gz') else open
+        opener2 = gzip.open if path2.endswith('gz') else open
+        with opener1(path1, 'rb') as handle1:
+            with opener2(path2, 'rb') as handle2:
+                self.assertEqual(handle1.read(), handle2.read(),
+                    '{} vs {}, not byte-identical'.format(path1, path2))
+
     def test_results_output(self):
         for test_set in test_sets_vs_output:
             test_options, test_expected_output_pair = test_set[:2]
@@ -356,8 +1218,306 @@ class TestFilerIlluminaIndex(unittest.TestCase):
                 filter_illumina_index_main(test_options)
                 if test_expected_filtered_file:
                     self.helper_compare_files(test_expected_filtered_path, test_output_filtered_path)
+                    self.helper_compare_bytes(test_expected_filtered_path, test_output_filtered_path)
                 if test_expected_unfiltered_file:
                     self.helper_compare_files(test_expected_unfiltered_path, test_output_unfiltered_path)
+                    self.helper_compare_bytes(test_expected_unfiltered_path, test_output_unfiltered_path)
+
+    def test_paired_output(self):
+        for test_set in test_sets_paired_output:
+            test_options, test_expected_output_pairs = test_set[:2]
+            test_options = list(test_options)
+            for test_expected_output_pair in test_expected_output_pairs:
+                for option, test_expected_file in zip(('-f', '-u'), test_expected_output_pair):
+                    if test_expected_file is None: # output not checked against
+                        test_expected_file = 'test_reads_paired_unchecked{}.fastq'.format(option)
+                    test_options.extend([option, tests_output_root + test_expected_file])
+            flat_test_options = " ".join(test_options)
+            with self.subTest(options = flat_test_options):
+                print("Testing options {}, comparing output to {}:".format(
+                    flat_test_options, test_expected_output_pairs))
+                filter_illumina_index_main(test_options)
+                for test_expected_output_pair in test_expected_output_pairs:
+                    for test_expected_file in test_expected_output_pair:
+                        if test_expected_file is None: continue
+                        self.helper_compare_bytes(tests_results_root + test_expected_file,
+                            tests_output_root + test_expected_file)
+
+    def test_standard_streams(self):
+        # input piped to standard input (compression detected from content),
+        # output to standard output with all messages on stderr
+        for test_options, test_input_file, test_expected_file in [
+            (['-', '--index','GATCGTGT','-m','1','-u','-','-v'], input_test_file_fastq,
+             tests_results_root + 'test_reads_GATCGTGT_unfiltered_m1.fastq'),
+            (['-', '--index','GATCGTGT','-m','1','-u','-'], input_test_file_fastq_gz,
+             tests_results_root + 'test_reads_GATCGTGT_unfiltered_m1.fastq'),
+            ([input_test_file_fastq, '--index','GATCGTGT','-f','-'], None,
+             tests_results_root + 'test_reads_GATCGTGT_filtered.fastq'),
+            (['-', '--index','-f','-'], input_test_file_fastq_gz, input_test_file_fastq),
+            (['-', '--index','GATCGTGT','-m','1','-f',
+              tests_output_root + 'test_reads_stdin_filtered_m1.fastq.gz'],
+             input_test_file_fastq, None),
+            ]:
+            with self.subTest(options = " ".join(test_options), input = test_input_file):
+                with contextlib.ExitStack() as stack:
+                    input_handle = stack.enter_context(open(test_input_file, 'rb')) \
+                        if test_input_file else subprocess.DEVNULL
+                    process = subprocess.run([sys.executable, '-m',
+                        'filter_illumina_index.filter_illumina_index'] + test_options,
+                        stdin = input_handle, stdout = subprocess.PIPE,
+                        stderr = subprocess.PIPE, check = True)
+                if test_expected_file is None:
+                    # no output to standard output, so messages shown there
+                    self.assertIn(b'Total reads: 30', process.stdout)
+                    self.helper_compare_bytes(
+                        tests_results_root + 'test_reads_GATCGTGT_filtered_m1.fastq.gz',
+                        tests_output_root + 'test_reads_stdin_filtered_m1.fastq.gz')
+                else:
+                    self.assertIn(b'Total reads: 30', process.stderr)
+                    with open(test_expected_file, 'rb') as expected_handle:
+                        self.assertEqual(process.stdout, expected_handle.read())
+
+    def test_split_cpu_budget(self):
+        for cpus, n_jobs, expected in [
+                (1, 4, (1, 0, 0)), (2, 4, (1, 0, 1)), (3, 4, (1, 1, 1)),
+                (8, 4, (2, 1, 2)), (16, 2, (2, 1, 6)), (16, 8, (5, 1, 1)),
+                (64, 4, (4, 1, 14))]:
+            with self.subTest(cpus = cpus, n_jobs = n_jobs):
+                self.assertEqual(filter_illumina_index.split_cpu_budget(cpus, n_jobs),
+                                 expected)
+
+    def test_batch(self):
+        # jobs of a manifest give the same output as run separately, with
+        # missing columns from the command line; a failed job is reported
+        # without stopping the others
+        test_manifest_path = tests_output_root + 'test_batch_manifest.csv'
+        test_stats_path = tests_output_root + 'test_batch_stats.json'
+        output_root = tests_output_root + 'test_batch_'
+        with open(test_manifest_path, 'w') as manifest_handle:
+            manifest_handle.write('name,input,filtered,unfiltered,index2,mismatches\n')
+            manifest_handle.write('single,{},{}filtered.fastq.gz,{}unfiltered.fastq,,\n'.format(
+                input_test_file_fastq, output_root, output_root))
+            manifest_handle.write('paired,{};{},{}R1_filtered.fastq;{}R2_filtered.fastq,,'
+                'TCTATCCT,1\n'.format(input_test_file_fastq_double,
+                input_test_file_fastq_double_r2, output_root, output_root))
+            manifest_handle.write('missing,{}missing.fastq,,,,\n'.format(tests_root))
+        with self.assertRaises(SystemExit) as cm:
+            with contextlib.redirect_stderr(io.StringIO()):
+                filter_illumina_index_main(['--batch', test_manifest_path, '--index',
+                    'GATCGTGT', '--separator', '+', '--cpus', '6',
+                    '--stats-json', test_stats_path])
+        self.assertEqual(cm.exception.code, 1)
+        for expected_file, output_file in [
+                ('test_reads_GATCGTGT_filtered.fastq.gz', 'filtered.fastq.gz'),
+                ('test_reads_GATCGTGT_unfiltered.fastq', 'unfiltered.fastq'),
+                ('test_reads_GATCGTGT+TCTATCCT_filtered_GATCGTGT+TCTATCCT_m1.fastq',
+                 'R1_filtered.fastq'),
+                ('test_reads_GATCGTGT+TCTATCCT_R2_filtered_GATCGTGT+TCTATCCT_m1.fastq',
+                 'R2_filtered.fastq')]:
+            self.helper_compare_bytes(tests_results_root + expected_file,
+                                      output_root + output_file)
+        with open(test_stats_path) as stats_handle:
+            test_stats = json.load(stats_handle)
+        self.assertEqual([job["name"] for job in test_stats["jobs"]],
+                         ['single', 'paired', 'missing'])
+        self.assertIn("FileNotFoundError", test_stats["jobs"][2]["error"])
+        self.assertEqual((test_stats["parallel_jobs"], test_stats["jobs_done"],
+                          test_stats["jobs_failed"]), (2, 2, 1))
+        self.assertEqual(test_stats["reads"], sum(job["results"]["total"]
+                                                  for job in test_stats["jobs"][:2]))
+        with open(tests_results_root + 'test_reads_GATCGTGT_results.json') as expected_obj:
+            self.assertEqual(test_stats["jobs"][0]["results"], json.load(expected_obj))
+        # indexes needed for every job
+        with open(test_manifest_path, 'w') as manifest_handle:
+            manifest_handle.write('input\n{}\n'.format(input_test_file_fastq))
+        with self.assertRaisesRegex(ValueError, "no index"):
+            filter_illumina_index.read_manifest(test_manifest_path)
+
+    def test_serve(self):
+        # requests run at once by a server give the same results and output
+        # as the program run directly, with its messages and exit status
+        test_socket_path = tests_output_root + 'test_serve.sock'
+        output_root = tests_output_root + 'test_serve_'
+        server = subprocess.Popen([sys.executable, '-m',
+            'filter_illumina_index.filter_illumina_index', '--serve', test_socket_path,
+            '--max-concurrent', '2'], stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        try:
+            for _ in range(100):
+                if os.path.exists(test_socket_path): break
+                time.sleep(0.1)
+            test_requests = [
+                [input_test_file_fastq, '--index', 'GATCGTGT', '-f',
+                 output_root + 'filtered.fastq'],
+                [input_test_file_fastq, '--index', 'GATCGTGT', '-m', '1', '-u',
+                 output_root + 'unfiltered_m1.fastq'],
+                [tests_root + 'missing.fastq', '--index', 'GATCGTGT'],
+                ['-', '--index', 'GATCGTGT']]
+            with concurrent.futures.ThreadPoolExecutor(len(test_requests)) as executor:
+                replies = list(executor.map(functools.partial(client.run, test_socket_path),
+                                            test_requests))
+        finally:
+            client.shutdown(test_socket_path)
+            server_output, _ = server.communicate(timeout = 60)
+        self.assertEqual(server.returncode, 0)
+        self.assertIn(b'Served 4 requests', server_output)
+        self.assertFalse(os.path.exists(test_socket_path))
+        self.assertEqual([reply["exit_status"] for reply in replies], [0, 0, 1, 2])
+        with open(tests_results_root + 'test_reads_GATCGTGT_results.json') as expected_obj:
+            self.assertEqual(replies[0]["result"], json.load(expected_obj))
+        self.assertIn('Total reads: 30', replies[1]["stdout"])
+        self.assertIn('FileNotFoundError', replies[2]["stderr"])
+        self.assertIn('cannot be used in a served request', replies[3]["stderr"])
+        self.helper_compare_bytes(tests_results_root + 'test_reads_GATCGTGT_filtered.fastq',
+                                  output_root + 'filtered.fastq')
+        self.helper_compare_bytes(tests_results_root + 'test_reads_GATCGTGT_unfiltered_m1.fastq',
+                                  output_root + 'unfiltered_m1.fastq')
+
+    def test_checkpoint(self):
+        # a run stopped after a checkpoint, with output written after it,
+        # carries on from it to the same output and results as a whole run
+        with open(input_test_file_fastq_double, 'rb') as input_handle:
+            data = input_handle.read()
+        members_path = tests_output_root + 'test_reads_checkpoint_members.fastq.gz'
+        with open(members_path, 'wb') as out_handle:
+            for start in range(0, len(data), 700):
+                out_handle.write(gzip.compress(data[start:start+700]))
+        single_path = tests_output_root + 'test_reads_checkpoint_single.fastq.gz'
+        with open(single_path, 'wb') as out_handle:
+            out_handle.write(gzip.compress(data))
+        expected_root = tests_results_root + 'test_reads_GATCGTGT+TCTATCCT_'
+        with open(expected_root + 'results_GATCGTGT+TCTATCCT_m1.json') as expected_obj:
+            expected_result = json.load(expected_obj)
+        test_checkpoint_path = tests_output_root + 'test_reads_checkpoint.json'
+        save_checkpoint = filter_illumina_index.IndexFilter._save_checkpoint
+        def interrupt_after_saving(*args):
+            save_checkpoint(*args)
+            raise KeyboardInterrupt
+        index_filter = filter_illumina_index.IndexFilter('GATCGTGT', 'TCTATCCT', '+', 1)
+        for input_path, extension, decompress_threads, decompressed_again in [
+                (input_test_file_fastq_double, '', 0, False),
+                (members_path, '.gz', 2, False),
+                (members_path, '.zst', 0, False),
+                (single_path, '.gz', 0, True)]:
+            with self.subTest(input_path = input_path, extension = extension):
+                output_paths = [tests_output_root + 'test_reads_checkpoint_{}.fastq{}'.format(
+                    output, extension) for output in ['filtered', 'unfiltered']]
+                decision_log_path = tests_output_root + 'test_reads_checkpoint.tsv' + extension
+                filter_files = functools.partial(index_filter.filter_files, input_path,
+                    output_paths[0], output_paths[1], decision_log_path = decision_log_path,
+                    decompress_threads = decompress_threads,
+                    checkpoint_path = test_checkpoint_path, checkpoint_interval = 0)
+                with unittest.mock.patch.object(filter_illumina_index, 'iter_chunks',
+                        functools.partial(filter_illumina_index.iter_chunks, chunk_size = 1000)), \
+                     unittest.mock.patch.object(filter_illumina_index, 'iter_mapped_chunks',
+                        functools.partial(filter_illumina_index.iter_mapped_chunks,
+                                          chunk_size = 1000)):
+                    with unittest.mock.patch.object(filter_illumina_index.IndexFilter,
+                            '_save_checkpoint', staticmethod(interrupt_after_saving)):
+                        with self.assertRaises(KeyboardInterrupt):
+                            filter_files()
+                    with open(test_checkpoint_path) as checkpoint_obj:
+                        self.assertGreater(json.load(checkpoint_obj)["input_offsets"][0], 0)
+                    for output_path in output_paths:
+                        with open(output_path, 'ab') as out_handle:
+                            out_handle.write(b'written after checkpoint')
+                    test_messages = []
+                    test_result = filter_files(log = test_messages.append)
+                self.assertRegex(test_messages[0], "Resuming from checkpoint .* after [0-9]+ reads")
+                self.assertEqual(any(message.startswith("Warning: {} is decompressed again"
+                    .format(input_path)) for message in test_messages), decompressed_again)
+                self.assertEqual(json.loads(json.dumps(test_result.as_dict())), expected_result)
+                self.assertFalse(os.path.exists(test_checkpoint_path))
+                for output_path, expected_path in zip(output_paths + [decision_log_path], [
+                        expected_root + 'filtered_GATCGTGT+TCTATCCT_m1.fastq',
+                        expected_root + 'unfiltered_GATCGTGT+TCTATCCT_m1.fastq',
+                        expected_root + 'decisions_GATCGTGT+TCTATCCT_m1.tsv']):
+                    with open(expected_path, 'rb') as expected_handle, \
+                         xopen.xopen(output_path, 'rb') as output_handle:
+                        self.assertEqual(output_handle.read(), expected_handle.read())
+        # checkpoint of another run not used
+        filter_illumina_index.Checkpoint({"inputs": []}, [0], [None], {}, {}).save(
+            test_checkpoint_path)
+        with self.assertRaisesRegex(ValueError, "another run"):
+            index_filter.filter_files(input_test_file_fastq_double,
+                                      checkpoint_path = test_checkpoint_path)
+        os.remove(test_checkpoint_path)
+
+    def test_tiered_output(self):
+        # each tier has the records filtered within its threshold but not the
+        # one before, in input order, for each input file, whichever way the
+        # input is read
+        thresholds = [0, 2, 5]
+        def read_records(path):
+            with open(path, 'rb') as handle:
+                lines = handle.read().splitlines(keepends = True)
+            return [b''.join(lines[i:i+4]) for i in range(0, len(lines), 4)]
+        input_paths = [input_test_file_fastq_double, input_test_file_fastq_double_r2]
+        expected_records = []
+        for threshold in thresholds:
+            output_paths = [tests_output_root + 'test_reads_tiers_expected_{}_m{}.fastq'.format(
+                file_number, threshold) for file_number in range(len(input_paths))]
+            filter_illumina_index.IndexFilter('NNNCGTGT', 'NNNATCCT', '+',
+                threshold).filter_files(input_paths, output_paths)
+            expected_records.append(list(map(read_records, output_paths)))
+        expected_unfiltered = None
+        for options in [{}, {"workers": 2}, {"sidecar": True}, {"paired": True},
+                        {"gz": True}]:
+            with self.subTest(**options):
+                index_filter = filter_illumina_index.IndexFilter('NNNCGTGT',
+                    'NNNATCCT', '+', thresholds)
+                test_input_paths = input_paths if options.get("paired") else input_paths[:1]
+                if options.get("gz"):
+                    test_input_paths = [tests_output_root + 'test_reads_tiers.fastq.gz']
+                    with open(input_paths[0], 'rb') as input_handle, \
+                         gzip.open(test_input_paths[0], 'wb') as out_handle:
+                        out_handle.write(input_handle.read())
+                filtered_paths = [tests_output_root + 'test_reads_tiers_{}_m{{mismatches}}.fastq'.format(
+                    file_number) for file_number in range(len(test_input_paths))]
+                unfiltered_paths = [tests_output_root + 'test_reads_tiers_{}_unfiltered.fastq'.format(
+                    file_number) for file_number in range(len(test_input_paths))]
+                sidecar_path = tests_output_root + 'test_reads_tiers.fastq.fii' \
+                    if options.get("sidecar") else None
+                test_result = index_filter.filter_files(test_input_paths, filtered_paths,
+                    unfiltered_paths, workers = options.get("workers", 0),
+                    sidecar_path = sidecar_path)
+                self.assertEqual(index_filter.tier_paths(filtered_paths),
+                    [path.replace('{mismatches}', str(threshold))
+                     for threshold in thresholds for path in filtered_paths])
+                previous_records = [[] for path in test_input_paths]
+                for tier, threshold in enumerate(thresholds):
+                    for file_number, filtered_path in enumerate(filtered_paths):
+                        tier_records = read_records(filtered_path.format(mismatches = threshold))
+                        self.assertEqual(tier_records, [record for record in
+                            expected_records[tier][file_number]
+                            if record not in previous_records[file_number]])
+                        previous_records[file_number] = expected_records[tier][file_number]
+                    self.assertEqual(test_result.threshold_counts()[tier][1:],
+                        (len(tier_records), len(expected_records[tier][0])))
+                unfiltered = read_records(unfiltered_paths[0])
+                if expected_unfiltered is None: expected_unfiltered = unfiltered
+                self.assertEqual(unfiltered, expected_unfiltered)
+                self.assertEqual(list(test_result.as_dict()["thresholds"]), thresholds)
+        with self.assertRaises(ValueError):
+            index_filter.filter_files(input_paths[0], tests_output_root + 'test_reads_tiers.fastq')
+
+    def test_demux_output(self):
+        for test_set in test_sets_demux_output:
+            test_options, test_output_template, test_samples, test_expected_unassigned_file = test_set
+            test_options = test_options + ['--output', tests_output_root + test_output_template]
+            if test_expected_unassigned_file is not None:
+                test_options.extend(['-u', tests_output_root + test_expected_unassigned_file])
+            flat_test_options = " ".join(test_options)
+            with self.subTest(options = flat_test_options):
+                print("Testing options {}, comparing output to {} for samples {}:".format(
+                    flat_test_options, test_output_template, test_samples))
+                filter_illumina_index_main(test_options)
+                for sample in test_samples:
+                    test_expected_file = test_output_template.format(sample=sample)
+                    self.helper_compare_files(tests_results_root + test_expected_file,
+                        tests_output_root + test_expected_file)
+                if test_expected_unassigned_file is not None:
+                    self.helper_compare_files(tests_results_root + test_expected_unassigned_file,
+                        tests_output_root + test_expected_unassigned_file)
 
     def test_errors(self):
         # generic tests for testing exceptions are generated
@@ -404,6 +1564,39 @@ def generate_results():
         print("Running with options {}:".format(' '.join(test_options)))
         filter_illumina_index_main(test_options)
 
+    for test_set in test_sets_paired_output:
+        if len(test_set)>2: # third parameter == False, don't generate
+            if test_set[2]  == False:
+                continue
+        test_options, test_expected_output_pairs = test_set[:2]
+        test_options = list(test_options)
+        for test_expected_output_pair in test_expected_output_pairs:
+            for option, test_expected_file in zip(('-f', '-u'), test_expected_output_pair):
+                if test_expected_file is None:
+                    test_expected_file = 'test_reads_paired_unchecked{}.fastq'.format(option)
+                    test_options.extend([option, tests_output_root + test_expected_file])
+                else:
+                    test_options.extend([option, tests_results_root + test_expected_file])
+        print("Running with options {}:".format(' '.join(test_options)))
+        filter_illumina_index_main(test_options)
+
+    for test_set in test_sets_decision_log:
+        if len(test_set)>2: # third parameter == False, don't generate
+            if test_set[2]  == False:
+                continue
+        test_options, test_expected_file = test_set[:2]
+        test_options = test_options + ['--decision-log', tests_results_root + test_expected_file]
+        print("Running with options {}:".format(' '.join(test_options)))
+        filter_illumina_index_main(test_options)
+
+    for test_set in test_sets_demux_output:
+        test_options, test_output_template, test_samples, test_expected_unassigned_file = test_set
+        test_options = test_options + ['--output', tests_results_root + test_output_template]
+        if test_expected_unassigned_file is not None:
+            test_options.extend(['-u', tests_results_root + test_expected_unassigned_file])
+        print("Running with options {}:".format(' '.join(test_options)))
+        filter_illumina_index_main(test_options)
+
 
 if __name__ == '__main__':
     if '--generate' in sys.argv:
@@ -8,7 +8,7 @@ with open("README.md", "r") as fh:
 
 setuptools.setup(
     name="filter_illumina_index",
-    version="1.0.5",
+    version="1.1.0.dev0",
     author="Tet Woo Lee",
     author_email="developer@twlee.nz",
     description="Filter a Illumina FASTQ file based on index sequence",
@@ -18,16 +18,21 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     package_data={
         "filter_illumina_index.tests": ["data/*.fastq",
+                                        "data/*.csv",
                                         "data/*.fastq.gz",
                                         "data/results/*.fastq",
                                         "data/results/*.fastq.gz",
                                         "data/results/*.json",
+                                        "data/results/*.tsv",
                                         "tmp/.gitkeep"]
                                         },
     install_requires=[
         "xopen >=v0.9.0",
         "dnaio >=v0.4.1"
     ],
+    extras_require={
+        "numpy": ["numpy"],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: GNU General Public License v3 (GPLv3)",
@@ -36,6 +41,7 @@ setuptools.setup(
     entry_points={
         "console_scripts": [
             "filter_illumina_index = filter_illumina_index.filter_illumina_index:main",
+            "filter_illumina_index_client = filter_illumina_index.client:main",
         ],
     },
     test_suite="filter_illumina_index.tests",